@@ -0,0 +1,207 @@
+"""Almacén de archivos del Ministerio Público direccionado por contenido.
+
+Los documentos base64 devueltos por ``ObtenerArchivoEstadoNotificacion`` se
+guardan una única vez en ``archivomp``, con el SHA-256 del texto como clave.
+``enviocedulanotificacionpolicia`` y ``notpolhistoricomp`` conservan solo el
+digest y el tamaño, y el contenido se lee bajo demanda con
+:func:`obtener_contenido`.
+
+Los contenidos que exponen ``fragmentos()`` (como ``ContenidoArchivo`` de
+``retornoxmlmp``) se envían con ``COPY`` leyendo de a un fragmento, sin armar
+el texto completo ni su copia escapada en memoria.
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+import hashlib
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+import psycopg2
+from psycopg2 import extras
+
+
+_SENTENCIA_EXISTENTES = "SELECT digest FROM archivomp WHERE digest = ANY(%s)"
+
+_SENTENCIA_INSERTAR = """
+    INSERT INTO archivomp (digest, tamano, contenido)
+    VALUES %s
+    ON CONFLICT (digest) DO NOTHING
+"""
+
+TAMANO_LECTURA_COPY = 64 * 1024
+
+# Tabla de paso para COPY, que no admite ON CONFLICT: un digest insertado por
+# otro proceso entre la consulta de existentes y la carga no debe fallar.
+_SENTENCIA_CREAR_CARGA = """
+    CREATE TEMP TABLE IF NOT EXISTS archivomp_carga (
+        digest char(64),
+        tamano integer,
+        contenido text
+    ) ON COMMIT DELETE ROWS
+"""
+
+_SENTENCIA_COPIAR_CARGA = "COPY archivomp_carga (digest, tamano, contenido) FROM STDIN"
+
+_SENTENCIA_VOLCAR_CARGA = """
+    WITH carga AS (
+        DELETE FROM archivomp_carga
+        RETURNING digest, tamano, contenido
+    )
+    INSERT INTO archivomp (digest, tamano, contenido)
+    SELECT digest, tamano, contenido
+    FROM carga
+    ON CONFLICT (digest) DO NOTHING
+"""
+
+_SENTENCIA_REFERENCIA_POR_CODIGO = """
+    SELECT ecedarchivoseguimientodigest, ecedarchivoseguimientotamano
+    FROM enviocedulanotificacionpolicia
+    WHERE codigoseguimientompnorm = TRIM(%s)
+      AND ecedarchivoseguimientodigest IS NOT NULL
+    LIMIT 1
+"""
+
+_SENTENCIA_REFERENCIA_HISTORIAL_POR_CODIGO = """
+    SELECT notpolhistoricomparchdigest, notpolhistoricomparchtamano
+    FROM notpolhistoricomp
+    WHERE codigoseguimientompnorm = TRIM(%s)
+      AND notpolhistoricomparchdigest IS NOT NULL
+      AND notpolhistoricomparchivoid IS NOT NULL
+      AND notpolhistoricomparchivoid <> 0
+    ORDER BY notpolhistoricompfechats DESC NULLS LAST
+    LIMIT 1
+"""
+
+
+@dataclass(frozen=True)
+class ReferenciaArchivo:
+    """Digest y tamaño de un archivo almacenado, sin su contenido."""
+
+    digest: str
+    tamano: Optional[int]
+
+    def leer(self, conexion: psycopg2.extensions.connection) -> Optional[str]:
+        return obtener_contenido(conexion, self.digest)
+
+
+def calcular_digest_contenido(contenido: str) -> str:
+    """SHA-256 hexadecimal del texto tal como se almacena."""
+
+    return hashlib.sha256(contenido.encode("utf-8")).hexdigest()
+
+
+class _LectorCopia:
+    """Archivo de solo lectura sobre las partes de un ``COPY`` generadas al vuelo."""
+
+    def __init__(self, partes: Iterable[bytes]) -> None:
+        self._partes = iter(partes)
+        self._buffer = b""
+
+    def read(self, tamano: int = -1) -> bytes:
+        while tamano < 0 or len(self._buffer) < tamano:
+            parte = next(self._partes, None)
+            if parte is None:
+                break
+            self._buffer += parte
+        if tamano < 0:
+            tamano = len(self._buffer)
+        datos, self._buffer = self._buffer[:tamano], self._buffer[tamano:]
+        return datos
+
+def _escapar_copia(fragmento: bytes) -> bytes:
+    # Formato de texto de COPY; los bytes ASCII no aparecen dentro de
+    # secuencias UTF-8 multibyte, así que se puede escapar por fragmento.
+    return (
+        fragmento.replace(b"\\", b"\\\\")
+        .replace(b"\n", b"\\n")
+        .replace(b"\r", b"\\r")
+        .replace(b"\t", b"\\t")
+    )
+
+
+def _partes_copia(contenidos: Iterable[Tuple[str, Optional[int], object]]) -> Iterator[bytes]:
+    for digest, tamano, contenido in contenidos:
+        tamano_texto = "\\N" if tamano is None else str(tamano)
+        yield f"{digest}\t{tamano_texto}\t".encode("ascii")
+        for fragmento in contenido.fragmentos():  # type: ignore[attr-defined]
+            yield _escapar_copia(fragmento)
+        yield b"\n"
+
+
+def _copiar_contenidos(
+    cursor: psycopg2.extensions.cursor,
+    contenidos: List[Tuple[str, Optional[int], object]],
+) -> None:
+    cursor.execute(_SENTENCIA_CREAR_CARGA)
+    cursor.copy_expert(
+        _SENTENCIA_COPIAR_CARGA,
+        _LectorCopia(_partes_copia(contenidos)),
+        size=TAMANO_LECTURA_COPY,
+    )
+    cursor.execute(_SENTENCIA_VOLCAR_CARGA)
+
+
+def guardar_contenidos(
+    cursor: psycopg2.extensions.cursor,
+    contenidos: Iterable[Tuple[str, int, object]],
+) -> int:
+    """Guarda los ``(digest, tamano, contenido)`` que todavía no existen.
+
+    Se consulta primero qué digests ya están almacenados para no enviar de
+    nuevo el contenido de los archivos repetidos. Los contenidos con
+    ``fragmentos()`` se cargan con ``COPY`` y el resto con un ``INSERT``
+    multi-fila. Devuelve cuántos se insertaron.
+    """
+
+    pendientes = {digest: (digest, tamano, contenido) for digest, tamano, contenido in contenidos}
+    if not pendientes:
+        return 0
+
+    cursor.execute(_SENTENCIA_EXISTENTES, (list(pendientes),))
+    for (digest,) in cursor.fetchall():
+        pendientes.pop(digest, None)
+    if not pendientes:
+        return 0
+
+    por_fragmentos = [fila for fila in pendientes.values() if hasattr(fila[2], "fragmentos")]
+    textos = [fila for fila in pendientes.values() if not hasattr(fila[2], "fragmentos")]
+    if por_fragmentos:
+        _copiar_contenidos(cursor, por_fragmentos)
+    if textos:
+        extras.execute_values(
+            cursor,
+            _SENTENCIA_INSERTAR,
+            textos,
+            template="(%s, %s, %s::text)",
+            page_size=len(textos),
+        )
+    return len(pendientes)
+
+
+def obtener_contenido(
+    conexion: psycopg2.extensions.connection, digest: str
+) -> Optional[str]:
+    """Devuelve el contenido almacenado para ``digest``."""
+
+    with conexion.cursor() as cursor:
+        cursor.execute("SELECT contenido FROM archivomp WHERE digest = %s", (digest,))
+        fila = cursor.fetchone()
+    return fila[0] if fila else None
+
+
+def obtener_referencia_por_codigo(
+    conexion: psycopg2.extensions.connection, codigo_seguimiento: str
+) -> Optional[ReferenciaArchivo]:
+    """Referencia del archivo del envío o, si no hay, del último historial."""
+
+    with conexion.cursor() as cursor:
+        for consulta in (
+            _SENTENCIA_REFERENCIA_POR_CODIGO,
+            _SENTENCIA_REFERENCIA_HISTORIAL_POR_CODIGO,
+        ):
+            cursor.execute(consulta, (codigo_seguimiento,))
+            fila = cursor.fetchone()
+            if fila and fila[0]:
+                return ReferenciaArchivo(digest=fila[0].strip(), tamano=fila[1])
+    return None
@@ -6,9 +6,10 @@ WITH historico AS (
         n.pactuacionid,
         n.pdomicilioelectronicopj,
         n.notpolhistoricompfecha,
+        n.notpolhistoricompfechats,
         n.notpolhistoricompestado,
         n.notpolhistoricompestadonid,
-        MAX(CASE WHEN n.notpolhistoricompestado ILIKE 'Entregada' THEN n.notpolhistoricompfecha END)
+        MAX(CASE WHEN n.notpolhistoricompestado ILIKE 'Entregada' THEN n.notpolhistoricompfechats END)
             OVER (
                 PARTITION BY n.pmovimientoid, n.pactuacionid, n.pdomicilioelectronicopj
             ) AS ultima_entregada_fecha
@@ -28,7 +29,7 @@ con_estados_posteriores AS (
         WHERE posteriores.pmovimientoid = h.pmovimientoid
           AND posteriores.pactuacionid = h.pactuacionid
           AND COALESCE(posteriores.pdomicilioelectronicopj, '') = COALESCE(h.pdomicilioelectronicopj, '')
-          AND posteriores.notpolhistoricompfecha > h.ultima_entregada_fecha
+          AND posteriores.notpolhistoricompfechats > h.ultima_entregada_fecha
       )
 )
 SELECT
@@ -49,9 +50,9 @@ LEFT JOIN public.enviocedulanotificacionpolicia AS env
  ON env.pmovimientoid = posteriores.pmovimientoid
  AND env.pactuacionid = posteriores.pactuacionid
  AND COALESCE(env.pdomicilioelectronicopj, '') = COALESCE(posteriores.pdomicilioelectronicopj, '')
-WHERE posteriores.notpolhistoricompfecha > con_estados_posteriores.ultima_entregada_fecha
+WHERE posteriores.notpolhistoricompfechats > con_estados_posteriores.ultima_entregada_fecha
 ORDER BY
     posteriores.pmovimientoid,
     posteriores.pactuacionid,
     posteriores.pdomicilioelectronicopj,
-    posteriores.notpolhistoricompfecha;
+    posteriores.notpolhistoricompfechats;
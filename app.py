@@ -14,7 +14,10 @@ import json
 import xml.etree.ElementTree as ET
 from typing import Tuple, Optional, Any, List, Sequence  # ✅ agregado
 
+import registro
 from soap_notificacion import consultar_estado_notificacion
+
+log = registro.obtener("app")
 app = FastAPI()
 templates = Jinja2Templates(directory="templates")
 
@@ -228,7 +231,7 @@ async def root(params: QueryParams, background_tasks: BackgroundTasks):
             procesar_e_insertar(pgsql_config, panel_config, test, query_sql)
             procesar_e_insertar_iw(pgsql_config, pgsql_iw, panel_config, test, queryvl, params.exp_id)
         except Exception as exc:
-            print(f"Error ejecutando proceso SIAN: {exc}")
+            log.error("Error ejecutando proceso SIAN: %s", exc)
 
     background_tasks.add_task(lanzar_proceso)
 
@@ -288,7 +291,7 @@ def cargar_consulta(archivo):
                 retorno = str(retorno)
         return retorno
     except Exception as e:
-        print(f"Error al cargar consulta {archivo}: {e}")
+        log.error("Error al cargar consulta %s: %s", archivo, e)
         return None
 
 
@@ -309,7 +312,7 @@ def ejecutar_sqlix(query_sql):
         conn.close()
         return rows
     except Exception as e:
-        print(f"Error al ejecutar Informix: {e}")
+        log.error("Error al ejecutar Informix: %s", e)
         return []
 
 
@@ -324,7 +327,7 @@ def ejecutar_iw(pgsql_iw, queryvl):
         conn.close()
         return rows
     except Exception as e:
-        print(f"Error al ejecutar IW: {e}")
+        log.error("Error al ejecutar IW: %s", e)
         return []
 
 
@@ -414,10 +417,10 @@ def insertar_datos_enviocedula(conn, datos):
                 else:
                     return False
             except Exception as er:
-                print(er)
+                log.error("%s", er)
     except Exception as e:
         conn.rollback()
-        print(f"Error al insertar datos: {e}")
+        log.error("Error al insertar datos: %s", e)
         return False
     
 
@@ -442,10 +445,10 @@ def ejecutar_convertidor_pdf(pmovimientoid, pactuacionid, pdomicilioelectronicop
         if response.status_code == 200:
             return True
         else:
-            print(f"Error en conversión a PDF: {response.status_code}, {response.text}")
+            log.error("Error en conversión a PDF: %s, %s", response.status_code, response.text)
             return False
     except Exception as e:
-        print(f"Error al convertir a PDF: {e}")
+        log.error("Error al convertir a PDF: %s", e)
         return False
 
 
@@ -463,7 +466,7 @@ def ejecutar_envio_cedulas(pgsql_config, cantidad, urlsian, pmovimientoid, pactu
     try:
         pass
     except Exception as e:
-        print(f"Error al enviar cédulas: {e}")
+        log.error("Error al enviar cédulas: %s", e)
         return False
 
 
@@ -489,10 +492,10 @@ def ejecutarpaso(proceso, panel_config):
                 if datetime.now() > proxima:
                     ejecutarpaso = True
             except Exception:
-                print("Error en comparacion 1")
+                log.error("Error en comparacion 1")
                 ejecutarpaso = False
     except Exception as e:
-        print(f"Error en comparacion 2 {e}")
+        log.error("Error en comparacion 2 %s", e)
         ejecutarpaso = False
 
     return ejecutarpaso
@@ -514,7 +517,7 @@ def registrar_paso(proceso, codigo_proceso, panel_config):
             cursor.execute(query)
             connrp.commit()
     except Exception as e:
-        print(f"Error al registrar paso {e}")
+        log.error("Error al registrar paso %s", e)
 
 
 
@@ -599,23 +602,25 @@ def procesar_e_insertar(pgsql_config, panel_config, test, query_sql):
                         pactuacionid = datos_insertar['pactuacionid']
                         pdomicilioelectronicopj = datos_insertar['pdomicilioelectronicopj']
                         if ejecutar_convertidor_pdf(pmovimientoid, pactuacionid, pdomicilioelectronicopj, './static/apiconsumo/cnotpolicia', test):
-                            print(
-                                f"Registro ok - pmovimientoid: {pmovimientoid}, "
-                                f"pactuacionid: {pactuacionid}, "
-                                f"pdomicilioelectronicopj: {pdomicilioelectronicopj}"
+                            log.info(
+                                "Registro ok - pmovimientoid: %s, pactuacionid: %s, "
+                                "pdomicilioelectronicopj: %s",
+                                pmovimientoid,
+                                pactuacionid,
+                                pdomicilioelectronicopj,
                             )
             except Exception as e:
                 errores.append(f"Error al procesar fila {fila[0]}: {e}")
-                print(f"Error al procesar fila {fila[0]}: {e}")
+                log.error("Error al procesar fila %s: %s", fila[0], e)
 
         if actualizar:
             registrar_paso("paso1", 1, panel_config)
         conn.close()
         if errores:
             for error in errores:
-                print(error)
+                log.error("%s", error)
     except Exception as e:
-        print(f"Error general: {e}")
+        log.error("Error general: %s", e)
 
 
 def procesar_e_insertar_iw(pgsql_config, pgsql_iw, panel_config, test, queryvl, exp_id=None):
@@ -714,27 +719,29 @@ def procesar_e_insertar_iw(pgsql_config, pgsql_iw, panel_config, test, queryvl,
                                         grabarcedencedulasconqr(int(fila[0]), int(fila[2]), str(fila[22]).strip(), sgdocidc, pgsql_config)
                                         formularioqr = obtener_formulario_qr(int(fila[0]), int(fila[2]), str(fila[22]).strip(), sgdocid, pgsql_config, urlpj='https://appweb.justiciasalta.gov.ar:8091/policia/api/cnotpolicia/incrustarqrpdf')
                         else:
-                            print("No se pudo completar la solicitud.")
+                            log.error("No se pudo completar la solicitud.")
                         pmovimientoid = datos_insertar['pmovimientoid']
                         pactuacionid = datos_insertar['pactuacionid']
                         pdomicilioelectronicopj = datos_insertar['pdomicilioelectronicopj']
-                        print(
-                            f"Registro ok - pmovimientoid: {pmovimientoid}, "
-                            f"pactuacionid: {pactuacionid}, "
-                            f"pdomicilioelectronicopj: {pdomicilioelectronicopj}"
+                        log.info(
+                            "Registro ok - pmovimientoid: %s, pactuacionid: %s, "
+                            "pdomicilioelectronicopj: %s",
+                            pmovimientoid,
+                            pactuacionid,
+                            pdomicilioelectronicopj,
                         )
             except Exception as e:
                 errores.append(f"Error al procesar fila {fila[1]}: {e}")
-                print(f"Error al procesar fila {fila[1]}: {e}")
+                log.error("Error al procesar fila %s: %s", fila[1], e)
 
         if actualizar:
             registrar_paso("paso21", 21, panel_config)
         conn.close()
         if errores:
             for error in errores:
-                print(error)
+                log.error("%s", error)
     except Exception as e:
-        print(f"Error general: {e}")
+        log.error("Error general: %s", e)
 
 
 def insertar_documento(base64_data, nombre_archivo, numero_legajo, test=True):
@@ -758,7 +765,7 @@ def insertar_documento(base64_data, nombre_archivo, numero_legajo, test=True):
         response.raise_for_status()
         return response.json()
     except requests.exceptions.RequestException as e:
-        print(f"Error al llamar al webservice: {e}")
+        log.error("Error al llamar al webservice: %s", e)
         return None
 
 
@@ -779,7 +786,7 @@ def grabarcedencedulasconqr(pmovimientoid, pactuacionid, pdomicilioelectronicopj
             cursor.execute(query)
             connrp.commit()
     except Exception as e:
-        print(f"Error al registrar paso {e}")
+        log.error("Error al registrar paso %s", e)
 
 
 def grabarcedulasconqr(pmovimientoid, pactuacionid, pdomicilioelectronicopj, sgdocid, pgsql_config):
@@ -795,7 +802,7 @@ def grabarcedulasconqr(pmovimientoid, pactuacionid, pdomicilioelectronicopj, sgd
             cursor.execute(query)
             connrp.commit()
     except Exception as e:
-        print(f"Error al registrar paso {e}")
+        log.error("Error al registrar paso %s", e)
 
 
 def obtener_formulario_qr(pmovimientoid, pactuacionid, pdomicilioelectronicopj, sgdocid, pgsql_config, urlpj):
@@ -857,17 +864,17 @@ def obtener_formulario_qr(pmovimientoid, pactuacionid, pdomicilioelectronicopj,
                 connrp.commit()
 
             except Exception as e:
-                print(f"Error al crear Formulario QR: {e}")
+                log.error("Error al crear Formulario QR: %s", e)
 
         else:
             raise Exception(f"Error de conexión: Código HTTP {response.status_code}, Respuesta: {response.text}")
 
     except Exception as e:
-        print(f"Error al llamar al servicio web de envío de cédulas: {e}")
+        log.error("Error al llamar al servicio web de envío de cédulas: %s", e)
 
 
 def registrar_error(dbgusername, dbguservalor, dbguserprograma):
-    print(f"Registrar  Error")
+    log.debug("Registrar error")
     panel_test = {
             "host": "10.18.250.251",
             "port": "5432",
@@ -878,11 +885,11 @@ def registrar_error(dbgusername, dbguservalor, dbguserprograma):
     connpanel = psycopg2.connect(**panel_test)
     try:
         query=f"insert into dbguser (dbguservalor,dbguserprograma) values ('{dbguservalor}','{dbguserprograma}')"
-        print(f"Error {query}")
+        log.debug("Registrando error: %s", query)
         logserror = connpanel.cursor()
         logserror.execute(query)
     except requests.exceptions.RequestException as e:
-        print(f"Error al insertar error '{e}'")
+        log.error("Error al insertar error '%s'", e)
         return None
 
 
@@ -907,8 +914,7 @@ def ejecutar_control_cedulas(pgsql_config, pmovimientoid, pactuacionid, pdomicil
                             conexion.commit()
 
     except Exception as e:
-        print("tabla con errores")
-        print(f"Error: {e} / {registro[1]} ")
+        log.error("tabla con errores: %s / %s", e, registro[1])
 
     finally:
         if 'cursor' in locals():
@@ -0,0 +1,160 @@
+"""Micro-benchmark del parseo de fechas de estado.
+
+Compara :mod:`fechas` con las funciones que usaba ``historialsian`` antes de
+centralizar el parseo (copiadas abajo como referencia): cada estado pasaba por
+``_parsear_fecha_estado_bd`` al leer el XML y luego por
+``_normalizar_fecha_para_comparacion`` al filtrar y al armar la clave de
+deduplicación, que volvía a parsear el texto.
+
+El escenario simula un historial: ``--textos`` fechas distintas en los formatos
+que devuelve el MP, cada una consultada ``--repeticiones`` veces.
+
+Uso:
+    python benchmark_fechas.py --textos 5000 --repeticiones 3
+"""
+
+from __future__ import annotations
+
+import argparse
+from datetime import date, datetime, timedelta
+import random
+import time
+from typing import Callable, List, Optional, Sequence, Union
+
+import fechas
+
+
+def _parsear_fecha_anterior(fecha_estado: Optional[str]) -> Optional[datetime]:
+    if not fecha_estado:
+        return None
+
+    fecha = fecha_estado.strip()
+    if not fecha:
+        return None
+
+    fecha_normalizada = fecha.replace("Z", "+00:00")
+
+    formatos = [
+        "%Y-%m-%dT%H:%M:%S%z",
+        "%Y-%m-%dT%H:%M:%S.%f%z",
+        "%Y-%m-%dT%H:%M:%S",
+        "%Y-%m-%dT%H:%M:%S.%f",
+        "%Y-%m-%d %H:%M:%S",
+    ]
+
+    for formato in formatos:
+        try:
+            return datetime.strptime(fecha_normalizada, formato)
+        except ValueError:
+            continue
+
+    try:
+        return datetime.fromisoformat(fecha_normalizada)
+    except ValueError:
+        return None
+
+
+def _normalizar_fecha_anterior(
+    fecha: Optional[Union[datetime, date, str]]
+) -> Optional[datetime]:
+    if fecha is None:
+        return None
+
+    if isinstance(fecha, str):
+        fecha_texto = fecha.strip()
+        if not fecha_texto:
+            return None
+
+        fecha_parseada = _parsear_fecha_anterior(fecha_texto)
+        if fecha_parseada is None:
+            try:
+                fecha_parseada = datetime.fromisoformat(
+                    fecha_texto.replace("Z", "+00:00")
+                )
+            except ValueError:
+                return None
+        fecha = fecha_parseada
+
+    if isinstance(fecha, date) and not isinstance(fecha, datetime):
+        fecha = datetime.combine(fecha, datetime.min.time())
+
+    if fecha.tzinfo is not None:
+        return fecha.replace(tzinfo=None)
+
+    return fecha
+
+
+def generar_textos(cantidad: int, semilla: int = 42) -> List[str]:
+    """Fechas en la mezcla de formatos observada en ``HistorialEstados``."""
+
+    azar = random.Random(semilla)
+    inicio = datetime(2024, 1, 1)
+    formatos = (
+        "%Y-%m-%dT%H:%M:%S",
+        "%Y-%m-%dT%H:%M:%S.%f",
+        "%Y-%m-%d %H:%M:%S",
+        "%Y-%m-%dT%H:%M:%S-03:00",
+    )
+    textos = []
+    for _ in range(cantidad):
+        momento = inicio + timedelta(seconds=azar.randrange(365 * 86400))
+        textos.append(momento.strftime(azar.choice(formatos)))
+    return textos
+
+
+def _medir(funcion: Callable[[str], object], textos: Sequence[str], repeticiones: int) -> float:
+    inicio = time.perf_counter()
+    for _ in range(repeticiones):
+        for texto in textos:
+            funcion(texto)
+    return time.perf_counter() - inicio
+
+
+def _flujo_anterior(texto: str) -> object:
+    # Lectura del XML, filtro por fecha y clave de deduplicación.
+    _parsear_fecha_anterior(texto)
+    _normalizar_fecha_anterior(texto)
+    return _normalizar_fecha_anterior(texto)
+
+
+def _flujo_actual(texto: str) -> object:
+    fechas.parsear(texto)
+    fechas.normalizar(texto)
+    return fechas.normalizar(texto)
+
+
+def ejecutar(textos: int, repeticiones: int) -> List[str]:
+    muestras = generar_textos(textos)
+    for texto in muestras:
+        if fechas.normalizar(texto) != _normalizar_fecha_anterior(texto):
+            raise AssertionError(f"Resultado distinto para {texto!r}")
+
+    fechas._parsear_texto.cache_clear()
+    anterior = _medir(_flujo_anterior, muestras, repeticiones)
+    actual = _medir(_flujo_actual, muestras, repeticiones)
+    llamadas = textos * repeticiones * 3
+    return [
+        f"Fechas distintas: {textos}, llamadas por implementación: {llamadas}",
+        f"Anterior: {anterior:.3f} s ({llamadas / anterior:,.0f} llamadas/s)",
+        f"fechas.py: {actual:.3f} s ({llamadas / actual:,.0f} llamadas/s)",
+        f"Aceleración: x{anterior / actual:.1f}; caché: {fechas.estadisticas_cache()}",
+    ]
+
+
+def _parse_args(argv: Optional[Sequence[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Compara el parseo de fechas de fechas.py con la versión anterior."
+    )
+    parser.add_argument("--textos", type=int, default=5000)
+    parser.add_argument("--repeticiones", type=int, default=3)
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    args = _parse_args(argv)
+    for linea in ejecutar(args.textos, args.repeticiones):
+        print(linea)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,558 @@
+"""Benchmark de punta a punta de la sincronización de estados con el MP.
+
+Prepara en una base PostgreSQL de pruebas las tablas que usan los procesos
+(``enviocedulanotificacionpolicia``, ``notpolhistoricomp``, ``retornomp``,
+``procesosat``, ``ejecproc`` y las de las migraciones), carga una población
+sintética de envíos con una mezcla realista de estados y ejecuta contra
+``mp_simulado``:
+
+* ``procesar_envios`` (incluye la conciliación del historial en el proceso),
+* ``procesar_por_estado`` para el estado indicado.
+
+Por etapa informa códigos por segundo, latencia p50/p95 por código, idas a la
+base por código y el pico de memoria residente, y agrega el resultado a un
+historial JSONL para comparar contra la corrida anterior con los mismos
+parámetros.
+
+La base indicada en ``--dsn`` se vacía: nunca debe apuntar a las bases de
+producción.
+
+Uso:
+    python benchmark_sincronizacion.py --dsn "dbname=sian_bench user=postgres" --envios 2000
+    python benchmark_sincronizacion.py --dsn "..." --latencia-mediana 0.05 --probabilidad-rafaga-429 0.01
+"""
+
+from __future__ import annotations
+
+import argparse
+from contextlib import contextmanager, redirect_stdout
+from dataclasses import asdict, dataclass, field
+from datetime import datetime
+import io
+import json
+import os
+from pathlib import Path
+import resource
+import subprocess
+import tempfile
+import time
+from typing import Callable, Dict, Iterator, List, Optional, Sequence
+from unittest import mock
+
+import psycopg2
+from psycopg2 import extensions
+
+from historialsian import _log_step, panel_config, pgsql_config
+import migraciones
+import mp_simulado
+import retornoporestado
+import retornoxmlmp
+
+
+HISTORIAL_POR_DEFECTO = Path("benchmarks") / "historial.jsonl"
+BASES_PROTEGIDAS = ("iurixPj", "panelnotificacionesws")
+
+# Proporciones de ``laststagesian`` en la población sintética.
+MEZCLA_ESTADOS: Dict[str, float] = {
+    "": 0.05,
+    "Ingresada": 0.10,
+    "Pendiente": 0.15,
+    "Enviada": 0.15,
+    "En Dep. Policial": 0.15,
+    "En Notificaciones": 0.15,
+    "Entregada": 0.10,
+    "No entregada": 0.05,
+    "Finalizada": 0.10,
+}
+
+_SENTENCIAS_ESQUEMA = (
+    """
+    DROP TABLE IF EXISTS enviocedulanotificacionpolicia, notpolhistoricomp,
+        retornomp, procesosat, ejecproc, puntocontrolretorno, limitesoapmp,
+        archivomp, permanenciaestado, permanenciamarca, permanenciacodigo,
+        notpol_ultimo_estado CASCADE
+    """,
+    "DROP SEQUENCE IF EXISTS procesosatid, ejecprocid",
+    """
+    CREATE TABLE enviocedulanotificacionpolicia (
+        pmovimientoid numeric NOT NULL,
+        pactuacionid numeric NOT NULL,
+        pdomicilioelectronicopj varchar(200) NOT NULL,
+        penviocedulanotificacionfechahora timestamp,
+        penviocedulanotificacionexito boolean DEFAULT FALSE,
+        codigoseguimientomp varchar(100),
+        laststagesian varchar(100),
+        fechalaststate timestamp,
+        finsian boolean DEFAULT FALSE,
+        descartada boolean DEFAULT FALSE,
+        fenviadaiw boolean DEFAULT FALSE,
+        feiw varchar(2) DEFAULT 'NO',
+        ecedarchivoseguimientoid numeric,
+        ecedarchivoseguimientonombre varchar(400),
+        ecedarchivoseguimientodatos text,
+        ecedarchivosegnotid numeric,
+        PRIMARY KEY (pmovimientoid, pactuacionid, pdomicilioelectronicopj)
+    )
+    """,
+    """
+    CREATE TABLE notpolhistoricomp (
+        notpolhistoricompid bigserial PRIMARY KEY,
+        pmovimientoid numeric,
+        pactuacionid numeric,
+        pdomicilioelectronicopj varchar(200),
+        codigoseguimientomp varchar(100),
+        notpolhistoricompestadonid numeric,
+        notpolhistoricompfecha varchar(40),
+        notpolhistoricompestado varchar(100),
+        notpolhistoricompobservaciones text,
+        notpolhistoricompmotivo text,
+        notpolhistoricompresponsable text,
+        notpolhistoricompdependencia text,
+        notpolhistoricomparchivoid numeric,
+        notpolhistoricomparchivonombre varchar(400),
+        notpolhistoricomparchcont text,
+        UNIQUE (
+            pmovimientoid,
+            pactuacionid,
+            pdomicilioelectronicopj,
+            notpolhistoricompestadonid
+        )
+    )
+    """,
+    """
+    CREATE TABLE retornomp (
+        pmovimientoid numeric NOT NULL,
+        pactuacionid numeric NOT NULL,
+        pdomicilioelectronicopj varchar(200) NOT NULL,
+        contenido_xml text,
+        procesado boolean DEFAULT FALSE,
+        fechaproceso timestamp,
+        ultactualizacion timestamp
+    )
+    """,
+)
+
+_SENTENCIA_POBLACION = """
+    INSERT INTO enviocedulanotificacionpolicia (
+        pmovimientoid,
+        pactuacionid,
+        pdomicilioelectronicopj,
+        penviocedulanotificacionfechahora,
+        codigoseguimientomp,
+        laststagesian,
+        fechalaststate
+    )
+    SELECT i,
+           i * 10,
+           'dom' || i || '@bench.test',
+           fecha - interval '2 days',
+           'SIM' || lpad(i::text, 8, '0'),
+           NULLIF(estados.estado, ''),
+           fecha
+    FROM (
+        SELECT i,
+               random() AS sorteo,
+               now() - random() * interval '9 days' - interval '1 day' AS fecha
+        FROM generate_series(1, %(envios)s) AS i
+    ) AS poblacion
+    JOIN LATERAL (
+        SELECT estado
+        FROM unnest(%(estados)s::text[], %(acumulados)s::float8[]) AS mezcla (estado, hasta)
+        WHERE poblacion.sorteo < mezcla.hasta
+        ORDER BY mezcla.hasta
+        LIMIT 1
+    ) AS estados ON TRUE
+"""
+
+
+# --- Medición -----------------------------------------------------------------
+
+
+@dataclass
+class MedicionEtapa:
+    """Acumula tiempos por código e idas a la base de una etapa."""
+
+    nombre: str
+    latencias: List[float] = field(default_factory=list)
+    idas_bd: int = 0
+    conexiones: int = 0
+    segundos: float = 0.0
+    rss_pico_mib: float = 0.0
+
+
+def _percentil(valores: Sequence[float], cuantil: float) -> float:
+    if not valores:
+        return 0.0
+    ordenados = sorted(valores)
+    posicion = cuantil * (len(ordenados) - 1)
+    inferior = int(posicion)
+    superior = min(inferior + 1, len(ordenados) - 1)
+    return ordenados[inferior] + (ordenados[superior] - ordenados[inferior]) * (posicion - inferior)
+
+
+def resumir_etapa(medicion: MedicionEtapa) -> Dict[str, float]:
+    codigos = len(medicion.latencias)
+    return {
+        "codigos": codigos,
+        "segundos": round(medicion.segundos, 3),
+        "codigos_por_segundo": round(codigos / medicion.segundos, 3) if medicion.segundos else 0.0,
+        "latencia_p50_ms": round(_percentil(medicion.latencias, 0.50) * 1000, 2),
+        "latencia_p95_ms": round(_percentil(medicion.latencias, 0.95) * 1000, 2),
+        "idas_bd": medicion.idas_bd,
+        "idas_bd_por_codigo": round(medicion.idas_bd / codigos, 2) if codigos else 0.0,
+        "conexiones": medicion.conexiones,
+        "rss_pico_mib": round(medicion.rss_pico_mib, 1),
+    }
+
+
+def _rss_pico_mib() -> float:
+    # En Linux ``ru_maxrss`` se informa en KiB.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class _Medidor:
+    def __init__(self) -> None:
+        self.etapa: Optional[MedicionEtapa] = None
+        self._clases: Dict[type, type] = {}
+
+    def contar_ida(self) -> None:
+        if self.etapa is not None:
+            self.etapa.idas_bd += 1
+
+    def cursor_medido(self, base: type) -> type:
+        """Subclase de ``base`` que cuenta cada ``execute`` como una ida."""
+
+        clase = self._clases.get(base)
+        if clase is None:
+            medidor = self
+
+            def execute(cursor, *args, **kwargs):
+                medidor.contar_ida()
+                return base.execute(cursor, *args, **kwargs)
+
+            def executemany(cursor, consulta, parametros):
+                parametros = list(parametros)
+                if medidor.etapa is not None:
+                    medidor.etapa.idas_bd += len(parametros)
+                return base.executemany(cursor, consulta, parametros)
+
+            clase = type(
+                f"{base.__name__}Medido",
+                (base,),
+                {"execute": execute, "executemany": executemany},
+            )
+            self._clases[base] = clase
+        return clase
+
+    def conexion_medida(self) -> type:
+        medidor = self
+
+        class ConexionMedida(extensions.connection):
+            def cursor(self, *args, **kwargs):
+                base = kwargs.get("cursor_factory") or self.cursor_factory or extensions.cursor
+                kwargs["cursor_factory"] = medidor.cursor_medido(base)
+                return super().cursor(*args, **kwargs)
+
+            def commit(self):
+                medidor.contar_ida()
+                return super().commit()
+
+            def rollback(self):
+                medidor.contar_ida()
+                return super().rollback()
+
+        return ConexionMedida
+
+    @contextmanager
+    def medir(self, nombre: str) -> Iterator[MedicionEtapa]:
+        self.etapa = MedicionEtapa(nombre)
+        inicio = time.perf_counter()
+        try:
+            yield self.etapa
+        finally:
+            self.etapa.segundos = time.perf_counter() - inicio
+            self.etapa.rss_pico_mib = _rss_pico_mib()
+            self.etapa = None
+
+
+@contextmanager
+def _instrumentar(medidor: _Medidor) -> Iterator[None]:
+    """Intercepta conexiones y las funciones por código de cada etapa."""
+
+    conectar_original = psycopg2.connect
+    invocar_original = retornoxmlmp._invocar_servicio
+    completado_original = retornoxmlmp._EscrituraDiferida.envio_completado
+    notificacion_original = retornoporestado._procesar_notificacion
+    conexion_medida = medidor.conexion_medida()
+    inicio_codigo: List[Optional[float]] = [None]
+
+    def conectar(*args, **kwargs):
+        if medidor.etapa is not None:
+            medidor.etapa.conexiones += 1
+        kwargs.setdefault("connection_factory", conexion_medida)
+        return conectar_original(*args, **kwargs)
+
+    def invocar(*args, **kwargs):
+        inicio_codigo[0] = time.perf_counter()
+        return invocar_original(*args, **kwargs)
+
+    def envio_completado(escritura):
+        # La latencia de un código va desde la consulta SOAP hasta que queda
+        # encolado para escritura (incluye parseo y descarga de archivos).
+        if inicio_codigo[0] is not None and medidor.etapa is not None:
+            medidor.etapa.latencias.append(time.perf_counter() - inicio_codigo[0])
+            inicio_codigo[0] = None
+        return completado_original(escritura)
+
+    def procesar_notificacion(*args, **kwargs):
+        inicio = time.perf_counter()
+        try:
+            return notificacion_original(*args, **kwargs)
+        finally:
+            if medidor.etapa is not None:
+                medidor.etapa.latencias.append(time.perf_counter() - inicio)
+
+    with mock.patch.object(psycopg2, "connect", conectar), mock.patch.object(
+        retornoxmlmp, "_invocar_servicio", invocar
+    ), mock.patch.object(
+        retornoxmlmp._EscrituraDiferida, "envio_completado", envio_completado
+    ), mock.patch.object(
+        retornoporestado, "_procesar_notificacion", procesar_notificacion
+    ):
+        yield
+
+
+# --- Preparación de la base ---------------------------------------------------
+
+
+def configurar_base(dsn: str) -> None:
+    """Apunta ``pgsql_config`` y ``panel_config`` a la base de benchmark."""
+
+    parametros = extensions.parse_dsn(dsn)
+    base = parametros.get("dbname") or parametros.get("database")
+    if not base or base in BASES_PROTEGIDAS:
+        raise ValueError(
+            f"La base '{base}' no es válida para el benchmark: se vacía al prepararla"
+        )
+    for configuracion in (pgsql_config, panel_config):
+        configuracion.clear()
+        configuracion.update(parametros)
+
+
+def preparar_base(envios: int, semilla: float) -> None:
+    """Recrea el esquema y carga ``envios`` envíos sintéticos."""
+
+    estados = list(MEZCLA_ESTADOS)
+    acumulados: List[float] = []
+    total = 0.0
+    for proporcion in MEZCLA_ESTADOS.values():
+        total += proporcion
+        acumulados.append(total)
+    acumulados[-1] = 1.0
+
+    with psycopg2.connect(**pgsql_config) as conexion:
+        with conexion.cursor() as cursor:
+            for sentencia in _SENTENCIAS_ESQUEMA:
+                cursor.execute(sentencia)
+        conexion.commit()
+        # Ambas configuraciones apuntan a la misma base, así que se aplican
+        # todas las migraciones sobre la misma conexión.
+        for migracion in migraciones.MIGRACIONES:
+            migraciones.aplicar_migracion(conexion, migracion)
+        with conexion.cursor() as cursor:
+            cursor.execute("SELECT setseed(%s)", (semilla,))
+            cursor.execute(
+                _SENTENCIA_POBLACION,
+                {"envios": envios, "estados": estados, "acumulados": acumulados},
+            )
+            cursor.execute("ANALYZE enviocedulanotificacionpolicia")
+        conexion.commit()
+    _log_step("preparar_base", "OK", "Población sintética cargada: %s envíos", envios)
+
+
+# --- Historial de corridas ----------------------------------------------------
+
+
+def _commit_actual() -> Optional[str]:
+    try:
+        salida = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=Path(__file__).resolve().parent,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return salida.stdout.strip() or None
+
+
+def cargar_corrida_anterior(
+    ruta: Path, parametros: Dict[str, object]
+) -> Optional[Dict[str, object]]:
+    """Última corrida del historial con los mismos parámetros."""
+
+    if not ruta.exists():
+        return None
+    anterior = None
+    with ruta.open(encoding="utf-8") as archivo:
+        for linea in archivo:
+            linea = linea.strip()
+            if not linea:
+                continue
+            corrida = json.loads(linea)
+            if corrida.get("parametros") == parametros:
+                anterior = corrida
+    return anterior
+
+
+def comparar_corridas(
+    actual: Dict[str, Dict[str, float]], anterior: Dict[str, Dict[str, float]]
+) -> List[str]:
+    """Variación porcentual de las métricas principales por etapa."""
+
+    lineas = []
+    for etapa, metricas in actual.items():
+        previas = anterior.get(etapa)
+        if not previas:
+            continue
+        for metrica in (
+            "codigos_por_segundo",
+            "latencia_p95_ms",
+            "idas_bd_por_codigo",
+            "rss_pico_mib",
+        ):
+            antes, ahora = previas.get(metrica), metricas.get(metrica)
+            if not antes or ahora is None:
+                continue
+            variacion = (ahora - antes) / antes * 100
+            lineas.append(f"{etapa}.{metrica}: {antes} -> {ahora} ({variacion:+.1f}%)")
+    return lineas
+
+
+def registrar_corrida(
+    ruta: Path, parametros: Dict[str, object], etapas: Dict[str, Dict[str, float]]
+) -> Optional[Dict[str, object]]:
+    """Agrega la corrida al historial y devuelve la anterior comparable."""
+
+    anterior = cargar_corrida_anterior(ruta, parametros)
+    ruta.parent.mkdir(parents=True, exist_ok=True)
+    with ruta.open("a", encoding="utf-8") as archivo:
+        archivo.write(
+            json.dumps(
+                {
+                    "fecha": datetime.now().isoformat(timespec="seconds"),
+                    "commit": _commit_actual(),
+                    "parametros": parametros,
+                    "etapas": etapas,
+                },
+                ensure_ascii=False,
+            )
+            + "\n"
+        )
+    return anterior
+
+
+# --- Ejecución ----------------------------------------------------------------
+
+
+def ejecutar_benchmark(
+    envios: int,
+    estado_por_estado: str,
+    dias: int,
+    configuracion: mp_simulado.ConfiguracionSimulador,
+    semilla: float = 0.42,
+) -> Dict[str, Dict[str, float]]:
+    """Prepara la base, levanta el simulador y mide cada etapa."""
+
+    preparar_base(envios, semilla)
+    servidor, _servicio, url = mp_simulado.iniciar_en_segundo_plano(configuracion)
+    medidor = _Medidor()
+    etapas: Dict[str, Callable[[], None]] = {
+        "procesar_envios": lambda: retornoxmlmp.procesar_envios(usar_test=True, dias=dias),
+        "procesar_por_estado": lambda: retornoporestado.procesar_por_estado(
+            estado_por_estado, usar_test=True
+        ),
+    }
+    resultados: Dict[str, Dict[str, float]] = {}
+    directorio_original = os.getcwd()
+    try:
+        with mock.patch.dict(os.environ, {"MP_SOAP_HOST": url}), mock.patch.object(
+            retornoxmlmp, "MIN_INTERVALO_SOAP_SEGUNDOS", 0
+        ), _instrumentar(medidor), tempfile.TemporaryDirectory() as directorio:
+            # Los procesos escriben archivos de códigos actualizados en el
+            # directorio de trabajo.
+            os.chdir(directorio)
+            for nombre, etapa in etapas.items():
+                with medidor.medir(nombre) as medicion, redirect_stdout(io.StringIO()):
+                    etapa()
+                resultados[nombre] = resumir_etapa(medicion)
+    finally:
+        os.chdir(directorio_original)
+        servidor.shutdown()
+        servidor.server_close()
+    return resultados
+
+
+def _parse_args(argv: Optional[Sequence[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Benchmark de la sincronización de estados contra mp_simulado."
+    )
+    parser.add_argument(
+        "--dsn",
+        default=os.environ.get("BENCH_PG_DSN"),
+        help="Cadena de conexión libpq a una base de pruebas (se vacía)",
+    )
+    parser.add_argument("--envios", type=int, default=1000)
+    parser.add_argument("--dias", type=int, default=10)
+    parser.add_argument("--estado", default="Entregada", help="Estado para procesar_por_estado")
+    parser.add_argument("--semilla", type=float, default=0.42)
+    parser.add_argument("--latencia-mediana", type=float, default=0.0)
+    parser.add_argument("--latencia-p95", type=float, default=0.0)
+    parser.add_argument("--probabilidad-rafaga-429", type=float, default=0.0)
+    parser.add_argument("--probabilidad-5xx", type=float, default=0.0)
+    parser.add_argument("--tamano-archivo", type=int, default=64 * 1024)
+    parser.add_argument("--historial", type=Path, default=HISTORIAL_POR_DEFECTO)
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    args = _parse_args(argv)
+    if not args.dsn:
+        raise SystemExit("Indique --dsn o BENCH_PG_DSN con una base de pruebas")
+    configurar_base(args.dsn)
+
+    configuracion = mp_simulado.ConfiguracionSimulador(
+        latencia_mediana=args.latencia_mediana,
+        latencia_p95=args.latencia_p95,
+        probabilidad_rafaga_429=args.probabilidad_rafaga_429,
+        probabilidad_5xx=args.probabilidad_5xx,
+        tamano_archivo=args.tamano_archivo,
+    )
+    parametros = {
+        "envios": args.envios,
+        "dias": args.dias,
+        "estado": args.estado,
+        "semilla": args.semilla,
+        "simulador": asdict(configuracion),
+    }
+    etapas = ejecutar_benchmark(
+        args.envios, args.estado, args.dias, configuracion, semilla=args.semilla
+    )
+
+    for nombre, metricas in etapas.items():
+        print(f"[{nombre}]")
+        for metrica, valor in metricas.items():
+            print(f"  {metrica}: {valor}")
+
+    anterior = registrar_corrida(args.historial, parametros, etapas)
+    if anterior is None:
+        print(f"Primera corrida con estos parámetros en {args.historial}")
+    else:
+        print(f"Comparación con la corrida {anterior.get('fecha')} ({anterior.get('commit')}):")
+        for linea in comparar_corridas(etapas, anterior.get("etapas", {})):
+            print(f"  {linea}")
+
+
+if __name__ == "__main__":
+    main()
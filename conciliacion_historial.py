@@ -0,0 +1,483 @@
+"""Conciliación por lotes de los XML pendientes de ``retornomp``.
+
+Recorre con un cursor del lado del servidor las filas de ``retornomp`` con
+``procesado = FALSE`` y, por cada lote:
+
+1. resuelve en IURIX el código de seguimiento de cada envío;
+2. parsea los XML en un pool de procesos, que devuelve tuplas compactas y
+   trabaja un lote por delante del único escritor;
+3. compara los estados con los ya registrados en ``notpolhistoricomp`` con
+   una sola consulta;
+4. inserta los estados nuevos y actualiza el último estado de los envíos con
+   sentencias por conjunto, confirma y recién entonces marca los retornos
+   como procesados.
+
+El resultado equivale a ``historialsian.llamar_his_mp`` por cada retorno, con
+una cantidad fija de idas a la base por lote en lugar de varias por código.
+
+Uso:
+    python conciliacion_historial.py --lote 500 --procesos 4
+"""
+
+from __future__ import annotations
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime
+import os
+import time
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import psycopg2
+from psycopg2 import extras
+
+import fechas
+import historialsian
+from historialsian import SUMMARY, _log_step, panel_config, pgsql_config
+import respuesta_estado
+
+
+LOTE_POR_DEFECTO = 500
+
+_SENTENCIA_RETORNOS_PENDIENTES = """
+    SELECT pmovimientoid,
+           pactuacionid,
+           pdomicilioelectronicopj,
+           contenido_xml,
+           contenido_digest
+    FROM retornomp
+    WHERE procesado = FALSE
+"""
+
+_SENTENCIA_CODIGOS_ENVIOS = """
+    SELECT e.pmovimientoid,
+           e.pactuacionid,
+           e.pdomicilioelectronicopj,
+           e.codigoseguimientompnorm
+    FROM enviocedulanotificacionpolicia AS e
+    JOIN (VALUES %s) AS d (pmovimientoid, pactuacionid, pdomicilioelectronicopj)
+      ON e.pmovimientoid = d.pmovimientoid
+     AND e.pactuacionid = d.pactuacionid
+     AND e.pdomicilioelectronicopj = d.pdomicilioelectronicopj
+    WHERE e.codigoseguimientompnorm <> ''
+"""
+
+# Orden de los campos de cada estado en las tuplas que devuelven los procesos.
+_CAMPOS_ESTADO = (
+    "estado_id",
+    "fecha",
+    "fecha_raw",
+    "estado",
+    "observaciones",
+    "motivo",
+    "responsable",
+    "dependencia",
+    "archivo_id",
+    "archivo_nombre",
+)
+
+ClaveEnvio = Tuple[Any, Any, str]
+ClaveHistorial = Tuple[Any, Any, str, str]
+
+
+@dataclass(frozen=True)
+class RetornoLeido:
+    """Fila pendiente de ``retornomp``."""
+
+    pmovimientoid: Any
+    pactuacionid: Any
+    pdomicilioelectronicopj: str
+    contenido_xml: Optional[str]
+    contenido_digest: Optional[str]
+
+    @property
+    def clave(self) -> ClaveEnvio:
+        return self.pmovimientoid, self.pactuacionid, self.pdomicilioelectronicopj
+
+
+@dataclass(frozen=True)
+class EstadosParseados:
+    """Resultado compacto (serializable entre procesos) de un XML."""
+
+    xml_valido: bool
+    estados: Tuple[Tuple[Any, ...], ...]
+    ultimo: Optional[Tuple[Any, ...]]
+
+
+@dataclass
+class PlanLote:
+    """Sentencias por conjunto que concilian un lote."""
+
+    filas_notpol: List[Tuple[Any, ...]]
+    estados_xml: List[Tuple[str, str, Optional[datetime], bool]]
+    claves_historial: List[ClaveHistorial]
+    procesados: List[Tuple[Any, Any, str, Optional[str]]]
+    sin_envio: int = 0
+
+
+@dataclass(frozen=True)
+class ResultadoConciliacion:
+    retornos: int
+    conciliados: int
+    estados_insertados: int
+    sin_envio: int
+    lotes_fallidos: int
+    segundos: float
+
+
+def _extraer_estados(xml: Optional[str]) -> EstadosParseados:
+    """Parsea un XML; se ejecuta en los procesos del pool."""
+
+    respuesta = respuesta_estado.parsear_respuesta_estado(xml)
+    if not respuesta.xml_valido:
+        return EstadosParseados(False, (), None)
+
+    def como_tupla(estado) -> Tuple[Any, ...]:
+        return tuple(getattr(estado, campo) for campo in _CAMPOS_ESTADO)
+
+    ultimo = respuesta.ultimo_estado
+    return EstadosParseados(
+        True,
+        tuple(como_tupla(estado) for estado in respuesta.estados),
+        como_tupla(ultimo) if ultimo is not None else None,
+    )
+
+
+def _encargar_parseo(
+    pool: Optional[ProcessPoolExecutor], retornos: Sequence[RetornoLeido]
+) -> Iterable[EstadosParseados]:
+    """Envía los XML del lote al pool y devuelve sus resultados en orden.
+
+    Con pool, las tareas quedan encoladas al volver y los resultados se
+    esperan recién al recorrer el iterable; sin pool se parsea en el acto.
+    """
+
+    xmls = [retorno.contenido_xml for retorno in retornos]
+    if pool is None:
+        return [_extraer_estados(xml) for xml in xmls]
+    procesos = getattr(pool, "_max_workers", 1) or 1
+    return pool.map(
+        _extraer_estados, xmls, chunksize=max(1, len(xmls) // (procesos * 4))
+    )
+
+
+def _parsear_por_adelantado(
+    pool: Optional[ProcessPoolExecutor], lotes: Iterable[List[RetornoLeido]]
+) -> Iterator[Tuple[List[RetornoLeido], Iterable[EstadosParseados]]]:
+    """Encarga el parseo de cada lote antes de entregar el anterior.
+
+    Así el pool parsea el lote siguiente mientras el único escritor aplica el
+    actual. Los lotes se entregan en el orden de lectura, de modo que las
+    escrituras (y el último estado de un código repetido) siguen ese orden.
+    """
+
+    anterior = None
+    for retornos in lotes:
+        encargado = (retornos, _encargar_parseo(pool, retornos))
+        if anterior is not None:
+            yield anterior
+        anterior = encargado
+    if anterior is not None:
+        yield anterior
+
+
+def _obtener_codigos(
+    cursor: psycopg2.extensions.cursor, retornos: Sequence[RetornoLeido]
+) -> Dict[ClaveEnvio, Tuple[ClaveEnvio, str]]:
+    """Clave del retorno -> (clave del envío en IURIX, código normalizado)."""
+
+    filas = extras.execute_values(
+        cursor,
+        _SENTENCIA_CODIGOS_ENVIOS,
+        [retorno.clave for retorno in retornos],
+        page_size=len(retornos),
+        fetch=True,
+    )
+    codigos: Dict[ClaveEnvio, Tuple[ClaveEnvio, str]] = {}
+    for pmovimientoid, pactuacionid, pdomicilioelectronicopj, codigo in filas:
+        clave = (pmovimientoid, pactuacionid, pdomicilioelectronicopj)
+        codigos[clave] = (clave, codigo)
+    return codigos
+
+
+def _planificar_lote(
+    retornos: Sequence[RetornoLeido],
+    codigos: Dict[ClaveEnvio, Tuple[ClaveEnvio, str]],
+    parseados: Sequence[EstadosParseados],
+    existentes: Dict[ClaveHistorial, set],
+) -> PlanLote:
+    """Calcula, sin acceder a la base, las filas a insertar y actualizar.
+
+    Aplica las mismas reglas que ``llamar_his_mp``: solo se registran los
+    estados con fecha igual o posterior a la última del código y que no
+    existan ya; si el XML es inválido o no tiene estados, el envío pasa a
+    ``Sin info``.
+    """
+
+    plan = PlanLote([], [], [], [])
+    fecha_maxima: Dict[str, Optional[datetime]] = {}
+    for (_, _, _, codigo), claves in existentes.items():
+        registradas = [clave[1] for clave in claves if clave[1] is not None]
+        if registradas:
+            actual = fecha_maxima.get(codigo)
+            fecha_maxima[codigo] = max(registradas + ([actual] if actual else []))
+
+    for retorno, parseado in zip(retornos, parseados):
+        envio = codigos.get(retorno.clave)
+        if envio is None:
+            plan.sin_envio += 1
+            continue
+        (pmovimientoid, pactuacionid, pdomicilioelectronicopj), codigo = envio
+        clave_historial = (pmovimientoid, pactuacionid, pdomicilioelectronicopj, codigo)
+
+        if parseado.ultimo is None:
+            plan.estados_xml.append((codigo, "Sin info", None, False))
+        else:
+            estados = [dict(zip(_CAMPOS_ESTADO, estado)) for estado in parseado.estados]
+            plan.filas_notpol.extend(
+                historialsian._filas_estados_nuevos(
+                    historialsian._filtrar_estados_nuevos(
+                        estados, fecha_maxima.get(codigo)
+                    ),
+                    existentes.setdefault(clave_historial, set()),
+                    pmovimientoid,
+                    pactuacionid,
+                    pdomicilioelectronicopj,
+                    codigo,
+                )
+            )
+            ultimo = dict(zip(_CAMPOS_ESTADO, parseado.ultimo))
+            estado_texto = (ultimo["estado"] or "").strip() or "Sin info"
+            plan.estados_xml.append(
+                (
+                    codigo,
+                    estado_texto,
+                    fechas.normalizar(
+                        ultimo["fecha"] or ultimo["fecha_raw"]
+                    ),
+                    historialsian._estado_finalizado(estado_texto),
+                )
+            )
+
+        plan.claves_historial.append(clave_historial)
+        plan.procesados.append(retorno.clave + (retorno.contenido_digest,))
+
+    return plan
+
+
+def _aplicar_plan(
+    conexion_pg: psycopg2.extensions.connection,
+    conexion_panel: psycopg2.extensions.connection,
+    plan: PlanLote,
+) -> int:
+    """Escribe el plan en IURIX, confirma y marca los retornos en el panel."""
+
+    with conexion_pg.cursor() as cursor:
+        insertados = historialsian._insertar_filas_notpol(cursor, plan.filas_notpol)
+        if insertados:
+            historialsian._actualizar_ultimo_estado_codigos(
+                cursor, [fila[13] for fila in plan.filas_notpol]
+            )
+        historialsian._actualizar_envios_por_codigo_lote(cursor, plan.estados_xml)
+        historialsian._actualizar_envios_con_ultimo_estado_lote(
+            cursor, plan.claves_historial
+        )
+    conexion_pg.commit()
+
+    historialsian._marcar_retornomp_procesados(conexion_panel, plan.procesados)
+
+    if insertados:
+        SUMMARY.add("notpolhistoricomp", "agregados", insertados)
+    return insertados
+
+
+def _conciliar_lote(
+    conexion_pg: psycopg2.extensions.connection,
+    conexion_panel: psycopg2.extensions.connection,
+    retornos: Sequence[RetornoLeido],
+    parseados: Iterable[EstadosParseados],
+) -> Tuple[int, int, int]:
+    """Concilia un lote; devuelve ``(conciliados, insertados, sin_envio)``."""
+
+    with SUMMARY.medir("esperar_parseo", items=len(retornos)):
+        parseados = list(parseados)
+    with SUMMARY.medir("leer_iurix", items=len(retornos)), conexion_pg.cursor() as cursor:
+        codigos = _obtener_codigos(cursor, retornos)
+        existentes = historialsian._obtener_claves_estados_existentes_lote(
+            cursor, [clave + (codigo,) for clave, codigo in codigos.values()]
+        )
+    plan = _planificar_lote(retornos, codigos, parseados, existentes)
+    with SUMMARY.medir("aplicar_plan", items=len(retornos)):
+        insertados = _aplicar_plan(conexion_pg, conexion_panel, plan)
+    return len(plan.procesados), insertados, plan.sin_envio
+
+
+def _leer_pendientes(
+    conexion_lectura: psycopg2.extensions.connection, lote: int
+) -> Iterable[List[RetornoLeido]]:
+    """Recorre ``retornomp`` con un cursor con nombre, de a ``lote`` filas."""
+
+    with conexion_lectura.cursor(name="retornomp_pendientes") as cursor:
+        cursor.itersize = lote
+        cursor.execute(_SENTENCIA_RETORNOS_PENDIENTES)
+        while True:
+            filas = cursor.fetchmany(lote)
+            if not filas:
+                return
+            yield [RetornoLeido(*fila) for fila in filas]
+
+
+def _limitar(
+    lotes: Iterable[List[RetornoLeido]], limite: Optional[int]
+) -> Iterator[List[RetornoLeido]]:
+    restantes = limite
+    for retornos in lotes:
+        if restantes is not None:
+            retornos = retornos[: max(0, restantes)]
+            if not retornos:
+                return
+            restantes -= len(retornos)
+        yield retornos
+
+
+@SUMMARY.cronometrar()
+def conciliar_pendientes(
+    lote: int = LOTE_POR_DEFECTO,
+    procesos: Optional[int] = None,
+    limite: Optional[int] = None,
+) -> ResultadoConciliacion:
+    """Concilia todos los retornos con ``procesado = FALSE``.
+
+    ``procesos`` fija el tamaño del pool de parseo (por defecto, la cantidad
+    de CPU; con 1 se parsea en el proceso actual). El pool parsea el lote
+    siguiente mientras este proceso, único escritor, aplica el actual. ``limite`` corta la
+    ejecución después de esa cantidad de retornos. Un lote que falla se
+    revierte y sus retornos quedan pendientes para la próxima ejecución.
+    """
+
+    procesos = procesos or os.cpu_count() or 1
+    inicio = time.perf_counter()
+    retornos_leidos = conciliados = insertados = sin_envio = lotes_fallidos = 0
+
+    _log_step(
+        "conciliar_pendientes",
+        "INICIO",
+        "Conciliando retornomp pendientes (lote=%s, procesos=%s)",
+        lote,
+        procesos,
+    )
+
+    pool = ProcessPoolExecutor(max_workers=procesos) if procesos > 1 else None
+    try:
+        with historialsian.conectar(panel_config) as conexion_lectura, historialsian.conectar(
+            panel_config
+        ) as conexion_panel, historialsian.conectar(pgsql_config) as conexion_pg:
+            lotes = _parsear_por_adelantado(
+                pool, _limitar(_leer_pendientes(conexion_lectura, lote), limite)
+            )
+            for retornos, parseados in lotes:
+                retornos_leidos += len(retornos)
+                try:
+                    resultado = _conciliar_lote(
+                        conexion_pg, conexion_panel, retornos, parseados
+                    )
+                except psycopg2.Error as exc:
+                    conexion_pg.rollback()
+                    conexion_panel.rollback()
+                    lotes_fallidos += 1
+                    _log_step(
+                        "conciliar_pendientes",
+                        "ERROR",
+                        "Lote de %s retornos revertido: %s",
+                        len(retornos),
+                        exc,
+                    )
+                    continue
+                conciliados += resultado[0]
+                insertados += resultado[1]
+                sin_envio += resultado[2]
+                _log_step(
+                    "conciliar_pendientes",
+                    "OK",
+                    "Retornos conciliados: %s de %s leídos",
+                    conciliados,
+                    retornos_leidos,
+                )
+            conexion_lectura.rollback()
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+    if sin_envio:
+        _log_step(
+            "conciliar_pendientes",
+            "ADVERTENCIA",
+            "Retornos sin envío con código en IURIX (quedan pendientes): %s",
+            sin_envio,
+        )
+    resultado = ResultadoConciliacion(
+        retornos=retornos_leidos,
+        conciliados=conciliados,
+        estados_insertados=insertados,
+        sin_envio=sin_envio,
+        lotes_fallidos=lotes_fallidos,
+        segundos=time.perf_counter() - inicio,
+    )
+    _log_step(
+        "conciliar_pendientes",
+        "OK",
+        "Conciliación terminada: %s",
+        resultado,
+    )
+    return resultado
+
+
+def _parse_args(argv: Optional[Sequence[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description=(
+            "Concilia por lotes el historial de los retornomp pendientes "
+            "(procesado = FALSE)."
+        )
+    )
+    parser.add_argument(
+        "--lote",
+        type=int,
+        default=LOTE_POR_DEFECTO,
+        help="Retornos por lote (una transacción por lote).",
+    )
+    parser.add_argument(
+        "--procesos",
+        type=int,
+        default=None,
+        help="Procesos para parsear XML (por defecto, la cantidad de CPU).",
+    )
+    parser.add_argument(
+        "--limite",
+        type=int,
+        default=None,
+        help="Cantidad máxima de retornos a conciliar.",
+    )
+    parser.add_argument(
+        "--reporte-json",
+        help="Guarda el resumen (conteos, tiempos por paso e idas a la base) en este archivo JSON.",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    args = _parse_args(argv)
+    resultado = conciliar_pendientes(
+        lote=args.lote, procesos=args.procesos, limite=args.limite
+    )
+    print(
+        f"Retornos leídos: {resultado.retornos}, conciliados: {resultado.conciliados}, "
+        f"estados insertados: {resultado.estados_insertados}, "
+        f"sin envío: {resultado.sin_envio}, lotes fallidos: {resultado.lotes_fallidos}, "
+        f"segundos: {resultado.segundos:.1f}"
+    )
+    SUMMARY.imprimir(args.reporte_json)
+
+
+if __name__ == "__main__":
+    main()
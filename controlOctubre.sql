@@ -11,10 +11,7 @@ WITH historico AS (
         n.notpolhistoricompdependencia,
         n.pactuacionid,
         n.pdomicilioelectronicopj,
-        to_timestamp(
-            left(replace(n.notpolhistoricompfecha, 'T', ' '), 19),
-            'YYYY-MM-DD HH24:MI:SS'
-        ) AS notpolhistoricompfecha_ts
+        n.notpolhistoricompfechats AS notpolhistoricompfecha_ts
     FROM public.notpolhistoricomp AS n
 ),
 ordenado AS (
@@ -69,9 +66,9 @@ FROM primeros AS p
 JOIN ultimos AS u
     ON u.codigoseguimientomp = p.codigoseguimientomp
 WHERE p.primer_estado = 'Pendiente'
-  AND p.fecha_primer_estado::date >= DATE '2025-10-01'
-  AND p.fecha_primer_estado::date < DATE '2025-11-01'
-ORDER BY p.fecha_primer_estado::date,
+  AND p.fecha_primer_estado_ts >= DATE '2025-10-01'
+  AND p.fecha_primer_estado_ts < DATE '2025-11-01'
+ORDER BY p.fecha_primer_estado_ts::date,
          p.codigoseguimientomp
 ) TO 'control_resultado.txt'
   WITH (FORMAT csv, DELIMITER E'\t', HEADER true);
@@ -1,22 +1,9 @@
 -- Reporta diferencias entre el último estado de MP y el registrado en SIAN.
 -- Incluye los casos en que no existe historial en notpolhistoricomp.
-WITH ultimo_estado AS (
-    SELECT DISTINCT ON (TRIM(codigoseguimientomp))
-        TRIM(codigoseguimientomp) AS codigoseguimientomp,
-        notpolhistoricompfecha,
-        notpolhistoricompestado
-    FROM public.notpolhistoricomp
-    WHERE codigoseguimientomp IS NOT NULL
-      AND TRIM(codigoseguimientomp) <> ''
-    ORDER BY TRIM(codigoseguimientomp),
-             to_timestamp(
-                 left(replace(notpolhistoricompfecha, 'T', ' '), 19),
-                 'YYYY-MM-DD HH24:MI:SS'
-             ) DESC NULLS LAST,
-             notpolhistoricompestadonid DESC NULLS LAST
-)
+-- Lee el último estado por código de notpol_ultimo_estado (migración
+-- ultimo_estado_por_codigo).
 SELECT
-    TRIM(env.codigoseguimientomp) AS codigoseguimientomp,
+    env.codigoseguimientompnorm AS codigoseguimientomp,
     env.laststagesian,
     ultimo_estado.notpolhistoricompestado AS ultimo_estado_notpolhistoricomp,
     env.penviocedulanotificacionfechahora,
@@ -26,12 +13,11 @@ SELECT
     env.fechalaststate,
     ultimo_estado.notpolhistoricompfecha
 FROM public.enviocedulanotificacionpolicia AS env
-LEFT JOIN ultimo_estado
-  ON TRIM(env.codigoseguimientomp) = ultimo_estado.codigoseguimientomp
-WHERE env.codigoseguimientomp IS NOT NULL
-  AND TRIM(env.codigoseguimientomp) <> ''
+LEFT JOIN public.notpol_ultimo_estado AS ultimo_estado
+  ON env.codigoseguimientompnorm = ultimo_estado.codigoseguimientompnorm
+WHERE env.codigoseguimientompnorm <> ''
   AND (
-    ultimo_estado.codigoseguimientomp IS NULL
+    ultimo_estado.codigoseguimientompnorm IS NULL
     OR COALESCE(env.laststagesian, '') <> COALESCE(ultimo_estado.notpolhistoricompestado, '')
   )
-ORDER BY TRIM(env.codigoseguimientomp);
+ORDER BY env.codigoseguimientompnorm;
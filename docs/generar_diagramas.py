@@ -206,7 +206,7 @@ def build_flowchart_page() -> List[str]:
         "retornoxmlmp.py\nFiltra envíos y consulta SOAP",
         "_almacenar_xml\nGuarda/actualiza XML pendientes",
         "historialsian.py\nGenera historial con pre_historial",
-        "_marcar_retornomp_procesado\nMarca registros como procesados",
+        "_marcar_retornomp_procesados\nMarca registros como procesados",
         "Fin del ciclo",
     ]
 
@@ -0,0 +1,142 @@
+"""Normalización de las fechas de estado del historial.
+
+Las fechas llegan como texto desde el XML del Ministerio Público
+(``HistorialEstados/Fecha``) y desde ``notpolhistoricomp.notpolhistoricompfecha``,
+casi siempre en ISO 8601 (``2024-01-31T10:15:00``, con o sin fracción y
+zona). :func:`parsear` reconoce ese formato con un camino rápido, recurre a
+``fromisoformat``/``strptime`` solo para el resto y memoriza el resultado por
+texto en una caché LRU acotada, de modo que una misma fecha se parsea una sola
+vez por proceso aunque la consulten ``respuesta_estado``, ``historialsian`` y
+``retornoporestado``.
+
+Todas las funciones devuelven ``datetime`` sin zona horaria. Si el texto
+trae zona, se descarta conservando la hora local indicada, igual que el
+completado de ``notpolhistoricompfechats`` en ``migraciones.py``.
+"""
+
+from __future__ import annotations
+
+from datetime import date, datetime
+from functools import lru_cache
+import re
+from typing import Optional, Union
+
+
+TAMANO_CACHE = 16384
+
+_ISO = re.compile(
+    r"(\d{4})-(\d{2})-(\d{2})[T ](\d{2}):(\d{2}):(\d{2})"
+    r"(?:\.(\d{1,6})\d*)?"
+    r"(Z|[+-]\d{2}:?\d{2})?"
+)
+
+_FORMATOS_ALTERNATIVOS = (
+    "%Y-%m-%dT%H:%M:%S%z",
+    "%Y-%m-%dT%H:%M:%S.%f%z",
+    "%Y-%m-%dT%H:%M:%S",
+    "%Y-%m-%dT%H:%M:%S.%f",
+    "%Y-%m-%d %H:%M:%S",
+)
+
+# Formatos que solo se aceptan para mostrar la fecha (no para comparar).
+_FORMATOS_PANTALLA = ("%d/%m/%Y %H:%M:%S", "%d/%m/%Y")
+
+FechaEntrada = Union[datetime, date, str, None]
+
+
+def _sin_zona(fecha: datetime) -> datetime:
+    return fecha.replace(tzinfo=None) if fecha.tzinfo is not None else fecha
+
+
+def _parsear_iso(texto: str) -> Optional[datetime]:
+    coincidencia = _ISO.fullmatch(texto)
+    if coincidencia is None:
+        return None
+    anio, mes, dia, hora, minuto, segundo, fraccion, _ = coincidencia.groups()
+    try:
+        return datetime(
+            int(anio),
+            int(mes),
+            int(dia),
+            int(hora),
+            int(minuto),
+            int(segundo),
+            int(fraccion.ljust(6, "0")) if fraccion else 0,
+        )
+    except ValueError:
+        return None
+
+
+@lru_cache(maxsize=TAMANO_CACHE)
+def _parsear_texto(texto: str) -> Optional[datetime]:
+    fecha = _parsear_iso(texto)
+    if fecha is not None:
+        return fecha
+
+    normalizado = texto.replace("Z", "+00:00")
+    for formato in _FORMATOS_ALTERNATIVOS:
+        try:
+            return _sin_zona(datetime.strptime(normalizado, formato))
+        except ValueError:
+            continue
+    try:
+        return _sin_zona(datetime.fromisoformat(normalizado))
+    except ValueError:
+        return None
+
+
+def parsear(texto: Optional[str]) -> Optional[datetime]:
+    """Convierte el texto de una fecha de estado; ``None`` si no se reconoce."""
+
+    if not texto:
+        return None
+    texto = texto.strip()
+    if not texto:
+        return None
+    return _parsear_texto(texto)
+
+
+def normalizar(fecha: FechaEntrada) -> Optional[datetime]:
+    """Lleva ``fecha`` (texto, ``date`` o ``datetime``) a ``datetime`` sin zona."""
+
+    if fecha is None:
+        return None
+    if isinstance(fecha, str):
+        return parsear(fecha)
+    if isinstance(fecha, datetime):
+        return _sin_zona(fecha)
+    if isinstance(fecha, date):
+        return datetime.combine(fecha, datetime.min.time())
+    return None
+
+
+def formatear(fecha: FechaEntrada) -> str:
+    """Representación ``dd/mm/aaaa hh:mm:ss`` para mostrar la fecha."""
+
+    if isinstance(fecha, str):
+        texto = fecha.strip()
+        if not texto:
+            return "Sin fecha"
+        fecha_dt = parsear(texto)
+        if fecha_dt is None:
+            for formato in _FORMATOS_PANTALLA:
+                try:
+                    fecha_dt = datetime.strptime(texto, formato)
+                    break
+                except ValueError:
+                    continue
+            else:
+                return texto
+        return fecha_dt.strftime("%d/%m/%Y %H:%M:%S")
+
+    fecha_dt = normalizar(fecha)
+    if fecha_dt is None:
+        return "Sin fecha"
+    return fecha_dt.strftime("%d/%m/%Y %H:%M:%S")
+
+
+def estadisticas_cache() -> str:
+    """Aciertos y tamaño de la caché de :func:`parsear`."""
+
+    info = _parsear_texto.cache_info()
+    return f"aciertos={info.hits} fallos={info.misses} tamaño={info.currsize}/{info.maxsize}"
@@ -1,19 +1,59 @@
 import argparse
+from contextlib import contextmanager
+from dataclasses import dataclass
+import functools
+import json
 import psycopg2
+from psycopg2 import extensions, extras
 from datetime import datetime, date
-import xml.etree.ElementTree as ET
-from typing import Optional, Union, Iterable, Dict, Any, List, Tuple
+import threading
+import time
+from typing import Optional, Union, Iterable, Dict, Any, List, Tuple, Callable, Iterator, Sequence
 from collections import defaultdict
 
+import fechas
+import registro
+import respuesta_estado
+
+
+@dataclass
+class MedicionPaso:
+    """Elementos procesados en una medición de :meth:`SummaryCollector.medir`."""
+
+    items: int = 1
+
+
+def _percentil(valores: List[float], cuantil: float) -> float:
+    ordenados = sorted(valores)
+    posicion = (len(ordenados) - 1) * cuantil
+    inferior = int(posicion)
+    superior = min(inferior + 1, len(ordenados) - 1)
+    return ordenados[inferior] + (ordenados[superior] - ordenados[inferior]) * (
+        posicion - inferior
+    )
+
 
 class SummaryCollector:
-    """Helper class to collect processing statistics for the execution."""
+    """Helper class to collect processing statistics for the execution.
+
+    Además de los conteos por tabla y los errores, acumula el tiempo de cada
+    paso medido con :meth:`medir` o :meth:`cronometrar` (llamadas, total,
+    máximo y p95), los elementos procesados y las idas a la base que cuenta
+    :class:`CursorMedido`, atribuidas al paso más interno en curso del hilo.
+    """
 
     _acciones = ("agregados", "modificados", "ignorados")
 
     def __init__(self) -> None:
         self._datos = defaultdict(lambda: {accion: 0 for accion in self._acciones})
         self._errores: List[str] = []
+        self._duraciones: Dict[str, List[float]] = defaultdict(list)
+        self._items: Dict[str, int] = defaultdict(int)
+        self._idas: Dict[str, int] = defaultdict(int)
+        self._idas_total = 0
+        self._inicio = time.perf_counter()
+        self._bloqueo = threading.Lock()
+        self._hilo = threading.local()
 
     def add(self, tabla: str, accion: str, cantidad: int = 1) -> None:
         accion_normalizada = accion.lower()
@@ -27,7 +67,90 @@ class SummaryCollector:
         detalle = contexto if not mensaje else f"{contexto}: {mensaje}"
         self._errores.append(detalle)
 
-    def imprimir(self) -> None:
+    def _pasos_en_curso(self) -> List[str]:
+        pila = getattr(self._hilo, "pasos", None)
+        if pila is None:
+            pila = self._hilo.pasos = []
+        return pila
+
+    def add_ida(self, cantidad: int = 1) -> None:
+        """Cuenta ``cantidad`` idas a la base para el paso en curso."""
+
+        pasos = self._pasos_en_curso()
+        with self._bloqueo:
+            self._idas_total += cantidad
+            if pasos:
+                self._idas[pasos[-1]] += cantidad
+
+    @contextmanager
+    def medir(self, paso: str, items: int = 1) -> Iterator[MedicionPaso]:
+        """Mide el tiempo de ``paso``; ``items`` puede ajustarse al final."""
+
+        medicion = MedicionPaso(items)
+        pasos = self._pasos_en_curso()
+        pasos.append(paso)
+        inicio = time.perf_counter()
+        try:
+            yield medicion
+        finally:
+            duracion = time.perf_counter() - inicio
+            pasos.pop()
+            with self._bloqueo:
+                self._duraciones[paso].append(duracion)
+                self._items[paso] += medicion.items
+
+    def cronometrar(self, paso: Optional[str] = None) -> Callable:
+        """Decorador que mide cada llamada a la función con :meth:`medir`."""
+
+        def decorar(funcion: Callable) -> Callable:
+            nombre = paso or funcion.__name__
+
+            @functools.wraps(funcion)
+            def envoltura(*args, **kwargs):
+                with self.medir(nombre):
+                    return funcion(*args, **kwargs)
+
+            return envoltura
+
+        return decorar
+
+    def tiempos(self) -> Dict[str, Dict[str, float]]:
+        """Estadísticas por paso, ordenadas por tiempo total descendente."""
+
+        with self._bloqueo:
+            duraciones = {paso: list(valores) for paso, valores in self._duraciones.items()}
+            items = dict(self._items)
+            idas = dict(self._idas)
+        resultado: Dict[str, Dict[str, float]] = {}
+        for paso, valores in sorted(duraciones.items(), key=lambda par: -sum(par[1])):
+            total = sum(valores)
+            resultado[paso] = {
+                "llamadas": len(valores),
+                "total_s": round(total, 3),
+                "max_ms": round(max(valores) * 1000, 1),
+                "p95_ms": round(_percentil(valores, 0.95) * 1000, 1),
+                "items": items.get(paso, 0),
+                "items_por_s": round(items.get(paso, 0) / total, 1) if total else 0.0,
+                "idas_bd": idas.get(paso, 0),
+            }
+        return resultado
+
+    def reporte(self) -> Dict[str, Any]:
+        """Resumen completo de la ejecución en un diccionario serializable."""
+
+        duracion = time.perf_counter() - self._inicio
+        return {
+            "duracion_s": round(duracion, 3),
+            "idas_bd": self._idas_total,
+            "idas_bd_por_s": round(self._idas_total / duracion, 1) if duracion else 0.0,
+            "tablas": {tabla: dict(datos) for tabla, datos in sorted(self._datos.items())},
+            "pasos": self.tiempos(),
+            "errores": list(self._errores),
+        }
+
+    def imprimir(self, ruta_json: Optional[str] = None) -> None:
+        """Registra el resumen y, con ``ruta_json``, lo guarda como JSON."""
+
         lineas = ["Resumen de procesamiento:"]
         if self._datos:
             for tabla in sorted(self._datos):
@@ -39,6 +162,20 @@ class SummaryCollector:
         else:
             lineas.append("- Sin cambios registrados.")
 
+        reporte = self.reporte()
+        if reporte["pasos"]:
+            lineas.append("Tiempos por paso:")
+            for paso, datos in reporte["pasos"].items():
+                lineas.append(
+                    "- {paso}: llamadas={llamadas}, total={total_s:.3f}s, "
+                    "max={max_ms:.1f}ms, p95={p95_ms:.1f}ms, items/s={items_por_s:.1f}, "
+                    "idas_bd={idas_bd}".format(paso=paso, **datos)
+                )
+        lineas.append(
+            "Duración: {duracion_s:.1f}s, idas a la base: {idas_bd} "
+            "({idas_bd_por_s:.1f}/s)".format(**reporte)
+        )
+
         if self._errores:
             lineas.append("Errores:")
             for error in self._errores:
@@ -46,17 +183,45 @@ class SummaryCollector:
         else:
             lineas.append("Errores: ninguno")
 
-        print("\n".join(lineas))
+        registro.obtener("resumen").info("%s", "\n".join(lineas))
+
+        if ruta_json:
+            with open(ruta_json, "w", encoding="utf-8") as archivo:
+                json.dump(reporte, archivo, ensure_ascii=False, indent=2)
 
 
 SUMMARY = SummaryCollector()
 
 
-def _log_step(func_name: str, status: str, message: str = "") -> None:
-    """Collect errors to include them in the final summary."""
+class CursorMedido(extensions.cursor):
+    """Cursor que cuenta cada sentencia como una ida a la base en ``SUMMARY``."""
+
+    def execute(self, query, vars=None):
+        SUMMARY.add_ida()
+        return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        vars_list = list(vars_list)
+        SUMMARY.add_ida(len(vars_list))
+        return super().executemany(query, vars_list)
+
+
+def conectar(configuracion: Dict[str, Any]) -> psycopg2.extensions.connection:
+    """Abre una conexión cuyos cursores cuentan las idas a la base."""
+
+    return psycopg2.connect(cursor_factory=CursorMedido, **configuracion)
+
+
+def _log_step(func_name: str, status: str, message: str = "", *args: Any) -> None:
+    """Registra el paso y acumula los errores para el resumen final.
+
+    ``message`` admite argumentos ``%`` que solo se formatean si el nivel del
+    paso está habilitado en :mod:`registro` o si es un error.
+    """
 
     if status.upper() == "ERROR":
-        SUMMARY.add_error(func_name, message)
+        SUMMARY.add_error(func_name, message % args if args else message)
+    registro.paso(func_name, status, message, *args)
 
 test = False
 
@@ -101,43 +266,216 @@ else:
         "password": "A8d%4pXq"
     }
 
+class SesionHistorial:
+    """Conexión a IURIX compartida por la conciliación del historial.
+
+    ``lasstage``, ``_guardar_historial_notpol`` y ``grabar_historico`` escriben
+    en ``conexion``. Cada código procesado con :meth:`codigo` queda aislado por
+    un savepoint, de modo que un error solo revierte ese código, y la
+    transacción se confirma cada ``lote`` códigos. El savepoint se libera al
+    terminar cada código, así el lote no acumula subtransacciones abiertas.
+    ``al_confirmar`` se invoca después de cada confirmación.
+
+    Sin ``conexion`` se abre una con ``pgsql_config`` que se cierra al salir
+    del contexto. Al salir sin errores se confirma lo pendiente.
+
+    :meth:`precargar_claves` trae en una consulta las claves de estado ya
+    registradas de los envíos del lote, que ``_guardar_historial_notpol`` usa
+    en lugar de consultarlas por código.
+
+    Con ``diferir_ultimo_estado``, ``grabar_historico`` no actualiza el envío
+    en el momento: acumula el estado del XML y la clave del envío, y al
+    confirmar el lote se aplican con dos sentencias por conjunto (estado por
+    código y último estado de ``notpolhistoricomp`` con ``DISTINCT ON``). Un
+    error en esas sentencias se propaga y revierte el lote completo.
+    """
+
+    _SAVEPOINT = "historial_codigo"
+
+    def __init__(
+        self,
+        conexion: Optional[psycopg2.extensions.connection] = None,
+        lote: int = 50,
+        al_confirmar: Optional[Callable[[], None]] = None,
+        diferir_ultimo_estado: bool = False,
+    ) -> None:
+        self._propia = conexion is None
+        self.conexion = conexion if conexion is not None else conectar(pgsql_config)
+        self.lote = max(1, lote)
+        self._al_confirmar = al_confirmar
+        self._pendientes = 0
+        self._en_savepoint = False
+        self._claves: Dict[Tuple[Any, Any, str, str], set] = {}
+        self.diferir_ultimo_estado = diferir_ultimo_estado
+        # Envíos diferidos del código en curso y de los códigos ya cerrados.
+        self._envios_codigo: List[Tuple[Tuple[str, str, Any, bool], Tuple[Any, Any, str, str]]] = []
+        self._envios_lote: List[Tuple[Tuple[str, str, Any, bool], Tuple[Any, Any, str, str]]] = []
+
+    def __enter__(self) -> "SesionHistorial":
+        return self
+
+    def __exit__(self, tipo, valor, traza) -> bool:
+        try:
+            if tipo is None:
+                self.confirmar()
+            else:
+                self._envios_codigo.clear()
+                self._envios_lote.clear()
+                self.conexion.rollback()
+        finally:
+            if self._propia:
+                self.conexion.close()
+        return False
+
+    def _ejecutar(self, sentencia: str) -> None:
+        with self.conexion.cursor() as cursor:
+            cursor.execute(sentencia)
+
+    @contextmanager
+    def codigo(self) -> Iterator["SesionHistorial"]:
+        """Delimita las escrituras de un código dentro del lote."""
+
+        # Con lote 1 cada código se confirma solo y no hace falta savepoint.
+        self._en_savepoint = self.lote > 1
+        if self._en_savepoint:
+            self._ejecutar(f"SAVEPOINT {self._SAVEPOINT}")
+        try:
+            yield self
+        except BaseException:
+            self.revertir_codigo()
+            self._liberar_savepoint()
+            raise
+        else:
+            # Liberar evita acumular subtransacciones abiertas en el lote.
+            self._liberar_savepoint()
+        finally:
+            self._en_savepoint = False
+        self._envios_lote.extend(self._envios_codigo)
+        self._envios_codigo.clear()
+        self._pendientes += 1
+        if self._pendientes >= self.lote:
+            self.confirmar()
+
+    def _liberar_savepoint(self) -> None:
+        if self._en_savepoint:
+            self._ejecutar(f"RELEASE SAVEPOINT {self._SAVEPOINT}")
+
+    def revertir_codigo(self) -> None:
+        """Descarta las escrituras del código en curso."""
+
+        if self._en_savepoint:
+            self._ejecutar(f"ROLLBACK TO SAVEPOINT {self._SAVEPOINT}")
+        else:
+            self.conexion.rollback()
+        # Las claves precargadas pueden incluir estados recién revertidos.
+        self._claves.clear()
+        self._envios_codigo.clear()
+        if not self._en_savepoint:
+            self._envios_lote.clear()
+
+    def diferir_envio(
+        self,
+        estado_texto: str,
+        fecha_estado,
+        pmovimientoid,
+        pactuacionid,
+        pdomicilioelectronicopj,
+        codigo: str,
+    ) -> None:
+        """Registra el estado del envío para aplicarlo al confirmar el lote."""
+
+        codigo = (codigo or "").strip()
+        self._envios_codigo.append(
+            (
+                (codigo, estado_texto, fecha_estado, _estado_finalizado(estado_texto)),
+                (pmovimientoid, pactuacionid, pdomicilioelectronicopj, codigo),
+            )
+        )
+
+    def _aplicar_envios_diferidos(self) -> None:
+        self._envios_lote.extend(self._envios_codigo)
+        self._envios_codigo.clear()
+        if not self._envios_lote:
+            return
+        with SUMMARY.medir("aplicar_envios_diferidos", items=len(self._envios_lote)):
+            with self.conexion.cursor() as cursor:
+                _actualizar_envios_por_codigo_lote(
+                    cursor, [estado for estado, _ in self._envios_lote]
+                )
+                _actualizar_envios_con_ultimo_estado_lote(
+                    cursor, list(dict.fromkeys(clave for _, clave in self._envios_lote))
+                )
+        self._envios_lote.clear()
+
+    def precargar_claves(
+        self, envios: Iterable[Tuple[Any, Any, str, str]]
+    ) -> None:
+        """Reemplaza las claves precargadas por las de ``envios``."""
+
+        with self.conexion.cursor() as cursor:
+            self._claves = _obtener_claves_estados_existentes_lote(cursor, envios)
+
+    def claves_precargadas(
+        self, pmovimientoid, pactuacionid, pdomicilioelectronicopj, codigo: str
+    ) -> Optional[set]:
+        """Claves precargadas del envío o ``None`` si no se precargaron."""
+
+        return self._claves.get(
+            (pmovimientoid, pactuacionid, pdomicilioelectronicopj, (codigo or "").strip())
+        )
+
+    def confirmar(self) -> None:
+        self._aplicar_envios_diferidos()
+        self.conexion.commit()
+        self._pendientes = 0
+        if self._al_confirmar is not None:
+            self._al_confirmar()
+
+
+@contextmanager
+def _usar_sesion(sesion: Optional[SesionHistorial]) -> Iterator[SesionHistorial]:
+    if sesion is not None:
+        yield sesion
+        return
+    with SesionHistorial(lote=1) as propia:
+        yield propia
+
+
+@SUMMARY.cronometrar()
 def lasstage(
     pmovimientoid,
     pactuacionid,
     pdomicilioelectronicopj,
     CODIGO_SEGUIMIENTO,
     fecha_ultima_estado=None,
-    xml_respuesta: Optional[str] = None,
+    xml_respuesta: Union[str, "respuesta_estado.RespuestaEstadoNotificacion", None] = None,
+    sesion: Optional[SesionHistorial] = None,
 ) -> Tuple[Optional[Dict[str, Any]], int, int]:
-    # Obtiene los estados desde el XML almacenado en retornomp.
+    # Obtiene los estados desde el XML almacenado en retornomp, parseado una
+    # sola vez y compartido con retornoxmlmp mediante respuesta_estado. Los
+    # estados nuevos se insertan en la conexión de ``sesion`` si se indica.
     _log_step(
         "lasstage",
         "INICIO",
-        f"Procesando seguimiento {CODIGO_SEGUIMIENTO} (mov: {pmovimientoid}, act: {pactuacionid})",
+        "Procesando seguimiento %s (mov: %s, act: %s)",
+        CODIGO_SEGUIMIENTO,
+        pmovimientoid,
+        pactuacionid,
     )
 
-    if not xml_respuesta:
-        _log_step("lasstage", "ADVERTENCIA", "XML vacío o inexistente")
+    respuesta = respuesta_estado.parsear_respuesta_estado(xml_respuesta)
+    if not respuesta.xml_valido:
+        nivel = "ERROR" if xml_respuesta else "ADVERTENCIA"
+        _log_step("lasstage", nivel, respuesta.errores[0])
         return None, 0, 0
+    for error in respuesta.errores:
+        _log_step("lasstage", "ADVERTENCIA", error)
 
-    try:
-        root = ET.fromstring(xml_respuesta)
-    except ET.ParseError as exc:
-        _log_step("lasstage", "ERROR", f"XML inválido: {exc}")
-        return None, 0, 0
-
-    namespaces = {
-        "soap": "http://schemas.xmlsoap.org/soap/envelope/",
-        "temp": "http://tempuri.org/",
-    }
-
-    estados = root.findall(
-        ".//temp:HistorialEstados/temp:EstadoNotificacion", namespaces
-    )
-
-    estados_normalizados = _normalizar_estados(estados, namespaces)
+    estados_normalizados = [estado.como_dict() for estado in respuesta.estados]
     total_estados = len(estados_normalizados)
-    ultimo_estado = _obtener_estado_mas_reciente(estados_normalizados)
+    ultimo_estado = (
+        respuesta.ultimo_estado.como_dict() if respuesta.ultimo_estado else None
+    )
 
     estados_filtrados = _filtrar_estados_nuevos(
         estados_normalizados, fecha_ultima_estado
@@ -157,57 +495,170 @@ def lasstage(
         pactuacionid,
         pdomicilioelectronicopj,
         CODIGO_SEGUIMIENTO,
+        sesion=sesion,
     )
 
     _log_step(
         "lasstage",
         "OK",
-        f"Estados obtenidos correctamente para {CODIGO_SEGUIMIENTO}",
+        "Estados obtenidos correctamente para %s",
+        CODIGO_SEGUIMIENTO,
     )
     return ultimo_estado, total_estados, insertados
 
 
-def pre_historial(codigodeseguimientomp: Optional[str] = None):
+def _actualizar_envios_pre_historial(conexion_pg: psycopg2.extensions.connection) -> None:
+    with conexion_pg.cursor() as cursor_pg:
+        cursor_pg.execute(
+            "update enviocedulanotificacionpolicia set finsian = True "
+            "where descartada = True and finsian <> True"
+        )
+        SUMMARY.add(
+            "enviocedulanotificacionpolicia", "modificados", cursor_pg.rowcount
+        )
+
+        cursor_pg.execute(
+            "update enviocedulanotificacionpolicia set descartada= false, "
+            "laststagesian = 'Sin info', fechalaststate = CURRENT_TIMESTAMP "
+            "where penviocedulanotificacionfechahora >= current_date - INTERVAL '1 days' "
+            "and coalesce(descartada,false) = false"
+        )
+        SUMMARY.add(
+            "enviocedulanotificacionpolicia", "modificados", cursor_pg.rowcount
+        )
+
+    conexion_pg.commit()
+
+
+@SUMMARY.cronometrar()
+def pre_historial(
+    codigodeseguimientomp: Optional[str] = None,
+    conexion_pg: Optional[psycopg2.extensions.connection] = None,
+):
     _log_step("pre_historial", "INICIO", "Preparando actualización de registros")
     codigo_filtrado = (codigodeseguimientomp or "").strip() or None
     try:
-        with psycopg2.connect(**pgsql_config) as conexion_pg:
-            with conexion_pg.cursor() as cursor_pg:
-                cursor_pg.execute(
-                    "update enviocedulanotificacionpolicia set finsian = True "
-                    "where descartada = True and finsian <> True"
-                )
-                SUMMARY.add(
-                    "enviocedulanotificacionpolicia", "modificados", cursor_pg.rowcount
-                )
-
-                cursor_pg.execute(
-                    "update enviocedulanotificacionpolicia set descartada= false, "
-                    "laststagesian = 'Sin info', fechalaststate = CURRENT_TIMESTAMP "
-                    "where penviocedulanotificacionfechahora >= current_date - INTERVAL '1 days' "
-                    "and coalesce(descartada,false) = false"
-                )
-                SUMMARY.add(
-                    "enviocedulanotificacionpolicia", "modificados", cursor_pg.rowcount
-                )
-
-            conexion_pg.commit()
+        if conexion_pg is not None:
+            _actualizar_envios_pre_historial(conexion_pg)
+        else:
+            with conectar(pgsql_config) as conexion_nueva:
+                _actualizar_envios_pre_historial(conexion_nueva)
 
-            _log_step(
-                "pre_historial",
-                "OK",
-                "Se omite el procesamiento de retornomp por configuración.",
-            )
-            return
+        _log_step(
+            "pre_historial",
+            "OK",
+            "Se omite el procesamiento de retornomp por configuración.",
+        )
+        return
     except Exception as e:
+        if conexion_pg is not None:
+            conexion_pg.rollback()
         _log_step(
             "pre_historial",
             "ERROR",
-            f"Error en la conexión o consulta SQL: {e}",
+            "Error en la conexión o consulta SQL: %s",
+            e,
+        )
+
+
+@dataclass(frozen=True)
+class RetornoPendiente:
+    """XML de ``retornomp`` que debe reflejarse en el historial."""
+
+    pmovimientoid: Any
+    pactuacionid: Any
+    pdomicilioelectronicopj: str
+    codigo_seguimiento: str
+    xml_contenido: str
+    # SHA-256 de ``xml_contenido`` como ``retornomp.contenido_digest``.
+    contenido_digest: Optional[str] = None
+
+
+@SUMMARY.cronometrar()
+def procesar_historial(
+    conexion_pg: psycopg2.extensions.connection,
+    conexion_panel: psycopg2.extensions.connection,
+    retornos: Iterable[RetornoPendiente] = (),
+    codigodeseguimientomp: Optional[str] = None,
+    lote_codigos: int = 50,
+) -> int:
+    """Ejecuta el historial en el proceso actual con conexiones existentes.
+
+    Aplica las actualizaciones de ``pre_historial`` y concilia únicamente los
+    ``retornos`` indicados (los XML modificados durante la ejecución que
+    invoca). Todo el historial se escribe en ``conexion_pg`` mediante una
+    :class:`SesionHistorial` que confirma cada ``lote_codigos`` códigos; los
+    retornos se marcan como procesados en ``retornomp`` recién después de
+    cada confirmación. Las claves de estado existentes se precargan con una
+    consulta por lote y el último estado de los envíos se actualiza por
+    conjunto al confirmar. Devuelve la cantidad de retornos conciliados.
+    """
+
+    pre_historial(codigodeseguimientomp, conexion_pg=conexion_pg)
+
+    por_marcar: List[RetornoPendiente] = []
+
+    def marcar_confirmados() -> None:
+        _marcar_retornomp_procesados(
+            conexion_panel,
+            [
+                (
+                    retorno.pmovimientoid,
+                    retorno.pactuacionid,
+                    retorno.pdomicilioelectronicopj,
+                    retorno.contenido_digest,
+                )
+                for retorno in por_marcar
+            ],
         )
+        por_marcar.clear()
+
+    retornos = list(retornos)
+    conciliados = 0
+    with SesionHistorial(
+        conexion_pg,
+        lote=lote_codigos,
+        al_confirmar=marcar_confirmados,
+        diferir_ultimo_estado=True,
+    ) as sesion:
+        for indice, retorno in enumerate(retornos):
+            if indice % sesion.lote == 0:
+                sesion.precargar_claves(
+                    (
+                        pendiente.pmovimientoid,
+                        pendiente.pactuacionid,
+                        pendiente.pdomicilioelectronicopj,
+                        pendiente.codigo_seguimiento,
+                    )
+                    for pendiente in retornos[indice:indice + sesion.lote]
+                )
+            with sesion.codigo():
+                fecha_ultima = _obtener_fecha_historial(
+                    conexion_pg, retorno.codigo_seguimiento
+                )
+                if llamar_his_mp(
+                    retorno.pmovimientoid,
+                    retorno.pactuacionid,
+                    retorno.pdomicilioelectronicopj,
+                    retorno.codigo_seguimiento,
+                    fecha_ultima,
+                    retorno.xml_contenido,
+                    sesion=sesion,
+                ):
+                    por_marcar.append(retorno)
+                    conciliados += 1
+
+    _log_step(
+        "procesar_historial",
+        "OK",
+        "Retornos conciliados: %s",
+        conciliados,
+    )
+    return conciliados
 
 
 
+@SUMMARY.cronometrar()
 def llamar_his_mp(
     pmovimientoid,
     pactuacionid,
@@ -215,11 +666,13 @@ def llamar_his_mp(
     CODIGO_SEGUIMIENTO,
     fecha_ultima_estado,
     xml_contenido,
+    sesion: Optional[SesionHistorial] = None,
 ) -> bool:
     _log_step(
         "llamar_his_mp",
         "INICIO",
-        f"Obteniendo historial para {CODIGO_SEGUIMIENTO}",
+        "Obteniendo historial para %s",
+        CODIGO_SEGUIMIENTO,
     )
     try:
         ultimo_estado, total_estados, insertados = lasstage(
@@ -229,16 +682,15 @@ def llamar_his_mp(
             CODIGO_SEGUIMIENTO,
             fecha_ultima_estado,
             xml_contenido,
+            sesion=sesion,
         )
 
         if ultimo_estado is None:
             _log_step(
                 "llamar_his_mp",
                 "OK",
-                (
-                    f"Sin estados en el XML para {CODIGO_SEGUIMIENTO}; "
-                    "se registra 'Sin info' en el envío"
-                ),
+                "Sin estados en el XML para %s; se registra 'Sin info' en el envío",
+                CODIGO_SEGUIMIENTO,
             )
             return grabar_historico(
                 "Sin info",
@@ -247,6 +699,7 @@ def llamar_his_mp(
                 pactuacionid,
                 pdomicilioelectronicopj,
                 CODIGO_SEGUIMIENTO,
+                sesion=sesion,
             )
 
         estado = (ultimo_estado.get("estado") or "").strip() or "Sin info"
@@ -254,7 +707,9 @@ def llamar_his_mp(
         _log_step(
             "llamar_his_mp",
             "OK",
-            f"Total estados analizados: {total_estados}, nuevos insertados: {insertados}",
+            "Total estados analizados: %s, nuevos insertados: %s",
+            total_estados,
+            insertados,
         )
 
         exito_guardado = grabar_historico(
@@ -264,22 +719,27 @@ def llamar_his_mp(
             pactuacionid,
             pdomicilioelectronicopj,
             CODIGO_SEGUIMIENTO,
+            sesion=sesion,
         )
     except Exception as e:
-        _log_step("llamar_his_mp", "ERROR", f"Error procesando XML: {e}")
+        if sesion is not None:
+            sesion.revertir_codigo()
+        _log_step("llamar_his_mp", "ERROR", "Error procesando XML: %s", e)
         return False
     else:
         if exito_guardado:
             _log_step(
                 "llamar_his_mp",
                 "OK",
-                f"Historial actualizado para {CODIGO_SEGUIMIENTO}",
+                "Historial actualizado para %s",
+                CODIGO_SEGUIMIENTO,
             )
             return True
         _log_step(
             "llamar_his_mp",
             "ERROR",
-            f"Historial no pudo actualizarse para {CODIGO_SEGUIMIENTO}",
+            "Historial no pudo actualizarse para %s",
+            CODIGO_SEGUIMIENTO,
         )
         return False
 
@@ -294,7 +754,7 @@ def _obtener_identificadores_por_codigo(
     consulta = """
         SELECT pmovimientoid, pactuacionid, pdomicilioelectronicopj
         FROM enviocedulanotificacionpolicia
-        WHERE TRIM(codigoseguimientomp) = %s
+        WHERE codigoseguimientompnorm = %s
     """
 
     with conexion_pg.cursor() as cursor:
@@ -315,8 +775,8 @@ def _obtener_datos_envio(
           AND pactuacionid = %s
           AND pdomicilioelectronicopj = %s
           AND codigoseguimientomp IS NOT NULL
-          AND TRIM(codigoseguimientomp) <> ''
-          AND UPPER(TRIM(codigoseguimientomp)) <> 'NONE'
+          AND codigoseguimientompnorm <> ''
+          AND UPPER(codigoseguimientompnorm) <> 'NONE'
         LIMIT 1
     """
 
@@ -339,17 +799,10 @@ def _obtener_fecha_historial(
     """Obtiene la última fecha registrada en notpolhistoricomp para el código."""
 
     consulta = """
-        SELECT to_timestamp(
-            left(replace(notpolhistoricompfecha, 'T', ' '), 19),
-            'YYYY-MM-DD HH24:MI:SS'
-        )
+        SELECT notpolhistoricompfechats
         FROM notpolhistoricomp
-        WHERE codigoseguimientomp IS NOT NULL
-          AND TRIM(codigoseguimientomp) = TRIM(%s)
-        ORDER BY to_timestamp(
-            left(replace(notpolhistoricompfecha, 'T', ' '), 19),
-            'YYYY-MM-DD HH24:MI:SS'
-        ) DESC NULLS LAST
+        WHERE codigoseguimientompnorm = TRIM(%s)
+        ORDER BY notpolhistoricompfechats DESC NULLS LAST
         LIMIT 1
     """
 
@@ -362,72 +815,53 @@ def _obtener_fecha_historial(
     return fila[0]
 
 
-def _marcar_retornomp_procesado(
+_SENTENCIA_MARCAR_PROCESADOS = """
+    UPDATE retornomp AS r
+    SET procesado = TRUE,
+        fechaproceso = NOW()
+    FROM (VALUES %s) AS d (pmovimientoid, pactuacionid, pdomicilioelectronicopj, digest)
+    WHERE r.pmovimientoid = d.pmovimientoid
+      AND r.pactuacionid = d.pactuacionid
+      AND r.pdomicilioelectronicopj = d.pdomicilioelectronicopj
+      AND r.contenido_digest IS NOT DISTINCT FROM d.digest
+"""
+
+
+def _marcar_retornomp_procesados(
     conexion_panel: psycopg2.extensions.connection,
-    pmovimientoid,
-    pactuacionid,
-    pdomicilioelectronicopj,
+    procesados: Sequence[Tuple[Any, Any, str, Optional[str]]],
 ) -> None:
+    """Marca como procesados los retornos conciliados en una sentencia.
+
+    ``procesados`` son tuplas ``(pmovimientoid, pactuacionid,
+    pdomicilioelectronicopj, digest)``; si ``contenido_digest`` cambió desde
+    la lectura (llegó un XML más nuevo) la fila queda pendiente.
+    """
+
+    if not procesados:
+        return
     with conexion_panel.cursor() as cursor:
-        cursor.execute(
-            """
-            UPDATE retornomp
-            SET procesado = TRUE,
-                fechaproceso = NOW()
-            WHERE pmovimientoid = %s
-              AND pactuacionid = %s
-              AND pdomicilioelectronicopj = %s
-            """,
-            (pmovimientoid, pactuacionid, pdomicilioelectronicopj),
+        extras.execute_values(
+            cursor,
+            _SENTENCIA_MARCAR_PROCESADOS,
+            procesados,
+            page_size=len(procesados),
         )
         SUMMARY.add("retornomp", "modificados", cursor.rowcount)
     conexion_panel.commit()
 
 
 
-def _formatear_fecha_estado(fecha_estado: Optional[Union[str, datetime]]) -> str:
-    """Devuelve una representación legible de la fecha del estado."""
-
-    if isinstance(fecha_estado, datetime):
-        return fecha_estado.strftime("%d/%m/%Y %H:%M:%S")
-
-    if isinstance(fecha_estado, str):
-        fecha = fecha_estado.strip()
-        if not fecha:
-            return "Sin fecha"
-
-        fecha_normalizada = fecha.replace("Z", "+00:00")
-        try:
-            fecha_dt = datetime.fromisoformat(fecha_normalizada)
-            return fecha_dt.strftime("%d/%m/%Y %H:%M:%S")
-        except ValueError:
-            formatos = [
-                "%Y-%m-%d %H:%M:%S",
-                "%Y-%m-%dT%H:%M:%S",
-                "%Y-%m-%dT%H:%M:%S.%f",
-                "%Y-%m-%dT%H:%M:%S%z",
-                "%Y-%m-%dT%H:%M:%S.%f%z",
-                "%d/%m/%Y %H:%M:%S",
-                "%d/%m/%Y",
-            ]
-            for formato in formatos:
-                try:
-                    fecha_dt = datetime.strptime(fecha, formato)
-                    return fecha_dt.strftime("%d/%m/%Y %H:%M:%S")
-                except ValueError:
-                    continue
-            return fecha
-
-    return "Sin fecha"
+ESTADOS_FINALIZADOS = (
+    "ENTREGADA",
+    "NO ENTREGADA",
+    "DESCARTADA",
+    "FINALIZADA",
+)
 
 
 def _estado_finalizado(estado_texto: str) -> bool:
-    return estado_texto.upper() in (
-        "ENTREGADA",
-        "NO ENTREGADA",
-        "DESCARTADA",
-        "FINALIZADA",
-    )
+    return estado_texto.upper() in ESTADOS_FINALIZADOS
 
 
 def _actualizar_envio_por_codigo(
@@ -441,7 +875,7 @@ def _actualizar_envio_por_codigo(
         SET laststagesian = %s,
             fechalaststate = %s,
             finsian = %s
-        WHERE TRIM(codigoseguimientomp) = TRIM(%s)
+        WHERE codigoseguimientompnorm = TRIM(%s)
     """
     cursor.execute(
         update_query,
@@ -464,20 +898,14 @@ def _obtener_ultimo_estado_notpolhistoricomp(
 ) -> Optional[Tuple[str, Optional[datetime]]]:
     consulta = """
         SELECT notpolhistoricompestado,
-               to_timestamp(
-                   left(replace(notpolhistoricompfecha, 'T', ' '), 19),
-                   'YYYY-MM-DD HH24:MI:SS'
-               )
+               notpolhistoricompfechats
         FROM notpolhistoricomp
         WHERE pmovimientoid = %s
           AND pactuacionid = %s
           AND pdomicilioelectronicopj = %s
-          AND TRIM(codigoseguimientomp) = TRIM(%s)
+          AND codigoseguimientompnorm = TRIM(%s)
         ORDER BY notpolhistoricompestadonid DESC NULLS LAST,
-                 to_timestamp(
-                     left(replace(notpolhistoricompfecha, 'T', ' '), 19),
-                     'YYYY-MM-DD HH24:MI:SS'
-                 ) DESC NULLS LAST
+                 notpolhistoricompfechats DESC NULLS LAST
         LIMIT 1
     """
     cursor.execute(
@@ -516,7 +944,7 @@ def _actualizar_envio_con_ultimo_estado(
         WHERE pmovimientoid = %s
           AND pactuacionid = %s
           AND pdomicilioelectronicopj = %s
-          AND TRIM(codigoseguimientomp) = TRIM(%s)
+          AND codigoseguimientompnorm = TRIM(%s)
     """
     cursor.execute(
         update_query,
@@ -538,22 +966,102 @@ def _actualizar_envio_con_ultimo_estado(
     return cursor.rowcount
 
 
-def _obtener_estado_mas_reciente(
-    estados: Iterable[Dict[str, Any]],
-) -> Optional[Dict[str, Any]]:
-    estados_lista = list(estados)
-    if not estados_lista:
-        return None
+_SENTENCIA_ULTIMO_ESTADO_LOTE = """
+    UPDATE enviocedulanotificacionpolicia AS e
+    SET laststagesian = u.estado,
+        fechalaststate = u.fecha,
+        finsian = UPPER(COALESCE(u.estado, '')) IN (%s)
+    FROM (
+        SELECT DISTINCT ON (
+                   n.pmovimientoid,
+                   n.pactuacionid,
+                   n.pdomicilioelectronicopj,
+                   n.codigoseguimientompnorm
+               )
+               n.pmovimientoid,
+               n.pactuacionid,
+               n.pdomicilioelectronicopj,
+               n.codigoseguimientompnorm AS codigo,
+               n.notpolhistoricompestado AS estado,
+               n.notpolhistoricompfechats AS fecha
+        FROM notpolhistoricomp AS n
+        JOIN (VALUES %%s) AS d (pmovimientoid, pactuacionid, pdomicilioelectronicopj, codigo)
+          ON n.pmovimientoid = d.pmovimientoid
+         AND n.pactuacionid = d.pactuacionid
+         AND n.pdomicilioelectronicopj = d.pdomicilioelectronicopj
+         AND n.codigoseguimientompnorm = d.codigo
+        ORDER BY n.pmovimientoid,
+                 n.pactuacionid,
+                 n.pdomicilioelectronicopj,
+                 n.codigoseguimientompnorm,
+                 n.notpolhistoricompestadonid DESC NULLS LAST,
+                 n.notpolhistoricompfechats DESC NULLS LAST
+    ) AS u
+    WHERE e.pmovimientoid = u.pmovimientoid
+      AND e.pactuacionid = u.pactuacionid
+      AND e.pdomicilioelectronicopj = u.pdomicilioelectronicopj
+      AND e.codigoseguimientompnorm = u.codigo
+""" % ", ".join(f"'{estado}'" for estado in ESTADOS_FINALIZADOS)
+
+
+def _actualizar_envios_con_ultimo_estado_lote(
+    cursor: psycopg2.extensions.cursor,
+    claves: List[Tuple[Any, Any, str, str]],
+) -> int:
+    """Versión por conjunto de :func:`_actualizar_envio_con_ultimo_estado`.
 
-    def _clave_estado(estado: Dict[str, Any]) -> datetime:
-        fecha = _normalizar_fecha_para_comparacion(
-            estado.get("fecha") or estado.get("fecha_raw")
-        )
-        return fecha or datetime.min
+    ``claves`` son tuplas ``(pmovimientoid, pactuacionid,
+    pdomicilioelectronicopj, codigo)``; cada envío toma el último estado de
+    ``notpolhistoricomp`` en una única sentencia.
+    """
+
+    if not claves:
+        return 0
+    extras.execute_values(
+        cursor, _SENTENCIA_ULTIMO_ESTADO_LOTE, claves, page_size=len(claves)
+    )
+    SUMMARY.add("enviocedulanotificacionpolicia", "modificados", cursor.rowcount)
+    return cursor.rowcount
+
+
+_SENTENCIA_ESTADO_POR_CODIGO_LOTE = """
+    UPDATE enviocedulanotificacionpolicia AS e
+    SET laststagesian = d.estado,
+        fechalaststate = d.fecha,
+        finsian = d.finsian
+    FROM (VALUES %s) AS d (codigo, estado, fecha, finsian)
+    WHERE e.codigoseguimientompnorm = d.codigo
+"""
 
-    return max(estados_lista, key=_clave_estado)
 
+def _actualizar_envios_por_codigo_lote(
+    cursor: psycopg2.extensions.cursor,
+    estados: Iterable[Tuple[str, str, Any, bool]],
+) -> int:
+    """Versión por conjunto de :func:`_actualizar_envio_por_codigo`.
+
+    ``estados`` son tuplas ``(codigo, estado, fecha, finsian)``; si un código
+    se repite, prevalece la última tupla, como con las sentencias por código.
+    """
 
+    por_codigo = {
+        (codigo or "").strip(): (estado, fechas.normalizar(fecha), finsian)
+        for codigo, estado, fecha, finsian in estados
+    }
+    if not por_codigo:
+        return 0
+    extras.execute_values(
+        cursor,
+        _SENTENCIA_ESTADO_POR_CODIGO_LOTE,
+        [(codigo,) + valores for codigo, valores in por_codigo.items()],
+        template="(%s, %s, %s::timestamp, %s::boolean)",
+        page_size=len(por_codigo),
+    )
+    SUMMARY.add("enviocedulanotificacionpolicia", "modificados", cursor.rowcount)
+    return cursor.rowcount
+
+
+@SUMMARY.cronometrar()
 def grabar_historico(
     estado,
     fecha_estado,
@@ -561,17 +1069,36 @@ def grabar_historico(
     pactuacionid,
     pdomicilioelectronicopj,
     CODIGO_SEGUIMIENTO,
+    sesion: Optional[SesionHistorial] = None,
 ):
     _log_step(
         "grabar_historico",
         "INICIO",
-        f"Actualizando registro {CODIGO_SEGUIMIENTO}",
+        "Actualizando registro %s",
+        CODIGO_SEGUIMIENTO,
     )
+    estado_texto = estado or ""
+    if sesion is not None and sesion.diferir_ultimo_estado:
+        sesion.diferir_envio(
+            estado_texto,
+            fecha_estado,
+            pmovimientoid,
+            pactuacionid,
+            pdomicilioelectronicopj,
+            CODIGO_SEGUIMIENTO,
+        )
+        _log_step(
+            "grabar_historico",
+            "OK",
+            "Registro %s se actualizará al confirmar el lote (%s)",
+            CODIGO_SEGUIMIENTO,
+            estado_texto,
+        )
+        return True
+
     try:
-        with psycopg2.connect(**pgsql_config) as conexion:
-            with conexion.cursor() as cursor:
-                estado_texto = estado or ""
-                fecha_estado_texto = _formatear_fecha_estado(fecha_estado)
+        with _usar_sesion(sesion) as sesion_activa:
+            with sesion_activa.conexion.cursor() as cursor:
                 _actualizar_envio_por_codigo(
                     cursor,
                     estado_texto,
@@ -585,108 +1112,37 @@ def grabar_historico(
                     pdomicilioelectronicopj,
                     CODIGO_SEGUIMIENTO,
                 )
-                conexion.commit()
-                _log_step(
-                    "grabar_historico",
-                    "OK",
-                    f"Registro {CODIGO_SEGUIMIENTO} actualizado ({estado_texto})",
-                )
-                return True
+        _log_step(
+            "grabar_historico",
+            "OK",
+            "Registro %s actualizado (%s)",
+            CODIGO_SEGUIMIENTO,
+            estado_texto,
+        )
+        return True
 
     except psycopg2.Error as e:
+        if sesion is not None:
+            sesion.revertir_codigo()
         _log_step(
             "grabar_historico",
             "ERROR",
-            f"Error al actualizar la base de datos: {e}",
+            "Error al actualizar la base de datos: %s",
+            e,
         )
     return False
 
 
-def _normalizar_estados(
-    estados: Iterable[ET.Element], namespaces: Dict[str, str]
-) -> List[Dict[str, Any]]:
-    _log_step("_normalizar_estados", "INICIO", "Normalizando estados recibidos")
-    def obtener_texto(node: ET.Element, tag: str) -> Optional[str]:
-        elemento = node.find(f"temp:{tag}", namespaces)
-        if elemento is None:
-            return None
-        if elemento.text is None:
-            return None
-        texto = elemento.text.strip()
-        return texto if texto else None
-
-    estados_normalizados = []
-
-    for estado_node in estados:
-        estado_id = obtener_texto(estado_node, "EstadoNotificacionId")
-        fecha_raw = obtener_texto(estado_node, "Fecha")
-        estados_normalizados.append(
-            {
-                "estado_id": int(estado_id) if estado_id else None,
-                "fecha": _parsear_fecha_estado_bd(fecha_raw),
-                "fecha_raw": fecha_raw,
-                "estado": obtener_texto(estado_node, "Estado"),
-                "observaciones": obtener_texto(estado_node, "Observaciones"),
-                "motivo": obtener_texto(estado_node, "Motivo"),
-                "responsable": obtener_texto(
-                    estado_node, "ResponsableNotificacion"
-                ),
-                "dependencia": obtener_texto(
-                    estado_node, "DependenciaNotificacion"
-                ),
-                "archivo_id": obtener_texto(estado_node, "ArchivoId"),
-                "archivo_nombre": obtener_texto(estado_node, "ArchivoNombre"),
-            }
-        )
-
-    _log_step(
-        "_normalizar_estados",
-        "OK",
-        f"Total estados normalizados: {len(estados_normalizados)}",
-    )
-    return estados_normalizados
-
-
-def _normalizar_fecha_para_comparacion(
-    fecha: Optional[Union[datetime, date, str]]
-) -> Optional[datetime]:
-    if fecha is None:
-        return None
-
-    if isinstance(fecha, str):
-        fecha_texto = fecha.strip()
-        if not fecha_texto:
-            return None
-
-        fecha_parseada = _parsear_fecha_estado_bd(fecha_texto)
-        if fecha_parseada is None:
-            try:
-                fecha_parseada = datetime.fromisoformat(
-                    fecha_texto.replace("Z", "+00:00")
-                )
-            except ValueError:
-                return None
-        fecha = fecha_parseada
-
-    if isinstance(fecha, date) and not isinstance(fecha, datetime):
-        fecha = datetime.combine(fecha, datetime.min.time())
-
-    if fecha.tzinfo is not None:
-        return fecha.replace(tzinfo=None)
-
-    return fecha
-
-
 def _filtrar_estados_nuevos(
     estados: Iterable[Dict[str, Any]],
     fecha_ultima_estado: Optional[datetime],
 ) -> List[Dict[str, Any]]:
-    fecha_ultima_normalizada = _normalizar_fecha_para_comparacion(fecha_ultima_estado)
+    fecha_ultima_normalizada = fechas.normalizar(fecha_ultima_estado)
     estados_filtrados: List[Dict[str, Any]] = []
 
     for estado in estados:
         fecha_estado = estado.get("fecha")
-        fecha_estado_normalizada = _normalizar_fecha_para_comparacion(fecha_estado)
+        fecha_estado_normalizada = fechas.normalizar(fecha_estado)
 
         if (
             fecha_ultima_normalizada is None
@@ -704,7 +1160,7 @@ def _construir_clave_estado(
     estado_texto: Optional[str],
 ) -> Tuple[Optional[int], Optional[datetime], str]:
     estado_norm = int(estado_id) if estado_id is not None else None
-    fecha_norm = _normalizar_fecha_para_comparacion(fecha)
+    fecha_norm = fechas.normalizar(fecha)
     texto_norm = (estado_texto or '').strip().upper()
     return estado_norm, fecha_norm, texto_norm
 
@@ -724,7 +1180,7 @@ def _obtener_claves_estados_existentes(
         WHERE pmovimientoid = %s
           AND pactuacionid = %s
           AND pdomicilioelectronicopj = %s
-          AND codigoseguimientomp = %s
+          AND codigoseguimientompnorm = TRIM(%s)
     """
     cursor.execute(
         consulta,
@@ -736,13 +1192,238 @@ def _obtener_claves_estados_existentes(
     return existentes
 
 
+_SENTENCIA_INSERTAR_NOTPOL = """
+    INSERT INTO notpolhistoricomp
+        (notpolhistoricomparchivoid, notpolhistoricomparchivonombre, notpolhistoricompestadonid,
+        notpolhistoricomparchcont, notpolhistoricompfecha, notpolhistoricompestado,
+        notpolhistoricompobservaciones, notpolhistoricompmotivo, notpolhistoricompresponsable,
+        notpolhistoricompdependencia, pmovimientoid, pactuacionid, pdomicilioelectronicopj,
+        codigoseguimientomp, notpolhistoricompfechats)
+    VALUES %s
+    ON CONFLICT DO NOTHING
+    RETURNING 1
+"""
+
+
+def _obtener_claves_estados_existentes_lote(
+    cursor: psycopg2.extensions.cursor,
+    envios: Iterable[Tuple[Any, Any, str, str]],
+) -> Dict[Tuple[Any, Any, str, str], set]:
+    """Claves de estado registradas para varios envíos en una sola consulta.
+
+    ``envios`` son tuplas ``(pmovimientoid, pactuacionid,
+    pdomicilioelectronicopj, codigo)``. El resultado tiene una entrada por
+    envío pedido (vacía si no tiene historial), con el código sin espacios
+    como en ``codigoseguimientompnorm``.
+    """
+
+    existentes: Dict[Tuple[Any, Any, str, str], set] = {
+        (pmovimientoid, pactuacionid, pdomicilioelectronicopj, (codigo or "").strip()): set()
+        for pmovimientoid, pactuacionid, pdomicilioelectronicopj, codigo in envios
+    }
+    if not existentes:
+        return existentes
+
+    cursor.execute(
+        """
+        SELECT pmovimientoid,
+               pactuacionid,
+               pdomicilioelectronicopj,
+               codigoseguimientompnorm,
+               notpolhistoricompestadonid,
+               notpolhistoricompfecha,
+               notpolhistoricompestado
+        FROM notpolhistoricomp
+        WHERE codigoseguimientompnorm = ANY(%s)
+        """,
+        (sorted({clave[3] for clave in existentes}),),
+    )
+    for (
+        pmovimientoid,
+        pactuacionid,
+        pdomicilioelectronicopj,
+        codigo,
+        estado_id,
+        fecha,
+        estado_texto,
+    ) in cursor.fetchall():
+        claves = existentes.get(
+            (pmovimientoid, pactuacionid, pdomicilioelectronicopj, codigo)
+        )
+        if claves is not None:
+            claves.add(_construir_clave_estado(estado_id, fecha, estado_texto))
+    return existentes
+
+
+def _filas_estados_nuevos(
+    estados: Iterable[Dict[str, Any]],
+    claves_existentes: set,
+    pmovimientoid,
+    pactuacionid,
+    pdomicilioelectronicopj,
+    CODIGO_SEGUIMIENTO,
+) -> List[Tuple[Any, ...]]:
+    """Filas de ``_SENTENCIA_INSERTAR_NOTPOL`` para los estados no registrados.
+
+    Agrega a ``claves_existentes`` las claves de las filas devueltas, de modo
+    que los estados repetidos dentro del mismo XML se omiten.
+    """
+
+    filas = []
+    for estado in estados:
+        clave = _construir_clave_estado(
+            estado.get('estado_id'),
+            estado.get('fecha'),
+            estado.get('estado'),
+        )
+        if clave in claves_existentes:
+            continue
+        claves_existentes.add(clave)
+        filas.append(
+            (
+                estado.get('archivo_id'),
+                estado.get('archivo_nombre'),
+                estado.get('estado_id'),
+                None,
+                estado.get('fecha'),
+                estado.get('estado'),
+                estado.get('observaciones'),
+                estado.get('motivo'),
+                estado.get('responsable'),
+                estado.get('dependencia'),
+                pmovimientoid,
+                pactuacionid,
+                pdomicilioelectronicopj,
+                CODIGO_SEGUIMIENTO,
+                clave[1],  # notpolhistoricompfechats, sin zona horaria
+            )
+        )
+    return filas
+
+
+def _insertar_filas_notpol(
+    cursor: psycopg2.extensions.cursor, filas: List[Tuple[Any, ...]]
+) -> int:
+    """Inserta ``filas`` en una sola sentencia y devuelve cuántas se agregaron."""
+
+    if not filas:
+        return 0
+    return len(
+        extras.execute_values(
+            cursor,
+            _SENTENCIA_INSERTAR_NOTPOL,
+            filas,
+            page_size=len(filas),
+            fetch=True,
+        )
+    )
+
+
+_SENTENCIA_ULTIMO_ESTADO_POR_CODIGO = """
+    INSERT INTO notpol_ultimo_estado (
+        codigoseguimientompnorm,
+        notpolhistoricompfechats,
+        notpolhistoricompfecha,
+        notpolhistoricompestado,
+        notpolhistoricompestadonid,
+        notpolhistoricomparchivoid,
+        actualizado
+    )
+    SELECT DISTINCT ON (codigoseguimientompnorm)
+           codigoseguimientompnorm,
+           notpolhistoricompfechats,
+           notpolhistoricompfecha,
+           notpolhistoricompestado,
+           notpolhistoricompestadonid,
+           notpolhistoricomparchivoid,
+           NOW()
+    FROM notpolhistoricomp
+    WHERE codigoseguimientompnorm = ANY(%s)
+    ORDER BY codigoseguimientompnorm,
+             notpolhistoricompfechats DESC NULLS LAST,
+             notpolhistoricompestadonid DESC NULLS LAST
+    ON CONFLICT (codigoseguimientompnorm) DO UPDATE
+    SET notpolhistoricompfechats = EXCLUDED.notpolhistoricompfechats,
+        notpolhistoricompfecha = EXCLUDED.notpolhistoricompfecha,
+        notpolhistoricompestado = EXCLUDED.notpolhistoricompestado,
+        notpolhistoricompestadonid = EXCLUDED.notpolhistoricompestadonid,
+        notpolhistoricomparchivoid = EXCLUDED.notpolhistoricomparchivoid,
+        actualizado = EXCLUDED.actualizado
+"""
+
+
+def _actualizar_ultimo_estado_codigos(
+    cursor: psycopg2.extensions.cursor, codigos: Iterable[str]
+) -> int:
+    """Recalcula ``notpol_ultimo_estado`` para ``codigos``.
+
+    Se ejecuta en la misma transacción que inserta el historial, así que la
+    tabla nunca queda adelantada ni atrasada respecto de ``notpolhistoricomp``.
+    """
+
+    codigos = sorted({(codigo or "").strip() for codigo in codigos} - {""})
+    if not codigos:
+        return 0
+    cursor.execute(_SENTENCIA_ULTIMO_ESTADO_POR_CODIGO, (codigos,))
+    return cursor.rowcount
+
+
+def _insertar_estados_notpol(
+    cursor: psycopg2.extensions.cursor,
+    estados: List[Dict[str, Any]],
+    pmovimientoid,
+    pactuacionid,
+    pdomicilioelectronicopj,
+    CODIGO_SEGUIMIENTO,
+    claves_existentes: Optional[set] = None,
+) -> Tuple[int, int]:
+    """Inserta en una sola sentencia los estados que todavía no existen.
+
+    ``claves_existentes`` son las claves precargadas del envío; si no se
+    indican se consultan. Si se agregan estados, también se actualiza
+    ``notpol_ultimo_estado``. Devuelve ``(insertados, ignorados)``; los
+    estados repetidos dentro del mismo XML se cuentan como ignorados.
+    """
+
+    if claves_existentes is None:
+        claves_existentes = _obtener_claves_estados_existentes(
+            cursor,
+            pmovimientoid,
+            pactuacionid,
+            pdomicilioelectronicopj,
+            CODIGO_SEGUIMIENTO,
+        )
+    filas = _filas_estados_nuevos(
+        estados,
+        claves_existentes,
+        pmovimientoid,
+        pactuacionid,
+        pdomicilioelectronicopj,
+        CODIGO_SEGUIMIENTO,
+    )
+    insertados = _insertar_filas_notpol(cursor, filas)
+    if insertados:
+        _actualizar_ultimo_estado_codigos(cursor, [CODIGO_SEGUIMIENTO])
+    return insertados, len(estados) - insertados
+
+
+@SUMMARY.cronometrar()
 def _guardar_historial_notpol(
     estados: Iterable[Dict[str, Any]],
     pmovimientoid,
     pactuacionid,
     pdomicilioelectronicopj,
     CODIGO_SEGUIMIENTO,
+    sesion: Optional[SesionHistorial] = None,
 ) -> int:
+    """Registra en ``notpolhistoricomp`` los estados nuevos del envío.
+
+    Con ``sesion`` se escribe en su transacción, que se confirma por lote, y
+    un error de base de datos se propaga para que quien llama revierta el
+    código y no lo dé por conciliado. Sin ella se abre una conexión propia y
+    se confirma al terminar.
+    """
+
     if not isinstance(estados, list):
         estados = list(estados)
 
@@ -750,120 +1431,61 @@ def _guardar_historial_notpol(
         _log_step(
             "_guardar_historial_notpol",
             "OK",
-            f"Sin estados para registrar en {CODIGO_SEGUIMIENTO}",
+            "Sin estados para registrar en %s",
+            CODIGO_SEGUIMIENTO,
         )
         return 0
 
-    insert_query = """INSERT INTO notpolhistoricomp \
-        (notpolhistoricomparchivoid, notpolhistoricomparchivonombre, notpolhistoricompestadonid, \
-        notpolhistoricomparchcont, notpolhistoricompfecha, notpolhistoricompestado, \
-        notpolhistoricompobservaciones, notpolhistoricompmotivo, notpolhistoricompresponsable, \
-        notpolhistoricompdependencia, pmovimientoid, pactuacionid, pdomicilioelectronicopj, \
-        codigoseguimientomp) \
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s) \
-        ON CONFLICT DO NOTHING;"""
+    _log_step(
+        "_guardar_historial_notpol",
+        "INICIO",
+        "Preparando inserción de %s estados para %s",
+        len(estados),
+        CODIGO_SEGUIMIENTO,
+    )
 
     try:
-        with psycopg2.connect(**pgsql_config) as conexion:
-            with conexion.cursor() as cursor:
-                total_estados = len(estados)
-                _log_step(
-                    "_guardar_historial_notpol",
-                    "INICIO",
-                    f"Preparando inserción de {total_estados} estados para {CODIGO_SEGUIMIENTO}",
-                )
-
-                claves_existentes = _obtener_claves_estados_existentes(
+        with _usar_sesion(sesion) as sesion_activa:
+            with sesion_activa.conexion.cursor() as cursor:
+                insertados, ignorados = _insertar_estados_notpol(
                     cursor,
+                    estados,
                     pmovimientoid,
                     pactuacionid,
                     pdomicilioelectronicopj,
                     CODIGO_SEGUIMIENTO,
-                )
-
-                insertados = 0
-                ignorados = 0
-                for estado in estados:
-                    clave = _construir_clave_estado(
-                        estado.get('estado_id'),
-                        estado.get('fecha'),
-                        estado.get('estado'),
-                    )
-                    if clave in claves_existentes:
-                        ignorados += 1
-                        continue
-
-                    valores = (
-                        estado.get('archivo_id'),
-                        estado.get('archivo_nombre'),
-                        estado.get('estado_id'),
-                        None,
-                        estado.get('fecha'),
-                        estado.get('estado'),
-                        estado.get('observaciones'),
-                        estado.get('motivo'),
-                        estado.get('responsable'),
-                        estado.get('dependencia'),
+                    sesion_activa.claves_precargadas(
                         pmovimientoid,
                         pactuacionid,
                         pdomicilioelectronicopj,
                         CODIGO_SEGUIMIENTO,
-                    )
-                    cursor.execute(insert_query, valores)
-                    if cursor.rowcount:
-                        insertados += 1
-                        claves_existentes.add(clave)
-
-            conexion.commit()
-            if insertados:
-                SUMMARY.add("notpolhistoricomp", "agregados", insertados)
-            if ignorados:
-                SUMMARY.add("notpolhistoricomp", "ignorados", ignorados)
-            _log_step(
-                "_guardar_historial_notpol",
-                "OK",
-                f"Historial guardado para {CODIGO_SEGUIMIENTO}. Nuevos registros: {insertados}",
-            )
-            return insertados
+                    ),
+                )
     except psycopg2.Error as e:
         _log_step(
             "_guardar_historial_notpol",
             "ERROR",
-            f"Error al insertar historial notificación en panel: {e}",
+            "Error al insertar historial notificación en panel: %s",
+            e,
         )
+        if sesion is not None:
+            raise
         return 0
 
+    if insertados:
+        SUMMARY.add("notpolhistoricomp", "agregados", insertados)
+    if ignorados:
+        SUMMARY.add("notpolhistoricomp", "ignorados", ignorados)
+    _log_step(
+        "_guardar_historial_notpol",
+        "OK",
+        "Historial guardado para %s. Nuevos registros: %s",
+        CODIGO_SEGUIMIENTO,
+        insertados,
+    )
+    return insertados
 
 
-def _parsear_fecha_estado_bd(fecha_estado: Optional[str]) -> Optional[datetime]:
-    if not fecha_estado:
-        return None
-
-    fecha = fecha_estado.strip()
-    if not fecha:
-        return None
-
-    fecha_normalizada = fecha.replace("Z", "+00:00")
-
-    formatos = [
-        "%Y-%m-%dT%H:%M:%S%z",
-        "%Y-%m-%dT%H:%M:%S.%f%z",
-        "%Y-%m-%dT%H:%M:%S",
-        "%Y-%m-%dT%H:%M:%S.%f",
-        "%Y-%m-%d %H:%M:%S",
-    ]
-
-    for formato in formatos:
-        try:
-            return datetime.strptime(fecha_normalizada, formato)
-        except ValueError:
-            continue
-
-    try:
-        return datetime.fromisoformat(fecha_normalizada)
-    except ValueError:
-        return None
-
 def _parse_args(argv: Optional[Iterable[str]] = None) -> argparse.Namespace:
     parser = argparse.ArgumentParser(
         description=(
@@ -879,13 +1501,17 @@ def _parse_args(argv: Optional[Iterable[str]] = None) -> argparse.Namespace:
             "seguimiento indicado."
         ),
     )
+    parser.add_argument(
+        "--reporte-json",
+        help="Guarda el resumen (conteos, tiempos por paso e idas a la base) en este archivo JSON.",
+    )
     return parser.parse_args(argv)
 
 
 def main(argv: Optional[Iterable[str]] = None) -> None:
     args = _parse_args(argv)
     pre_historial(codigodeseguimientomp=args.codigodeseguimientomp)
-    SUMMARY.imprimir()
+    SUMMARY.imprimir(args.reporte_json)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,733 @@
+"""Migraciones de esquema para las tablas de notificaciones del tablero SIAN.
+
+Cada migración agrupa sentencias idempotentes (``IF NOT EXISTS``) que pueden
+ejecutarse repetidamente sin efectos secundarios. Las sentencias usan el
+marcador ``{esquema}`` para poder aplicarse sobre ``public`` en producción o
+sobre tablas temporales (``pg_temp``) al generar reportes comparativos.
+
+Uso:
+    python migraciones.py --aplicar
+    python migraciones.py --aplicar codigo_normalizado
+    python migraciones.py --completar-fecha-historial --lote 5000
+    python migraciones.py --reconstruir-ultimo-estado
+    python migraciones.py --reporte-explain --filas 200000
+"""
+
+from __future__ import annotations
+
+import argparse
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import psycopg2
+
+from historialsian import _log_step, panel_config, pgsql_config
+
+
+BASE_PGSQL = "pgsql"
+BASE_PANEL = "panel"
+
+
+@dataclass(frozen=True)
+class Migracion:
+    """Conjunto de sentencias idempotentes aplicadas sobre una base."""
+
+    nombre: str
+    descripcion: str
+    base: str
+    sentencias: Tuple[str, ...]
+    # Paso por lotes que se ejecuta después de confirmar las sentencias.
+    completar: Optional[Callable[[psycopg2.extensions.connection, str], int]] = None
+
+
+SENTENCIAS_CODIGO_NORMALIZADO: Tuple[str, ...] = (
+    """
+    ALTER TABLE {esquema}.enviocedulanotificacionpolicia
+        ADD COLUMN IF NOT EXISTS codigoseguimientompnorm text
+        GENERATED ALWAYS AS (TRIM(codigoseguimientomp)) STORED
+    """,
+    """
+    ALTER TABLE {esquema}.notpolhistoricomp
+        ADD COLUMN IF NOT EXISTS codigoseguimientompnorm text
+        GENERATED ALWAYS AS (TRIM(codigoseguimientomp)) STORED
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_envio_notif_pol_codnorm
+        ON {esquema}.enviocedulanotificacionpolicia (codigoseguimientompnorm)
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_notpolhistoricomp_codnorm_fecha
+        ON {esquema}.notpolhistoricomp (
+            codigoseguimientompnorm,
+            notpolhistoricompfecha DESC
+        )
+    """,
+)
+
+
+SENTENCIAS_RETORNOMP_DIGEST: Tuple[str, ...] = (
+    """
+    ALTER TABLE {esquema}.retornomp
+        ADD COLUMN IF NOT EXISTS contenido_digest char(64)
+    """,
+    # El select-then-insert anterior de _almacenar_xml no era atómico: se
+    # conserva la fila más reciente de cada clave para poder crear el índice.
+    """
+    DELETE FROM {esquema}.retornomp AS r
+    USING (
+        SELECT ctid,
+               ROW_NUMBER() OVER (
+                   PARTITION BY pmovimientoid, pactuacionid, pdomicilioelectronicopj
+                   ORDER BY ultactualizacion DESC NULLS LAST, ctid DESC
+               ) AS orden
+        FROM {esquema}.retornomp
+        WHERE pmovimientoid IS NOT NULL
+          AND pactuacionid IS NOT NULL
+          AND pdomicilioelectronicopj IS NOT NULL
+    ) AS duplicados
+    WHERE r.ctid = duplicados.ctid
+      AND duplicados.orden > 1
+    """,
+    """
+    UPDATE {esquema}.retornomp
+    SET contenido_digest = encode(sha256(convert_to(contenido_xml::text, 'UTF8')), 'hex')
+    WHERE contenido_digest IS NULL
+      AND contenido_xml IS NOT NULL
+    """,
+    """
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_retornomp_claves
+        ON {esquema}.retornomp (pmovimientoid, pactuacionid, pdomicilioelectronicopj)
+    """,
+)
+
+
+SENTENCIAS_ARCHIVOS_POR_CONTENIDO: Tuple[str, ...] = (
+    """
+    CREATE TABLE IF NOT EXISTS {esquema}.archivomp (
+        digest char(64) PRIMARY KEY,
+        tamano integer,
+        contenido text NOT NULL,
+        fechaalta timestamp NOT NULL DEFAULT NOW()
+    )
+    """,
+    """
+    ALTER TABLE {esquema}.enviocedulanotificacionpolicia
+        ADD COLUMN IF NOT EXISTS ecedarchivoseguimientodigest char(64),
+        ADD COLUMN IF NOT EXISTS ecedarchivoseguimientotamano integer
+    """,
+    """
+    ALTER TABLE {esquema}.notpolhistoricomp
+        ADD COLUMN IF NOT EXISTS notpolhistoricomparchdigest char(64),
+        ADD COLUMN IF NOT EXISTS notpolhistoricomparchtamano integer
+    """,
+    """
+    INSERT INTO {esquema}.archivomp (digest, tamano, contenido)
+    SELECT encode(sha256(convert_to(contenido, 'UTF8')), 'hex'),
+           length(contenido),
+           contenido
+    FROM (
+        SELECT ecedarchivoseguimientodatos::text AS contenido
+        FROM {esquema}.enviocedulanotificacionpolicia
+        WHERE COALESCE(ecedarchivoseguimientodatos::text, '') <> ''
+        UNION
+        SELECT notpolhistoricomparchcont::text
+        FROM {esquema}.notpolhistoricomp
+        WHERE COALESCE(notpolhistoricomparchcont::text, '') <> ''
+    ) AS contenidos
+    ON CONFLICT (digest) DO NOTHING
+    """,
+    """
+    UPDATE {esquema}.enviocedulanotificacionpolicia
+    SET ecedarchivoseguimientodigest = encode(
+            sha256(convert_to(ecedarchivoseguimientodatos::text, 'UTF8')), 'hex'
+        ),
+        ecedarchivoseguimientotamano = length(ecedarchivoseguimientodatos::text),
+        ecedarchivoseguimientodatos = NULL
+    WHERE COALESCE(ecedarchivoseguimientodatos::text, '') <> ''
+    """,
+    """
+    UPDATE {esquema}.notpolhistoricomp
+    SET notpolhistoricomparchdigest = encode(
+            sha256(convert_to(notpolhistoricomparchcont::text, 'UTF8')), 'hex'
+        ),
+        notpolhistoricomparchtamano = length(notpolhistoricomparchcont::text),
+        notpolhistoricomparchcont = NULL
+    WHERE COALESCE(notpolhistoricomparchcont::text, '') <> ''
+    """,
+)
+
+
+SENTENCIAS_PERMANENCIA_ESTADOS: Tuple[str, ...] = (
+    """
+    CREATE TABLE IF NOT EXISTS {esquema}.permanenciaestado (
+        estado text NOT NULL,
+        cubeta smallint NOT NULL,
+        cantidad bigint NOT NULL DEFAULT 0,
+        PRIMARY KEY (estado, cubeta)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS {esquema}.permanenciamarca (
+        id boolean PRIMARY KEY DEFAULT TRUE CHECK (id),
+        procesado_hasta timestamp,
+        actualizado timestamp
+    )
+    """,
+    """
+    ALTER TABLE {esquema}.enviocedulanotificacionpolicia
+        ADD COLUMN IF NOT EXISTS proximaconsultasian timestamp
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_envio_notif_pol_proxima
+        ON {esquema}.enviocedulanotificacionpolicia (proximaconsultasian)
+    """,
+    # La marca incremental se compara con el alta de cada fila del historial.
+    # Las filas existentes toman el momento de la migración.
+    """
+    ALTER TABLE {esquema}.notpolhistoricomp
+        ADD COLUMN IF NOT EXISTS notpolhistoricompalta timestamp DEFAULT NOW()
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_notpolhistoricomp_alta
+        ON {esquema}.notpolhistoricomp (notpolhistoricompalta)
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS {esquema}.permanenciacodigo (
+        codigo text NOT NULL,
+        estado text NOT NULL,
+        cubeta smallint NOT NULL,
+        cantidad bigint NOT NULL,
+        PRIMARY KEY (codigo, estado, cubeta)
+    )
+    """,
+    # Los histogramas anteriores no tienen aporte por código: mientras
+    # permanenciacodigo esté vacía se descartan y la próxima actualización
+    # recalcula todos los códigos.
+    """
+    DELETE FROM {esquema}.permanenciaestado
+    WHERE NOT EXISTS (SELECT 1 FROM {esquema}.permanenciacodigo)
+    """,
+    """
+    UPDATE {esquema}.permanenciamarca
+    SET procesado_hasta = NULL
+    WHERE NOT EXISTS (SELECT 1 FROM {esquema}.permanenciacodigo)
+    """,
+)
+
+
+SENTENCIAS_FECHA_HISTORIAL_TIPADA: Tuple[str, ...] = (
+    """
+    ALTER TABLE {esquema}.notpolhistoricomp
+        ADD COLUMN IF NOT EXISTS notpolhistoricompfechats timestamp
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_notpolhistoricomp_codnorm_fechats
+        ON {esquema}.notpolhistoricomp (
+            codigoseguimientompnorm,
+            notpolhistoricompfechats DESC NULLS LAST
+        )
+        INCLUDE (
+            notpolhistoricompestado,
+            notpolhistoricompestadonid,
+            notpolhistoricomparchivoid
+        )
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_notpolhistoricomp_claves_fechats
+        ON {esquema}.notpolhistoricomp (
+            pmovimientoid,
+            pactuacionid,
+            pdomicilioelectronicopj,
+            notpolhistoricompfechats DESC NULLS LAST
+        )
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_notpolhistoricomp_fechats
+        ON {esquema}.notpolhistoricomp (notpolhistoricompfechats)
+    """,
+)
+
+# Solo se convierten las fechas ISO ('T' o espacio, con o sin fracción/zona);
+# las demás quedan en NULL y no se vuelven a seleccionar.
+_SENTENCIA_COMPLETAR_FECHA_HISTORIAL = r"""
+    UPDATE {esquema}.notpolhistoricomp
+    SET notpolhistoricompfechats = to_timestamp(
+            left(replace(notpolhistoricompfecha, 'T', ' '), 19),
+            'YYYY-MM-DD HH24:MI:SS'
+        )::timestamp
+    WHERE ctid = ANY(ARRAY(
+        SELECT ctid
+        FROM {esquema}.notpolhistoricomp
+        WHERE notpolhistoricompfechats IS NULL
+          AND notpolhistoricompfecha ~ '^\d{{4}}-\d{{2}}-\d{{2}}[T ]\d{{2}}:\d{{2}}:\d{{2}}'
+        LIMIT %s
+    ))
+"""
+
+
+def completar_fecha_historial(
+    conexion: psycopg2.extensions.connection,
+    esquema: str = "public",
+    lote: int = 10000,
+) -> int:
+    """Completa ``notpolhistoricompfechats`` por lotes confirmados.
+
+    Cada lote es una transacción corta, de modo que la tabla no queda
+    bloqueada durante todo el relleno. Las fechas que no respetan el formato
+    ISO quedan en ``NULL``. Devuelve la cantidad de filas actualizadas.
+    """
+
+    sentencia = _SENTENCIA_COMPLETAR_FECHA_HISTORIAL.format(esquema=esquema)
+    total = 0
+    while True:
+        with conexion.cursor() as cursor:
+            cursor.execute(sentencia, (lote,))
+            actualizadas = cursor.rowcount
+        conexion.commit()
+        total += actualizadas
+        if actualizadas < lote:
+            break
+        _log_step(
+            "completar_fecha_historial", "OK", "Filas completadas: %s", total
+        )
+    _log_step(
+        "completar_fecha_historial",
+        "OK",
+        "notpolhistoricompfechats completada (%s filas)",
+        total,
+    )
+    return total
+
+
+SENTENCIAS_ULTIMO_ESTADO_POR_CODIGO: Tuple[str, ...] = (
+    """
+    CREATE TABLE IF NOT EXISTS {esquema}.notpol_ultimo_estado (
+        codigoseguimientompnorm text PRIMARY KEY,
+        notpolhistoricompfechats timestamp,
+        notpolhistoricompfecha varchar(40),
+        notpolhistoricompestado varchar(100),
+        notpolhistoricompestadonid numeric,
+        notpolhistoricomparchivoid numeric,
+        actualizado timestamp NOT NULL DEFAULT NOW()
+    )
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_notpol_ultimo_estado_estado
+        ON {esquema}.notpol_ultimo_estado (
+            LOWER(COALESCE(notpolhistoricompestado, ''))
+        )
+        INCLUDE (notpolhistoricompfechats, notpolhistoricomparchivoid)
+    """,
+)
+
+_SENTENCIA_RECONSTRUIR_ULTIMO_ESTADO = """
+    INSERT INTO {esquema}.notpol_ultimo_estado (
+        codigoseguimientompnorm,
+        notpolhistoricompfechats,
+        notpolhistoricompfecha,
+        notpolhistoricompestado,
+        notpolhistoricompestadonid,
+        notpolhistoricomparchivoid
+    )
+    SELECT DISTINCT ON (codigoseguimientompnorm)
+           codigoseguimientompnorm,
+           notpolhistoricompfechats,
+           notpolhistoricompfecha,
+           notpolhistoricompestado,
+           notpolhistoricompestadonid,
+           notpolhistoricomparchivoid
+    FROM {esquema}.notpolhistoricomp
+    WHERE codigoseguimientompnorm <> ''
+    ORDER BY codigoseguimientompnorm,
+             notpolhistoricompfechats DESC NULLS LAST,
+             notpolhistoricompestadonid DESC NULLS LAST
+"""
+
+
+def reconstruir_ultimo_estado(
+    conexion: psycopg2.extensions.connection,
+    esquema: str = "public",
+) -> int:
+    """Recalcula ``notpol_ultimo_estado`` desde ``notpolhistoricomp``.
+
+    Se vacía y se vuelve a cargar en una sola transacción, de modo que los
+    lectores ven la tabla anterior hasta la confirmación. Es necesario después
+    de cargar historial por fuera de ``historialsian`` (por ejemplo, a mano o
+    desde otros sistemas). Devuelve la cantidad de códigos.
+    """
+
+    _log_step("reconstruir_ultimo_estado", "INICIO", "Recalculando notpol_ultimo_estado")
+    with conexion.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {esquema}.notpol_ultimo_estado")
+        cursor.execute(_SENTENCIA_RECONSTRUIR_ULTIMO_ESTADO.format(esquema=esquema))
+        total = cursor.rowcount
+    conexion.commit()
+    _log_step(
+        "reconstruir_ultimo_estado",
+        "OK",
+        "notpol_ultimo_estado reconstruida (%s códigos)",
+        total,
+    )
+    return total
+
+
+MIGRACIONES: Tuple[Migracion, ...] = (
+    Migracion(
+        nombre="codigo_normalizado",
+        descripcion=(
+            "Columna codigoseguimientompnorm (TRIM generado) e índices en "
+            "enviocedulanotificacionpolicia y notpolhistoricomp"
+        ),
+        base=BASE_PGSQL,
+        sentencias=SENTENCIAS_CODIGO_NORMALIZADO,
+    ),
+    Migracion(
+        nombre="retornomp_digest",
+        descripcion=(
+            "Digest SHA-256 de contenido_xml en retornomp, depuración de "
+            "duplicados y clave única para el upsert de _almacenar_xml"
+        ),
+        base=BASE_PANEL,
+        sentencias=SENTENCIAS_RETORNOMP_DIGEST,
+    ),
+    Migracion(
+        nombre="archivos_por_contenido",
+        descripcion=(
+            "Tabla archivomp direccionada por SHA-256; los archivos de "
+            "enviocedulanotificacionpolicia y notpolhistoricomp se mueven allí "
+            "y las tablas conservan digest y tamaño"
+        ),
+        base=BASE_PGSQL,
+        sentencias=SENTENCIAS_ARCHIVOS_POR_CONTENIDO,
+    ),
+    Migracion(
+        nombre="permanencia_estados",
+        descripcion=(
+            "Histogramas de permanencia por estado (permanenciaestado) con "
+            "aporte por código (permanenciacodigo), marca de actualización "
+            "incremental sobre notpolhistoricompalta y columna indexada "
+            "proximaconsultasian en enviocedulanotificacionpolicia"
+        ),
+        base=BASE_PGSQL,
+        sentencias=SENTENCIAS_PERMANENCIA_ESTADOS,
+    ),
+    Migracion(
+        nombre="fecha_historial_tipada",
+        descripcion=(
+            "Columna notpolhistoricompfechats (timestamp) completada por lotes "
+            "desde notpolhistoricompfecha e índices (código, fecha DESC) para "
+            "obtener el último estado sin ordenar la tabla"
+        ),
+        base=BASE_PGSQL,
+        sentencias=SENTENCIAS_FECHA_HISTORIAL_TIPADA,
+        completar=completar_fecha_historial,
+    ),
+    Migracion(
+        nombre="ultimo_estado_por_codigo",
+        descripcion=(
+            "Tabla notpol_ultimo_estado con el último estado de cada código "
+            "normalizado, mantenida por historialsian al registrar el "
+            "historial e indexada por estado"
+        ),
+        base=BASE_PGSQL,
+        sentencias=SENTENCIAS_ULTIMO_ESTADO_POR_CODIGO,
+        completar=reconstruir_ultimo_estado,
+    ),
+)
+
+
+def _configuracion_base(base: str) -> Dict[str, str]:
+    if base == BASE_PANEL:
+        return panel_config
+    return pgsql_config
+
+
+def aplicar_migracion(
+    conexion: psycopg2.extensions.connection,
+    migracion: Migracion,
+    esquema: str = "public",
+) -> None:
+    """Ejecuta las sentencias de ``migracion`` en una única transacción."""
+
+    _log_step("aplicar_migracion", "INICIO", "Aplicando %s", migracion.nombre)
+    with conexion.cursor() as cursor:
+        for sentencia in migracion.sentencias:
+            cursor.execute(sentencia.format(esquema=esquema))
+    conexion.commit()
+    if migracion.completar is not None:
+        migracion.completar(conexion, esquema)
+    _log_step("aplicar_migracion", "OK", "Migración %s aplicada", migracion.nombre)
+
+
+def aplicar_migraciones(nombres: Optional[Iterable[str]] = None) -> List[str]:
+    """Aplica las migraciones indicadas (o todas) sobre las bases configuradas."""
+
+    seleccion = set(nombres or ())
+    desconocidas = seleccion - {migracion.nombre for migracion in MIGRACIONES}
+    if desconocidas:
+        raise ValueError(
+            "Migraciones desconocidas: " + ", ".join(sorted(desconocidas))
+        )
+
+    aplicadas: List[str] = []
+    for migracion in MIGRACIONES:
+        if seleccion and migracion.nombre not in seleccion:
+            continue
+        with psycopg2.connect(**_configuracion_base(migracion.base)) as conexion:
+            aplicar_migracion(conexion, migracion)
+        aplicadas.append(migracion.nombre)
+    return aplicadas
+
+
+# --- Reporte EXPLAIN ANALYZE sobre datos sintéticos -------------------------
+
+_SENTENCIAS_DATOS_SINTETICOS: Tuple[str, ...] = (
+    """
+    CREATE TEMP TABLE enviocedulanotificacionpolicia (
+        pmovimientoid numeric,
+        pactuacionid numeric,
+        pdomicilioelectronicopj varchar(200),
+        codigoseguimientomp varchar(100),
+        laststagesian varchar(100),
+        fechalaststate timestamp
+    ) ON COMMIT DROP
+    """,
+    """
+    CREATE TEMP TABLE notpolhistoricomp (
+        pmovimientoid numeric,
+        pactuacionid numeric,
+        pdomicilioelectronicopj varchar(200),
+        codigoseguimientomp varchar(100),
+        notpolhistoricompestadonid numeric,
+        notpolhistoricompfecha varchar(40),
+        notpolhistoricompestado varchar(100),
+        notpolhistoricomparchivoid numeric
+    ) ON COMMIT DROP
+    """,
+    """
+    INSERT INTO enviocedulanotificacionpolicia
+    SELECT i, i, 'dom' || i || '@test',
+           CASE WHEN i %% 7 = 0 THEN ' ' ELSE '' END || 'MP' || lpad(i::text, 8, '0')
+               || CASE WHEN i %% 5 = 0 THEN '  ' ELSE '' END,
+           (ARRAY['Pendiente', 'Enviada', 'En Notificaciones', 'Entregada'])[1 + i %% 4],
+           now() - (i %% 60) * interval '1 day'
+    FROM generate_series(1, %(codigos)s) AS i
+    """,
+    """
+    INSERT INTO notpolhistoricomp
+    SELECT e.pmovimientoid, e.pactuacionid, e.pdomicilioelectronicopj,
+           e.codigoseguimientomp, s,
+           to_char(now() - (10 - s) * interval '1 day', 'YYYY-MM-DD"T"HH24:MI:SS'),
+           (ARRAY['Pendiente', 'Enviada', 'En Notificaciones', 'Entregada'])[1 + s %% 4],
+           CASE WHEN s %% 3 = 0 THEN s ELSE 0 END
+    FROM enviocedulanotificacionpolicia AS e
+    CROSS JOIN generate_series(1, %(estados_por_codigo)s) AS s
+    """,
+)
+
+_CONSULTAS_REPORTE: Tuple[Tuple[str, str, str], ...] = (
+    (
+        "Último estado de un código (_obtener_fecha_historial)",
+        """
+        SELECT notpolhistoricompfecha
+        FROM notpolhistoricomp
+        WHERE TRIM(codigoseguimientomp) = TRIM(%(codigo)s)
+        ORDER BY notpolhistoricompfecha DESC NULLS LAST
+        LIMIT 1
+        """,
+        """
+        SELECT notpolhistoricompfecha
+        FROM notpolhistoricomp
+        WHERE codigoseguimientompnorm = TRIM(%(codigo)s)
+        ORDER BY notpolhistoricompfecha DESC NULLS LAST
+        LIMIT 1
+        """,
+    ),
+    (
+        "Envíos por código (_actualizar_envio_por_codigo)",
+        """
+        SELECT pmovimientoid, pactuacionid, pdomicilioelectronicopj
+        FROM enviocedulanotificacionpolicia
+        WHERE TRIM(codigoseguimientomp) = TRIM(%(codigo)s)
+        """,
+        """
+        SELECT pmovimientoid, pactuacionid, pdomicilioelectronicopj
+        FROM enviocedulanotificacionpolicia
+        WHERE codigoseguimientompnorm = TRIM(%(codigo)s)
+        """,
+    ),
+    (
+        "Último archivo por envío (_obtener_envios)",
+        """
+        SELECT count(*)
+        FROM enviocedulanotificacionpolicia AS env
+        WHERE EXISTS (
+            SELECT 1
+            FROM (
+                SELECT n.notpolhistoricomparchivoid
+                FROM notpolhistoricomp AS n
+                WHERE TRIM(n.codigoseguimientomp) = TRIM(env.codigoseguimientomp)
+                ORDER BY n.notpolhistoricompfecha DESC NULLS LAST
+                LIMIT 1
+            ) AS ultimo_archivo
+            WHERE ultimo_archivo.notpolhistoricomparchivoid <> 0
+        )
+          AND env.laststagesian = 'Entregada'
+        """,
+        """
+        SELECT count(*)
+        FROM enviocedulanotificacionpolicia AS env
+        WHERE EXISTS (
+            SELECT 1
+            FROM (
+                SELECT n.notpolhistoricomparchivoid
+                FROM notpolhistoricomp AS n
+                WHERE n.codigoseguimientompnorm = env.codigoseguimientompnorm
+                ORDER BY n.notpolhistoricompfecha DESC NULLS LAST
+                LIMIT 1
+            ) AS ultimo_archivo
+            WHERE ultimo_archivo.notpolhistoricomparchivoid <> 0
+        )
+          AND env.laststagesian = 'Entregada'
+        """,
+    ),
+)
+
+
+def _explain_analyze(
+    cursor: psycopg2.extensions.cursor, consulta: str, parametros: Dict[str, object]
+) -> str:
+    cursor.execute("EXPLAIN (ANALYZE, BUFFERS) " + consulta, parametros)
+    return "\n".join(fila[0] for fila in cursor.fetchall())
+
+
+def reporte_explain_codigo_normalizado(
+    conexion: psycopg2.extensions.connection,
+    codigos: int = 20000,
+    estados_por_codigo: int = 10,
+) -> str:
+    """Compara planes antes y después de ``codigo_normalizado``.
+
+    Los datos sintéticos se cargan en tablas temporales que ocultan a las de
+    ``public`` durante la transacción, que siempre se revierte al finalizar.
+    """
+
+    parametros_carga = {"codigos": codigos, "estados_por_codigo": estados_por_codigo}
+    parametros_consulta = {"codigo": f"MP{codigos // 2:08d}"}
+    secciones: List[str] = [
+        "Reporte EXPLAIN ANALYZE: codigo_normalizado",
+        f"Envíos sintéticos: {codigos}, estados por código: {estados_por_codigo}",
+    ]
+
+    try:
+        with conexion.cursor() as cursor:
+            for sentencia in _SENTENCIAS_DATOS_SINTETICOS:
+                cursor.execute(sentencia, parametros_carga)
+            cursor.execute("ANALYZE enviocedulanotificacionpolicia")
+            cursor.execute("ANALYZE notpolhistoricomp")
+
+            planes_antes = [
+                _explain_analyze(cursor, antes, parametros_consulta)
+                for _, antes, _ in _CONSULTAS_REPORTE
+            ]
+
+            for sentencia in SENTENCIAS_CODIGO_NORMALIZADO:
+                cursor.execute(sentencia.format(esquema="pg_temp"))
+            cursor.execute("ANALYZE enviocedulanotificacionpolicia")
+            cursor.execute("ANALYZE notpolhistoricomp")
+
+            planes_despues = [
+                _explain_analyze(cursor, despues, parametros_consulta)
+                for _, _, despues in _CONSULTAS_REPORTE
+            ]
+    finally:
+        conexion.rollback()
+
+    for (titulo, _, _), antes, despues in zip(
+        _CONSULTAS_REPORTE, planes_antes, planes_despues
+    ):
+        secciones.extend(
+            [
+                "",
+                f"== {titulo} ==",
+                "-- Antes (TRIM(codigoseguimientomp)):",
+                antes,
+                "-- Después (codigoseguimientompnorm):",
+                despues,
+            ]
+        )
+    return "\n".join(secciones)
+
+
+def _parse_args(argv: Optional[Sequence[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Aplica migraciones de esquema del tablero SIAN."
+    )
+    parser.add_argument(
+        "--aplicar",
+        nargs="*",
+        metavar="NOMBRE",
+        help=(
+            "Aplica las migraciones indicadas; sin nombres se aplican todas. "
+            "Disponibles: " + ", ".join(m.nombre for m in MIGRACIONES)
+        ),
+    )
+    parser.add_argument(
+        "--reporte-explain",
+        action="store_true",
+        help=(
+            "Genera un reporte EXPLAIN ANALYZE antes/después sobre datos "
+            "sintéticos en tablas temporales."
+        ),
+    )
+    parser.add_argument(
+        "--filas",
+        type=int,
+        default=20000,
+        help="Cantidad de envíos sintéticos para el reporte.",
+    )
+    parser.add_argument(
+        "--completar-fecha-historial",
+        action="store_true",
+        help=(
+            "Completa notpolhistoricompfechats en las filas que aún no la "
+            "tienen (por ejemplo, cargadas por otros procesos)."
+        ),
+    )
+    parser.add_argument(
+        "--reconstruir-ultimo-estado",
+        action="store_true",
+        help=(
+            "Recalcula notpol_ultimo_estado desde notpolhistoricomp (después de "
+            "cargas de historial hechas por fuera de historialsian)."
+        ),
+    )
+    parser.add_argument(
+        "--lote",
+        type=int,
+        default=10000,
+        help="Filas por transacción al completar notpolhistoricompfechats.",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    args = _parse_args(argv)
+    if args.aplicar is not None:
+        for nombre in aplicar_migraciones(args.aplicar):
+            print(f"Migración aplicada: {nombre}")
+    if args.completar_fecha_historial:
+        with psycopg2.connect(**pgsql_config) as conexion:
+            total = completar_fecha_historial(conexion, lote=args.lote)
+        print(f"Filas completadas: {total}")
+    if args.reconstruir_ultimo_estado:
+        with psycopg2.connect(**pgsql_config) as conexion:
+            total = reconstruir_ultimo_estado(conexion)
+        print(f"Códigos en notpol_ultimo_estado: {total}")
+    if args.reporte_explain:
+        with psycopg2.connect(**pgsql_config) as conexion:
+            print(reporte_explain_codigo_normalizado(conexion, codigos=args.filas))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,383 @@
+"""Servidor local que simula ``wsNotificacion.asmx`` del Ministerio Público.
+
+Atiende ``ObtenerEstadoNotificacion`` y ``ObtenerArchivoEstadoNotificacion`` a
+partir de un corpus de historiales generado de forma determinista por código
+de seguimiento, para ejercitar ``retornoxmlmp``, ``retornoporestado`` y
+``soap_notificacion`` sin consultar ``pruebasian.mpublico.gov.ar``. Permite
+configurar la latencia (distribución log-normal por mediana y p95), ráfagas de
+``HTTP 429`` con ``Retry-After``, errores 5xx y el tamaño de los archivos.
+
+Para apuntar los scripts al simulador se define ``MP_SOAP_HOST``:
+
+    python mp_simulado.py --puerto 8089 --latencia-mediana 0.2 --latencia-p95 1.5
+    MP_SOAP_HOST=http://127.0.0.1:8089 python retornoxmlmp.py --test
+"""
+
+from __future__ import annotations
+
+import argparse
+import base64
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import math
+import random
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+from xml.sax.saxutils import escape
+import xml.etree.ElementTree as ET
+
+
+RUTA_SERVICIO = "/services/wsNotificacion.asmx"
+ACCION_ESTADO = "http://tempuri.org/ObtenerEstadoNotificacion"
+ACCION_ARCHIVO = "http://tempuri.org/ObtenerArchivoEstadoNotificacion"
+
+XML_NAMESPACES = {
+    "soap": "http://schemas.xmlsoap.org/soap/envelope/",
+    "temp": "http://tempuri.org/",
+}
+
+# Secuencia típica de estados de una cédula; cada historial recorre un prefijo.
+SECUENCIA_ESTADOS: Tuple[str, ...] = (
+    "Ingresada",
+    "Pendiente",
+    "Enviada",
+    "En Dep. Policial",
+    "En Notificaciones",
+    "Entregada",
+    "Finalizada",
+)
+ESTADOS_CON_ARCHIVO = ("Entregada", "No entregada", "Finalizada")
+
+_BLOQUE_ARCHIVO = 48 * 1024  # múltiplo de 3: el base64 de cada bloque se concatena
+
+
+@dataclass(frozen=True)
+class ConfiguracionSimulador:
+    """Parámetros de comportamiento del servicio simulado."""
+
+    latencia_mediana: float = 0.0
+    latencia_p95: float = 0.0
+    probabilidad_rafaga_429: float = 0.0
+    duracion_rafaga_429: float = 5.0
+    probabilidad_5xx: float = 0.0
+    probabilidad_cambio: float = 0.0
+    tamano_archivo: int = 64 * 1024
+    semilla: int = 0
+
+    def sortear_latencia(self, azar: random.Random) -> float:
+        if self.latencia_mediana <= 0:
+            return 0.0
+        sigma = 0.0
+        if self.latencia_p95 > self.latencia_mediana:
+            sigma = math.log(self.latencia_p95 / self.latencia_mediana) / 1.645
+        return azar.lognormvariate(math.log(self.latencia_mediana), sigma)
+
+
+@dataclass(frozen=True)
+class EstadoSimulado:
+    estado_id: int
+    fecha: datetime
+    estado: str
+    archivo_id: int
+
+
+def _semilla_codigo(codigo: str, semilla: int) -> int:
+    resumen = hashlib.sha256(f"{semilla}:{codigo}".encode("utf-8")).digest()
+    return int.from_bytes(resumen[:8], "big")
+
+
+def generar_historial(
+    codigo: str, semilla: int = 0, cambios: int = 0
+) -> List[EstadoSimulado]:
+    """Historial determinista de ``codigo`` más ``cambios`` estados nuevos."""
+
+    azar = random.Random(_semilla_codigo(codigo, semilla))
+    base_id = azar.randrange(100_000, 900_000) * 10
+    cantidad = min(azar.randint(1, len(SECUENCIA_ESTADOS)) + cambios, len(SECUENCIA_ESTADOS))
+    fecha = datetime(2025, 1, 1) + timedelta(minutes=azar.randrange(0, 60 * 24 * 300))
+
+    historial = []
+    for indice, estado in enumerate(SECUENCIA_ESTADOS[:cantidad]):
+        if estado == "Entregada" and azar.random() < 0.2:
+            estado = "No entregada"
+        estado_id = base_id + indice
+        historial.append(
+            EstadoSimulado(
+                estado_id=estado_id,
+                fecha=fecha,
+                estado=estado,
+                archivo_id=estado_id * 10 if estado in ESTADOS_CON_ARCHIVO else 0,
+            )
+        )
+        fecha += timedelta(hours=azar.lognormvariate(math.log(36), 1.2))
+    return historial
+
+
+def _xml_estado(codigo: str, historial: Sequence[EstadoSimulado]) -> str:
+    estados = "".join(
+        "<tem:EstadoNotificacion>"
+        f"<tem:EstadoNotificacionId>{registro.estado_id}</tem:EstadoNotificacionId>"
+        f"<tem:Fecha>{registro.fecha:%Y-%m-%dT%H:%M:%S}</tem:Fecha>"
+        f"<tem:Estado>{escape(registro.estado)}</tem:Estado>"
+        "<tem:Observaciones>Generado por mp_simulado</tem:Observaciones>"
+        "<tem:Motivo></tem:Motivo>"
+        "<tem:ResponsableNotificacion>Agente simulado</tem:ResponsableNotificacion>"
+        "<tem:DependenciaNotificacion>Comisaría simulada</tem:DependenciaNotificacion>"
+        f"<tem:ArchivoId>{registro.archivo_id}</tem:ArchivoId>"
+        + (
+            f"<tem:ArchivoNombre>{registro.archivo_id}.pdf</tem:ArchivoNombre>"
+            if registro.archivo_id
+            else ""
+        )
+        + "</tem:EstadoNotificacion>"
+        for registro in historial
+    )
+    return (
+        '<?xml version="1.0" encoding="utf-8"?>'
+        '<soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/" '
+        'xmlns:tem="http://tempuri.org/"><soapenv:Body>'
+        "<tem:ObtenerEstadoNotificacionResponse><tem:ObtenerEstadoNotificacionResult>"
+        f"<tem:CodigoSeguimiento>{escape(codigo)}</tem:CodigoSeguimiento>"
+        f"<tem:HistorialEstados>{estados}</tem:HistorialEstados>"
+        "</tem:ObtenerEstadoNotificacionResult></tem:ObtenerEstadoNotificacionResponse>"
+        "</soapenv:Body></soapenv:Envelope>"
+    )
+
+
+def _partes_xml_archivo(estado_id: str, tamano: int) -> Tuple[bytes, bytes, int]:
+    archivo_id = int(estado_id) * 10 if estado_id.isdigit() else 0
+    prefijo = (
+        '<?xml version="1.0" encoding="utf-8"?>'
+        '<soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/" '
+        'xmlns:tem="http://tempuri.org/"><soapenv:Body>'
+        "<tem:ObtenerArchivoEstadoNotificacionResponse>"
+        "<tem:ObtenerArchivoEstadoNotificacionResult>"
+        f"<tem:ArchivoId>{archivo_id}</tem:ArchivoId>"
+        f"<tem:ArchivoNombre>{archivo_id}.pdf</tem:ArchivoNombre>"
+        "<tem:ArchivoContenido>"
+    ).encode("utf-8")
+    sufijo = (
+        "</tem:ArchivoContenido>"
+        "</tem:ObtenerArchivoEstadoNotificacionResult>"
+        "</tem:ObtenerArchivoEstadoNotificacionResponse>"
+        "</soapenv:Body></soapenv:Envelope>"
+    ).encode("utf-8")
+    return prefijo, sufijo, 4 * math.ceil(tamano / 3)
+
+
+def _fragmentos_archivo(estado_id: str, tamano: int) -> Iterator[bytes]:
+    """Contenido base64 del archivo generado por bloques, sin armarlo entero."""
+
+    bloque = hashlib.sha256(estado_id.encode("utf-8")).digest() * (_BLOQUE_ARCHIVO // 32)
+    restante = tamano
+    while restante > 0:
+        parte = bloque[: min(restante, _BLOQUE_ARCHIVO)]
+        restante -= len(parte)
+        yield base64.b64encode(parte)
+
+
+def _texto_peticion(cuerpo: bytes, etiqueta: str) -> Optional[str]:
+    try:
+        raiz = ET.fromstring(cuerpo)
+    except ET.ParseError:
+        return None
+    nodo = raiz.find(f".//temp:{etiqueta}", XML_NAMESPACES)
+    if nodo is None or nodo.text is None:
+        return None
+    return nodo.text.strip() or None
+
+
+class ServicioSimulado:
+    """Estado compartido del simulador: corpus, ráfagas 429 y contadores."""
+
+    def __init__(self, configuracion: ConfiguracionSimulador) -> None:
+        self.configuracion = configuracion
+        self._azar = random.Random(configuracion.semilla)
+        self._bloqueo = threading.Lock()
+        self._cambios: Dict[str, int] = {}
+        self._fin_rafaga = 0.0
+        self.contadores: Dict[str, int] = {}
+
+    def _contar(self, clave: str) -> None:
+        self.contadores[clave] = self.contadores.get(clave, 0) + 1
+
+    def decidir_falla(self) -> Tuple[float, Optional[int], Optional[int]]:
+        """Devuelve ``(latencia, status de error, Retry-After)`` para una petición."""
+
+        configuracion = self.configuracion
+        with self._bloqueo:
+            latencia = configuracion.sortear_latencia(self._azar)
+            ahora = time.monotonic()
+            if ahora >= self._fin_rafaga and self._azar.random() < configuracion.probabilidad_rafaga_429:
+                self._fin_rafaga = ahora + configuracion.duracion_rafaga_429
+            if ahora < self._fin_rafaga:
+                self._contar("429")
+                return latencia, 429, max(1, math.ceil(self._fin_rafaga - ahora))
+            if self._azar.random() < configuracion.probabilidad_5xx:
+                self._contar("5xx")
+                return latencia, self._azar.choice((500, 502, 503)), None
+        return latencia, None, None
+
+    def historial(self, codigo: str) -> List[EstadoSimulado]:
+        with self._bloqueo:
+            self._contar("estado")
+            cambios = self._cambios.get(codigo, 0)
+            if self._azar.random() < self.configuracion.probabilidad_cambio:
+                cambios += 1
+                self._cambios[codigo] = cambios
+        return generar_historial(codigo, self.configuracion.semilla, cambios)
+
+    def contar_archivo(self) -> None:
+        with self._bloqueo:
+            self._contar("archivo")
+
+
+class _ManejadorSOAP(BaseHTTPRequestHandler):
+    servicio: ServicioSimulado
+
+    def log_message(self, formato: str, *args: object) -> None:
+        return
+
+    def _responder(
+        self, status: int, cuerpo: bytes, encabezados: Optional[Dict[str, str]] = None
+    ) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", "text/xml; charset=utf-8")
+        self.send_header("Content-Length", str(len(cuerpo)))
+        for nombre, valor in (encabezados or {}).items():
+            self.send_header(nombre, valor)
+        self.end_headers()
+        self.wfile.write(cuerpo)
+
+    def do_POST(self) -> None:
+        cuerpo = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if self.path.split("?")[0] != RUTA_SERVICIO:
+            self._responder(404, b"")
+            return
+
+        latencia, status_error, retry_after = self.servicio.decidir_falla()
+        if latencia:
+            time.sleep(latencia)
+        if status_error is not None:
+            encabezados = {"Retry-After": str(retry_after)} if retry_after else None
+            self._responder(status_error, f"Error simulado {status_error}".encode("utf-8"), encabezados)
+            return
+
+        accion = (self.headers.get("SOAPAction") or "").strip('"')
+        if accion == ACCION_ESTADO:
+            codigo = _texto_peticion(cuerpo, "codigoSeguimiento")
+            if codigo is None:
+                self._responder(400, b"codigoSeguimiento requerido")
+                return
+            xml = _xml_estado(codigo, self.servicio.historial(codigo))
+            self._responder(200, xml.encode("utf-8"))
+        elif accion == ACCION_ARCHIVO:
+            estado_id = _texto_peticion(cuerpo, "idEstadoNotificacion")
+            if estado_id is None:
+                self._responder(400, b"idEstadoNotificacion requerido")
+                return
+            self.servicio.contar_archivo()
+            tamano = self.servicio.configuracion.tamano_archivo
+            prefijo, sufijo, longitud = _partes_xml_archivo(estado_id, tamano)
+            self.send_response(200)
+            self.send_header("Content-Type", "text/xml; charset=utf-8")
+            self.send_header("Content-Length", str(len(prefijo) + longitud + len(sufijo)))
+            self.end_headers()
+            self.wfile.write(prefijo)
+            for fragmento in _fragmentos_archivo(estado_id, tamano):
+                self.wfile.write(fragmento)
+            self.wfile.write(sufijo)
+        else:
+            self._responder(400, f"SOAPAction desconocida: {accion}".encode("utf-8"))
+
+
+def crear_servidor(
+    configuracion: Optional[ConfiguracionSimulador] = None,
+    host: str = "127.0.0.1",
+    puerto: int = 0,
+) -> Tuple[ThreadingHTTPServer, ServicioSimulado]:
+    """Crea el servidor HTTP; con ``puerto=0`` el sistema elige uno libre."""
+
+    servicio = ServicioSimulado(configuracion or ConfiguracionSimulador())
+    manejador = type("ManejadorSOAP", (_ManejadorSOAP,), {"servicio": servicio})
+    servidor = ThreadingHTTPServer((host, puerto), manejador)
+    servidor.daemon_threads = True
+    return servidor, servicio
+
+
+def iniciar_en_segundo_plano(
+    configuracion: Optional[ConfiguracionSimulador] = None,
+) -> Tuple[ThreadingHTTPServer, ServicioSimulado, str]:
+    """Inicia el simulador en un hilo y devuelve la URL base para ``MP_SOAP_HOST``."""
+
+    servidor, servicio = crear_servidor(configuracion)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    host, puerto = servidor.server_address[:2]
+    return servidor, servicio, f"http://{host}:{puerto}"
+
+
+def _parse_args(argv: Optional[Sequence[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Servidor local que simula wsNotificacion.asmx del MP."
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--puerto", type=int, default=8089)
+    parser.add_argument("--latencia-mediana", type=float, default=0.0, help="Segundos")
+    parser.add_argument("--latencia-p95", type=float, default=0.0, help="Segundos")
+    parser.add_argument(
+        "--probabilidad-rafaga-429",
+        type=float,
+        default=0.0,
+        help="Probabilidad por petición de iniciar una ráfaga de HTTP 429",
+    )
+    parser.add_argument(
+        "--duracion-rafaga-429",
+        type=float,
+        default=5.0,
+        help="Segundos que dura cada ráfaga (se informa en Retry-After)",
+    )
+    parser.add_argument("--probabilidad-5xx", type=float, default=0.0)
+    parser.add_argument(
+        "--probabilidad-cambio",
+        type=float,
+        default=0.0,
+        help="Probabilidad de que una consulta encuentre un estado nuevo",
+    )
+    parser.add_argument(
+        "--tamano-archivo",
+        type=int,
+        default=64 * 1024,
+        help="Bytes decodificados de cada archivo devuelto",
+    )
+    parser.add_argument("--semilla", type=int, default=0)
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    args = _parse_args(argv)
+    configuracion = ConfiguracionSimulador(
+        latencia_mediana=args.latencia_mediana,
+        latencia_p95=args.latencia_p95,
+        probabilidad_rafaga_429=args.probabilidad_rafaga_429,
+        duracion_rafaga_429=args.duracion_rafaga_429,
+        probabilidad_5xx=args.probabilidad_5xx,
+        probabilidad_cambio=args.probabilidad_cambio,
+        tamano_archivo=args.tamano_archivo,
+        semilla=args.semilla,
+    )
+    servidor, servicio = crear_servidor(configuracion, args.host, args.puerto)
+    print(f"Simulador MP escuchando en http://{args.host}:{servidor.server_address[1]}{RUTA_SERVICIO}")
+    try:
+        servidor.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        servidor.server_close()
+        print(f"Peticiones atendidas: {servicio.contadores}")
+
+
+if __name__ == "__main__":
+    main()
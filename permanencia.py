@@ -0,0 +1,372 @@
+"""Modelo de permanencia por estado para planificar las consultas al MP.
+
+A partir de las transiciones registradas en ``notpolhistoricomp`` se arma, por
+cada estado, un histograma del tiempo que las notificaciones permanecen en él
+antes de pasar al siguiente. Las cubetas son logarítmicas en horas: la cubeta
+``0`` cubre menos de una hora y la cubeta ``i`` el intervalo
+``[2**(i-1), 2**i)`` horas.
+
+Con ese histograma se calcula para cada envío activo la fecha en la que es
+probable que haya cambiado de estado (``proximaconsultasian``) y
+``retornoxmlmp`` consulta solo los envíos cuya fecha ya pasó. El modelo se
+actualiza de forma incremental: solo se recalculan los códigos con filas de
+historial insertadas después de la última marca procesada.
+
+Uso:
+    python permanencia.py --actualizar
+    python permanencia.py --reconstruir
+"""
+
+from __future__ import annotations
+
+import argparse
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import psycopg2
+from psycopg2 import extras
+
+from historialsian import _log_step, pgsql_config
+
+
+CANTIDAD_CUBETAS = 14
+MIN_MUESTRAS = 20
+CUANTIL_CONSULTA = 0.5
+ESPERA_SIN_MODELO = timedelta(days=1)
+ESPERA_MINIMA = timedelta(hours=12)
+ESPERA_MAXIMA = timedelta(days=7)
+SOLAPAMIENTO_MARCA = timedelta(hours=1)
+ESTADOS_FINALES = ("Finalizada",)
+
+# Cada código aporta sus transiciones a ``permanenciacodigo``. Al actualizar se
+# recalculan completos los códigos con filas dadas de alta desde la marca: se
+# resta su aporte anterior de ``permanenciaestado`` y se suma el nuevo, así una
+# fila antigua insertada tarde corrige la transición que la rodea.
+_SENTENCIA_CREAR_CODIGOS = """
+    CREATE TEMP TABLE IF NOT EXISTS permanencia_codigos (
+        codigo text PRIMARY KEY
+    ) ON COMMIT DELETE ROWS
+"""
+
+_SENTENCIA_CODIGOS_AFECTADOS = """
+    INSERT INTO permanencia_codigos (codigo)
+    SELECT DISTINCT codigoseguimientompnorm
+    FROM notpolhistoricomp
+    WHERE notpolhistoricompalta > %(desde)s
+      AND notpolhistoricompalta <= %(hasta)s
+      AND COALESCE(codigoseguimientompnorm, '') <> ''
+    ON CONFLICT DO NOTHING
+"""
+
+_SENTENCIA_RESTAR_APORTES = """
+    UPDATE permanenciaestado AS p
+    SET cantidad = p.cantidad - anterior.cantidad
+    FROM (
+        SELECT c.estado, c.cubeta, SUM(c.cantidad) AS cantidad
+        FROM permanenciacodigo AS c
+        JOIN permanencia_codigos AS a ON a.codigo = c.codigo
+        GROUP BY 1, 2
+    ) AS anterior
+    WHERE p.estado = anterior.estado
+      AND p.cubeta = anterior.cubeta
+"""
+
+_SENTENCIA_BORRAR_APORTES = """
+    DELETE FROM permanenciacodigo AS c
+    USING permanencia_codigos AS a
+    WHERE c.codigo = a.codigo
+"""
+
+_SENTENCIA_TRANSICIONES = f"""
+    INSERT INTO permanenciacodigo (codigo, estado, cubeta, cantidad)
+    SELECT codigo,
+           estado,
+           CASE
+               WHEN horas < 1 THEN 0
+               ELSE LEAST(
+                   {CANTIDAD_CUBETAS - 1},
+                   floor(log(2.0, horas::numeric))::int + 1
+               )
+           END AS cubeta,
+           COUNT(*) AS cantidad
+    FROM (
+        SELECT n.codigoseguimientompnorm AS codigo,
+               TRIM(n.notpolhistoricompestado) AS estado,
+               EXTRACT(
+                   EPOCH FROM (
+                       LEAD(n.notpolhistoricompfechats) OVER siguiente
+                       - n.notpolhistoricompfechats
+                   )
+               ) / 3600.0 AS horas
+        FROM notpolhistoricomp AS n
+        JOIN permanencia_codigos AS a ON a.codigo = n.codigoseguimientompnorm
+        WHERE COALESCE(TRIM(n.notpolhistoricompestado), '') <> ''
+          AND n.notpolhistoricompfechats IS NOT NULL
+        WINDOW siguiente AS (
+            PARTITION BY n.codigoseguimientompnorm
+            ORDER BY n.notpolhistoricompfechats
+        )
+    ) AS permanencias
+    WHERE horas IS NOT NULL
+    GROUP BY 1, 2, 3
+"""
+
+_SENTENCIA_SUMAR_APORTES = """
+    WITH nuevos AS (
+        SELECT c.estado, c.cubeta, SUM(c.cantidad) AS cantidad
+        FROM permanenciacodigo AS c
+        JOIN permanencia_codigos AS a ON a.codigo = c.codigo
+        GROUP BY 1, 2
+    ),
+    sumados AS (
+        INSERT INTO permanenciaestado (estado, cubeta, cantidad)
+        SELECT estado, cubeta, cantidad
+        FROM nuevos
+        ON CONFLICT (estado, cubeta) DO UPDATE
+        SET cantidad = permanenciaestado.cantidad + EXCLUDED.cantidad
+    )
+    SELECT COUNT(*), COALESCE(SUM(cantidad), 0)
+    FROM nuevos
+"""
+
+_SENTENCIA_ACTUALIZAR_MARCA = """
+    INSERT INTO permanenciamarca (id, procesado_hasta, actualizado)
+    VALUES (TRUE, %s, NOW())
+    ON CONFLICT (id) DO UPDATE
+    SET procesado_hasta = EXCLUDED.procesado_hasta,
+        actualizado = EXCLUDED.actualizado
+"""
+
+_SENTENCIA_ENVIOS_ACTIVOS = """
+    SELECT pmovimientoid,
+           pactuacionid,
+           pdomicilioelectronicopj,
+           TRIM(COALESCE(laststagesian, '')),
+           fechalaststate
+    FROM enviocedulanotificacionpolicia
+    WHERE COALESCE(descartada, FALSE) = FALSE
+      AND COALESCE(fenviadaiw, FALSE) = FALSE
+      AND NOT (COALESCE(laststagesian, '') = ANY(%s))
+"""
+
+_SENTENCIA_PROXIMAS_CONSULTAS = """
+    UPDATE enviocedulanotificacionpolicia AS env
+    SET proximaconsultasian = datos.proxima
+    FROM (VALUES %s) AS datos (pmovimientoid, pactuacionid, pdomicilioelectronicopj, proxima)
+    WHERE env.pmovimientoid = datos.pmovimientoid
+      AND env.pactuacionid = datos.pactuacionid
+      AND env.pdomicilioelectronicopj = datos.pdomicilioelectronicopj
+      AND env.proximaconsultasian IS DISTINCT FROM datos.proxima
+"""
+
+
+def limite_cubeta(cubeta: int) -> timedelta:
+    """Límite superior de la cubeta ``cubeta``."""
+
+    return timedelta(hours=2 ** cubeta)
+
+
+@dataclass
+class ModeloPermanencia:
+    """Histogramas de permanencia por estado y cálculo de la próxima consulta."""
+
+    histogramas: Dict[str, List[int]] = field(default_factory=dict)
+    cuantil: float = CUANTIL_CONSULTA
+
+    @classmethod
+    def cargar(cls, conexion: psycopg2.extensions.connection) -> "ModeloPermanencia":
+        modelo = cls()
+        with conexion.cursor() as cursor:
+            cursor.execute("SELECT estado, cubeta, cantidad FROM permanenciaestado")
+            for estado, cubeta, cantidad in cursor.fetchall():
+                modelo.sumar(estado, int(cubeta), int(cantidad))
+        return modelo
+
+    def sumar(self, estado: str, cubeta: int, cantidad: int) -> None:
+        conteos = self.histogramas.setdefault(estado, [0] * CANTIDAD_CUBETAS)
+        conteos[min(max(cubeta, 0), CANTIDAD_CUBETAS - 1)] += cantidad
+
+    def espera(self, estado: str, transcurrido: timedelta) -> Optional[timedelta]:
+        """Tiempo hasta que el cambio de estado alcance el cuantil configurado.
+
+        La distribución se condiciona a que el envío ya lleva ``transcurrido``
+        en el estado. Devuelve ``None`` si no hay muestras suficientes o si el
+        envío superó todas las permanencias observadas.
+        """
+
+        conteos = self.histogramas.get(estado)
+        if not conteos or sum(conteos) < MIN_MUESTRAS:
+            return None
+
+        restantes = [
+            (limite_cubeta(cubeta), cantidad)
+            for cubeta, cantidad in enumerate(conteos)
+            if cantidad and limite_cubeta(cubeta) > transcurrido
+        ]
+        total = sum(cantidad for _, cantidad in restantes)
+        if not total:
+            return None
+
+        acumulado = 0
+        for limite, cantidad in restantes:
+            acumulado += cantidad
+            if acumulado >= total * self.cuantil:
+                return limite - transcurrido
+        return restantes[-1][0] - transcurrido
+
+    def proxima_consulta(
+        self,
+        estado: str,
+        fecha_estado: Optional[datetime],
+        ahora: datetime,
+    ) -> datetime:
+        """Fecha en la que conviene volver a consultar el envío."""
+
+        espera = None
+        if fecha_estado is not None:
+            espera = self.espera(estado, max(ahora - fecha_estado, timedelta(0)))
+        if espera is None:
+            espera = ESPERA_SIN_MODELO
+        return ahora + min(max(espera, ESPERA_MINIMA), ESPERA_MAXIMA)
+
+
+def _obtener_marca(cursor: psycopg2.extensions.cursor) -> datetime:
+    cursor.execute("SELECT procesado_hasta FROM permanenciamarca WHERE id")
+    fila = cursor.fetchone()
+    return fila[0] if fila and fila[0] is not None else datetime.min
+
+
+def actualizar_modelo(
+    conexion: psycopg2.extensions.connection,
+    hasta: Optional[datetime] = None,
+    reconstruir: bool = False,
+) -> int:
+    """Recalcula el aporte de los códigos con historial nuevo desde la marca.
+
+    La marca se compara con ``notpolhistoricompalta`` (cuándo se insertó la
+    fila), no con la fecha del estado: el historial llega al consultar el
+    código, a veces días después del cambio. Se repasa además
+    ``SOLAPAMIENTO_MARCA`` antes de la marca para incluir filas de
+    transacciones que confirmaron tarde; recalcular un código dos veces no
+    altera el modelo. Con ``reconstruir`` se descartan los histogramas y se
+    recorre todo el historial. Devuelve la cantidad de transiciones de los
+    códigos recalculados.
+    """
+
+    hasta = hasta or datetime.now()
+    with conexion.cursor() as cursor:
+        if reconstruir:
+            cursor.execute("DELETE FROM permanenciaestado")
+            cursor.execute("DELETE FROM permanenciacodigo")
+            desde = datetime.min
+        else:
+            desde = _obtener_marca(cursor)
+            if desde - datetime.min > SOLAPAMIENTO_MARCA:
+                desde -= SOLAPAMIENTO_MARCA
+
+        cursor.execute(_SENTENCIA_CREAR_CODIGOS)
+        cursor.execute(_SENTENCIA_CODIGOS_AFECTADOS, {"desde": desde, "hasta": hasta})
+        cursor.execute(_SENTENCIA_RESTAR_APORTES)
+        cursor.execute(_SENTENCIA_BORRAR_APORTES)
+        cursor.execute(_SENTENCIA_TRANSICIONES)
+        cursor.execute(_SENTENCIA_SUMAR_APORTES)
+        cubetas, transiciones = cursor.fetchone()
+        cursor.execute(_SENTENCIA_ACTUALIZAR_MARCA, (hasta,))
+    conexion.commit()
+
+    _log_step(
+        "actualizar_modelo",
+        "OK",
+        "Transiciones recalculadas en el modelo de permanencia: %s (%s cubetas)",
+        transiciones,
+        cubetas,
+    )
+    return int(transiciones)
+
+
+def calcular_proximas_consultas(
+    modelo: ModeloPermanencia,
+    envios: Iterable[Tuple[int, int, str, str, Optional[datetime]]],
+    ahora: datetime,
+) -> List[Tuple[int, int, str, datetime]]:
+    return [
+        (
+            pmovimientoid,
+            pactuacionid,
+            pdomicilioelectronicopj,
+            modelo.proxima_consulta(estado, fecha_estado, ahora),
+        )
+        for pmovimientoid, pactuacionid, pdomicilioelectronicopj, estado, fecha_estado in envios
+    ]
+
+
+def actualizar_proximas_consultas(
+    conexion: psycopg2.extensions.connection,
+    modelo: Optional[ModeloPermanencia] = None,
+    ahora: Optional[datetime] = None,
+) -> int:
+    """Recalcula ``proximaconsultasian`` para los envíos activos."""
+
+    ahora = ahora or datetime.now()
+    modelo = modelo or ModeloPermanencia.cargar(conexion)
+    with conexion.cursor() as cursor:
+        cursor.execute(_SENTENCIA_ENVIOS_ACTIVOS, (list(ESTADOS_FINALES),))
+        proximas = calcular_proximas_consultas(modelo, cursor.fetchall(), ahora)
+        if proximas:
+            extras.execute_values(
+                cursor,
+                _SENTENCIA_PROXIMAS_CONSULTAS,
+                proximas,
+                template="(%s, %s, %s, %s::timestamp)",
+                page_size=1000,
+            )
+    conexion.commit()
+
+    _log_step(
+        "actualizar_proximas_consultas",
+        "OK",
+        "Próxima consulta recalculada para %s envíos",
+        len(proximas),
+    )
+    return len(proximas)
+
+
+def refrescar(
+    conexion: psycopg2.extensions.connection, reconstruir: bool = False
+) -> None:
+    """Actualiza el modelo y las próximas consultas en una sola pasada."""
+
+    actualizar_modelo(conexion, reconstruir=reconstruir)
+    actualizar_proximas_consultas(conexion)
+
+
+def _parse_args(argv: Optional[Sequence[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description=(
+            "Actualiza el modelo de permanencia por estado y la próxima "
+            "consulta de cada envío."
+        )
+    )
+    grupo = parser.add_mutually_exclusive_group()
+    grupo.add_argument(
+        "--actualizar",
+        action="store_true",
+        help="Incorpora solo las transiciones nuevas (comportamiento por defecto).",
+    )
+    grupo.add_argument(
+        "--reconstruir",
+        action="store_true",
+        help="Descarta el modelo y lo recalcula con todo el historial.",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    args = _parse_args(argv)
+    with psycopg2.connect(**pgsql_config) as conexion:
+        refrescar(conexion, reconstruir=args.reconstruir)
+
+
+if __name__ == "__main__":
+    main()
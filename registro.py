@@ -0,0 +1,207 @@
+"""Registro estructurado de los procesos del tablero SIAN.
+
+Envuelve ``logging`` con la configuración común de ``app.py``,
+``retornoxmlmp``, ``historialsian`` y ``retornoporestado``:
+
+* niveles estándar y mensajes con argumentos ``%`` que solo se formatean si el
+  registro se emite;
+* salida de texto o JSON (una línea por evento);
+* muestreo por categoría para los mensajes por código (los ``WARNING`` y
+  ``ERROR`` nunca se descartan);
+* truncado de payloads (XML, base64) con :func:`truncar`;
+* volcado de XML SOAP solo con la bandera de depuración.
+
+La configuración se toma de los argumentos de :func:`configurar` o de las
+variables de entorno ``SIAN_LOG_NIVEL``, ``SIAN_LOG_FORMATO`` (``texto`` o
+``json``), ``SIAN_LOG_MUESTREO`` (``categoria=tasa,...``),
+``SIAN_LOG_MAX_PAYLOAD`` y ``SIAN_LOG_XML``.
+"""
+
+from __future__ import annotations
+
+from datetime import datetime
+import json
+import logging
+import os
+import random
+import sys
+import threading
+from typing import Any, Callable, Dict, Mapping, Optional
+
+
+RAIZ = "sian"
+MAX_PAYLOAD_POR_DEFECTO = 512
+
+_NIVELES_PASO = {
+    "INICIO": logging.DEBUG,
+    "OK": logging.DEBUG,
+    "ADVERTENCIA": logging.WARNING,
+    "ERROR": logging.ERROR,
+}
+
+_bloqueo = threading.Lock()
+_configurado = False
+_depurar_xml = False
+_max_payload = MAX_PAYLOAD_POR_DEFECTO
+
+
+class _Diferido:
+    """Valor que se calcula recién al formatear el mensaje."""
+
+    __slots__ = ("_funcion", "_args")
+
+    def __init__(self, funcion: Callable[..., Any], *args: Any) -> None:
+        self._funcion = funcion
+        self._args = args
+
+    def __str__(self) -> str:
+        return str(self._funcion(*self._args))
+
+
+def diferido(funcion: Callable[..., Any], *args: Any) -> _Diferido:
+    """Argumento de log que invoca ``funcion(*args)`` solo si se emite."""
+
+    return _Diferido(funcion, *args)
+
+
+def _recortar(texto: Any, limite: Optional[int]) -> str:
+    texto = "" if texto is None else str(texto)
+    limite = _max_payload if limite is None else limite
+    if limite <= 0 or len(texto) <= limite:
+        return texto
+    return f"{texto[:limite]}... [{len(texto) - limite} caracteres omitidos]"
+
+
+def truncar(texto: Any, limite: Optional[int] = None) -> _Diferido:
+    """Recorta ``texto`` a ``limite`` caracteres (``SIAN_LOG_MAX_PAYLOAD``)."""
+
+    return _Diferido(_recortar, texto, limite)
+
+
+def depurar_xml() -> bool:
+    """Indica si se pidieron los volcados de XML SOAP."""
+
+    _asegurar_configuracion()
+    return _depurar_xml
+
+
+class _FiltroMuestreo(logging.Filter):
+    """Deja pasar una fracción de los mensajes informativos por categoría."""
+
+    def __init__(self, tasas: Mapping[str, float]) -> None:
+        super().__init__()
+        self._tasas = dict(tasas)
+        self._azar = random.Random()
+
+    def _tasa(self, categoria: str) -> float:
+        # La categoría más específica que coincida define la tasa.
+        while categoria:
+            if categoria in self._tasas:
+                return self._tasas[categoria]
+            categoria = categoria.rpartition(".")[0]
+        return 1.0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or not self._tasas:
+            return True
+        tasa = self._tasa(_categoria(record.name))
+        return tasa >= 1.0 or self._azar.random() < tasa
+
+
+class _FormateadorJSON(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        evento: Dict[str, Any] = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "nivel": record.levelname,
+            "categoria": _categoria(record.name),
+            "mensaje": record.getMessage(),
+        }
+        campos = getattr(record, "campos", None)
+        if campos:
+            evento.update(campos)
+        if record.exc_info:
+            evento["excepcion"] = self.formatException(record.exc_info)
+        return json.dumps(evento, ensure_ascii=False, default=str)
+
+
+def _categoria(nombre_logger: str) -> str:
+    if nombre_logger.startswith(RAIZ + "."):
+        return nombre_logger[len(RAIZ) + 1:]
+    return nombre_logger
+
+
+def _parsear_muestreo(texto: str) -> Dict[str, float]:
+    tasas: Dict[str, float] = {}
+    for parte in texto.split(","):
+        categoria, _, tasa = parte.partition("=")
+        if categoria.strip() and tasa.strip():
+            tasas[categoria.strip()] = max(0.0, min(1.0, float(tasa)))
+    return tasas
+
+
+def configurar(
+    nivel: Optional[str] = None,
+    formato: Optional[str] = None,
+    muestreo: Optional[Mapping[str, float]] = None,
+    max_payload: Optional[int] = None,
+    xml: Optional[bool] = None,
+    destino: Any = None,
+) -> None:
+    """Instala el handler de ``sian``; las llamadas posteriores lo reemplazan."""
+
+    global _configurado, _depurar_xml, _max_payload
+
+    nivel = (nivel or os.environ.get("SIAN_LOG_NIVEL") or "INFO").upper()
+    formato = (formato or os.environ.get("SIAN_LOG_FORMATO") or "texto").lower()
+    if muestreo is None:
+        muestreo = _parsear_muestreo(os.environ.get("SIAN_LOG_MUESTREO", ""))
+    if max_payload is None:
+        max_payload = int(os.environ.get("SIAN_LOG_MAX_PAYLOAD") or MAX_PAYLOAD_POR_DEFECTO)
+    if xml is None:
+        xml = os.environ.get("SIAN_LOG_XML", "").strip().lower() in ("1", "true", "si", "sí")
+
+    handler = logging.StreamHandler(destino or sys.stdout)
+    if formato == "json":
+        handler.setFormatter(_FormateadorJSON())
+    else:
+        handler.setFormatter(
+            logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s")
+        )
+    handler.addFilter(_FiltroMuestreo(muestreo))
+
+    with _bloqueo:
+        raiz = logging.getLogger(RAIZ)
+        for anterior in list(raiz.handlers):
+            raiz.removeHandler(anterior)
+        raiz.addHandler(handler)
+        raiz.setLevel(nivel)
+        raiz.propagate = False
+        _max_payload = max_payload
+        _depurar_xml = bool(xml)
+        logging.getLogger(f"{RAIZ}.soap.xml").setLevel(
+            logging.DEBUG if _depurar_xml else logging.NOTSET
+        )
+        _configurado = True
+
+
+def _asegurar_configuracion() -> None:
+    if not _configurado:
+        configurar()
+
+
+def obtener(categoria: str) -> logging.Logger:
+    """Logger de la categoría ``categoria`` (por ejemplo ``soap.xml``)."""
+
+    _asegurar_configuracion()
+    return logging.getLogger(f"{RAIZ}.{categoria.strip('_')}")
+
+
+def paso(funcion: str, estado: str, mensaje: str, *args: Any) -> None:
+    """Registra un paso con el formato de ``_log_step``."""
+
+    logger = obtener(funcion)
+    nivel = _NIVELES_PASO.get(estado.upper(), logging.INFO)
+    if logger.isEnabledFor(nivel):
+        if not args:
+            mensaje = mensaje.replace("%", "%%")
+        logger.log(nivel, "[%s] " + mensaje, estado.upper(), *args)
@@ -0,0 +1,296 @@
+"""Respuesta de ``ObtenerEstadoNotificacion`` parseada una única vez.
+
+El XML devuelto por el servicio SOAP del Ministerio Público se recorre una sola
+vez para construir un :class:`RespuestaEstadoNotificacion` inmutable con los
+estados del historial, el último estado y el último estado con archivo. Los
+resultados se memorizan por digest SHA-256 del XML, de modo que
+``retornoxmlmp``, ``historialsian`` y ``retornoporestado`` comparten el mismo
+objeto para una misma respuesta.
+"""
+
+from __future__ import annotations
+
+from collections import OrderedDict
+from datetime import datetime
+import hashlib
+import threading
+from typing import Any, Dict, Optional, Tuple, Union
+import xml.etree.ElementTree as ET
+
+import fechas
+
+
+XML_NAMESPACES = {
+    "soap": "http://schemas.xmlsoap.org/soap/envelope/",
+    "temp": "http://tempuri.org/",
+}
+
+MAX_RESPUESTAS_MEMORIZADAS = 512
+
+
+class _Inmutable:
+    """Base para registros con ``__slots__`` que no admiten reasignación."""
+
+    __slots__ = ()
+
+    def __init__(self, **valores: Any) -> None:
+        for nombre in self.__slots__:
+            object.__setattr__(self, nombre, valores[nombre])
+
+    def __setattr__(self, nombre: str, valor: Any) -> None:
+        raise AttributeError(f"{type(self).__name__} es inmutable")
+
+    def __reduce__(self):
+        return (
+            _reconstruir,
+            (type(self), {nombre: getattr(self, nombre) for nombre in self.__slots__}),
+        )
+
+    def __eq__(self, otro: object) -> bool:
+        if type(otro) is not type(self):
+            return NotImplemented
+        return all(
+            getattr(self, nombre) == getattr(otro, nombre) for nombre in self.__slots__
+        )
+
+    def __hash__(self) -> int:
+        return hash(tuple(getattr(self, nombre) for nombre in self.__slots__))
+
+    def __repr__(self) -> str:
+        campos = ", ".join(
+            f"{nombre}={getattr(self, nombre)!r}" for nombre in self.__slots__
+        )
+        return f"{type(self).__name__}({campos})"
+
+
+def _reconstruir(clase: type, valores: Dict[str, Any]) -> _Inmutable:
+    return clase(**valores)
+
+
+class EstadoRegistro(_Inmutable):
+    """Un ``EstadoNotificacion`` del ``HistorialEstados``."""
+
+    __slots__ = (
+        "indice",
+        "estado_id",
+        "fecha",
+        "fecha_raw",
+        "estado",
+        "observaciones",
+        "motivo",
+        "responsable",
+        "dependencia",
+        "archivo_id",
+        "archivo_nombre",
+    )
+
+    indice: int
+    estado_id: Optional[int]
+    fecha: Optional[datetime]
+    fecha_raw: Optional[str]
+    estado: Optional[str]
+    observaciones: Optional[str]
+    motivo: Optional[str]
+    responsable: Optional[str]
+    dependencia: Optional[str]
+    archivo_id: Optional[str]
+    archivo_nombre: Optional[str]
+
+    @property
+    def tiene_archivo(self) -> bool:
+        return bool(self.archivo_id) and self.archivo_id != "0"
+
+    @property
+    def fecha_comparable(self) -> Optional[datetime]:
+        return fechas.normalizar(
+            self.fecha or self.fecha_raw
+        )
+
+    def como_dict(self) -> Dict[str, Any]:
+        """Formato de diccionario usado por las funciones de ``historialsian``."""
+
+        return {
+            "estado_id": self.estado_id,
+            "fecha": self.fecha,
+            "fecha_raw": self.fecha_raw,
+            "estado": self.estado,
+            "observaciones": self.observaciones,
+            "motivo": self.motivo,
+            "responsable": self.responsable,
+            "dependencia": self.dependencia,
+            "archivo_id": self.archivo_id,
+            "archivo_nombre": self.archivo_nombre,
+        }
+
+
+class RespuestaEstadoNotificacion(_Inmutable):
+    """Resultado inmutable de parsear una respuesta ``ObtenerEstadoNotificacion``.
+
+    ``ultimo_estado`` es el estado con la fecha más reciente (el primero ante
+    empates), tal como lo registra el historial. ``ultimo_estado_con_archivo``
+    y ``ultimo_estado_con_id`` priorizan el orden del documento ante empates y
+    son los que determinan el estado cuyo archivo se descarga.
+    """
+
+    __slots__ = (
+        "digest",
+        "xml_valido",
+        "estados",
+        "ultimo_estado",
+        "ultimo_estado_con_id",
+        "ultimo_estado_con_archivo",
+        "estado_id_sin_historial",
+        "errores",
+    )
+
+    digest: str
+    xml_valido: bool
+    estados: Tuple[EstadoRegistro, ...]
+    ultimo_estado: Optional[EstadoRegistro]
+    ultimo_estado_con_id: Optional[EstadoRegistro]
+    ultimo_estado_con_archivo: Optional[EstadoRegistro]
+    estado_id_sin_historial: Optional[str]
+    errores: Tuple[str, ...]
+
+    @property
+    def estado_id_archivo(self) -> Optional[str]:
+        """Estado a usar en ``ObtenerArchivoEstadoNotificacion``."""
+
+        for registro in (self.ultimo_estado_con_archivo, self.ultimo_estado_con_id):
+            if registro is not None:
+                return str(registro.estado_id)
+        return self.estado_id_sin_historial
+
+
+def _texto_hijo(nodo: ET.Element, tag: str) -> Optional[str]:
+    elemento = nodo.find(f"temp:{tag}", XML_NAMESPACES)
+    if elemento is None or elemento.text is None:
+        return None
+    texto = elemento.text.strip()
+    return texto if texto else None
+
+
+def _clave_documento(registro: EstadoRegistro) -> Tuple[bool, datetime, int]:
+    fecha = registro.fecha_comparable
+    return fecha is not None, fecha or datetime.min, registro.indice
+
+
+def _construir_respuesta(xml_respuesta: str, digest: str) -> RespuestaEstadoNotificacion:
+    vacia = dict(
+        digest=digest,
+        estados=(),
+        ultimo_estado=None,
+        ultimo_estado_con_id=None,
+        ultimo_estado_con_archivo=None,
+        estado_id_sin_historial=None,
+    )
+    if not xml_respuesta:
+        return RespuestaEstadoNotificacion(
+            xml_valido=False, errores=("XML vacío o inexistente",), **vacia
+        )
+
+    try:
+        root = ET.fromstring(xml_respuesta)
+    except ET.ParseError as exc:
+        return RespuestaEstadoNotificacion(
+            xml_valido=False, errores=(f"XML inválido: {exc}",), **vacia
+        )
+
+    errores = []
+    estados = []
+    for indice, nodo in enumerate(
+        root.findall(".//temp:HistorialEstados/temp:EstadoNotificacion", XML_NAMESPACES)
+    ):
+        estado_id_texto = _texto_hijo(nodo, "EstadoNotificacionId")
+        estado_id: Optional[int] = None
+        if estado_id_texto:
+            try:
+                estado_id = int(estado_id_texto)
+            except ValueError:
+                errores.append(
+                    f"EstadoNotificacionId no numérico en posición {indice}: "
+                    f"{estado_id_texto}"
+                )
+        fecha_raw = _texto_hijo(nodo, "Fecha")
+        estados.append(
+            EstadoRegistro(
+                indice=indice,
+                estado_id=estado_id,
+                fecha=fechas.parsear(fecha_raw),
+                fecha_raw=fecha_raw,
+                estado=_texto_hijo(nodo, "Estado"),
+                observaciones=_texto_hijo(nodo, "Observaciones"),
+                motivo=_texto_hijo(nodo, "Motivo"),
+                responsable=_texto_hijo(nodo, "ResponsableNotificacion"),
+                dependencia=_texto_hijo(nodo, "DependenciaNotificacion"),
+                archivo_id=_texto_hijo(nodo, "ArchivoId"),
+                archivo_nombre=_texto_hijo(nodo, "ArchivoNombre"),
+            )
+        )
+
+    ultimo_estado = None
+    if estados:
+        ultimo_estado = max(
+            estados, key=lambda registro: registro.fecha_comparable or datetime.min
+        )
+    con_id = [registro for registro in estados if registro.estado_id is not None]
+    con_archivo = [registro for registro in con_id if registro.tiene_archivo]
+
+    estado_id_sin_historial = None
+    if not con_id:
+        nodo_estado = root.find(".//temp:EstadoNotificacionId", XML_NAMESPACES)
+        if nodo_estado is not None and nodo_estado.text is not None:
+            estado_id_sin_historial = nodo_estado.text.strip() or None
+
+    return RespuestaEstadoNotificacion(
+        digest=digest,
+        xml_valido=True,
+        estados=tuple(estados),
+        ultimo_estado=ultimo_estado,
+        ultimo_estado_con_id=max(con_id, key=_clave_documento) if con_id else None,
+        ultimo_estado_con_archivo=(
+            max(con_archivo, key=_clave_documento) if con_archivo else None
+        ),
+        estado_id_sin_historial=estado_id_sin_historial,
+        errores=tuple(errores),
+    )
+
+
+def calcular_digest(xml_respuesta: str) -> str:
+    """SHA-256 hexadecimal del XML, la misma clave que ``retornomp``."""
+
+    return hashlib.sha256((xml_respuesta or "").encode("utf-8")).hexdigest()
+
+
+_MEMO: "OrderedDict[str, RespuestaEstadoNotificacion]" = OrderedDict()
+_MEMO_BLOQUEO = threading.Lock()
+
+
+def parsear_respuesta_estado(
+    xml_respuesta: Union[str, RespuestaEstadoNotificacion, None],
+    digest: Optional[str] = None,
+) -> RespuestaEstadoNotificacion:
+    """Devuelve la respuesta parseada, reutilizando la memorizada si existe."""
+
+    if isinstance(xml_respuesta, RespuestaEstadoNotificacion):
+        return xml_respuesta
+
+    texto = xml_respuesta or ""
+    clave = digest or calcular_digest(texto)
+    with _MEMO_BLOQUEO:
+        respuesta = _MEMO.get(clave)
+        if respuesta is not None:
+            _MEMO.move_to_end(clave)
+            return respuesta
+
+    respuesta = _construir_respuesta(texto, clave)
+    with _MEMO_BLOQUEO:
+        _MEMO[clave] = respuesta
+        while len(_MEMO) > MAX_RESPUESTAS_MEMORIZADAS:
+            _MEMO.popitem(last=False)
+    return respuesta
+
+
+def limpiar_memo() -> None:
+    with _MEMO_BLOQUEO:
+        _MEMO.clear()
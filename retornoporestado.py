@@ -10,14 +10,16 @@ from __future__ import annotations
 
 import argparse
 from dataclasses import dataclass
-from typing import Iterable, List, Optional
-import xml.etree.ElementTree as ET
+from typing import Iterable, List, Optional, Union
 
 import psycopg2
 from psycopg2 import extras
 
+import almacen_archivos
 import historialsian
-from historialsian import _log_step, pgsql_config, test as default_test_flag
+from historialsian import SUMMARY, _log_step, pgsql_config, test as default_test_flag
+import registro
+import respuesta_estado
 import retornoxmlmp
 
 
@@ -43,51 +45,33 @@ def _obtener_notificaciones_por_estado(
     """Devuelve las notificaciones filtradas por el último estado cuando aplica."""
 
     consulta = """
-        WITH ultimo_estado AS (
-            SELECT DISTINCT ON (TRIM(codigoseguimientomp))
-                TRIM(codigoseguimientomp) AS codigoseguimientomp,
-                notpolhistoricompfecha,
-                notpolhistoricompestado,
-                notpolhistoricompestadonid,
-                notpolhistoricomparchivoid
-            FROM notpolhistoricomp
-            WHERE codigoseguimientomp IS NOT NULL
-              AND TRIM(codigoseguimientomp) <> ''
-            ORDER BY TRIM(codigoseguimientomp),
-                     to_timestamp(
-                         left(replace(notpolhistoricompfecha, 'T', ' '), 19),
-                         'YYYY-MM-DD HH24:MI:SS'
-                     ) DESC NULLS LAST,
-                     notpolhistoricompestadonid DESC NULLS LAST
-        )
         SELECT
-            TRIM(env.codigoseguimientomp) AS codigo_seguimiento,
+            env.codigoseguimientompnorm AS codigo_seguimiento,
             env.pmovimientoid,
             env.pactuacionid,
             env.pdomicilioelectronicopj,
-            ultimo_estado.notpolhistoricompfecha,
+            ultimo_estado.notpolhistoricompfechats,
             ultimo_estado.notpolhistoricompestado,
             ultimo_estado.notpolhistoricompestadonid,
             ultimo_estado.notpolhistoricomparchivoid,
             env.laststagesian
         FROM enviocedulanotificacionpolicia env
-        LEFT JOIN ultimo_estado
-          ON TRIM(env.codigoseguimientomp) = ultimo_estado.codigoseguimientomp
-        WHERE env.codigoseguimientomp IS NOT NULL
-          AND TRIM(env.codigoseguimientomp) <> ''
+        LEFT JOIN notpol_ultimo_estado AS ultimo_estado
+          ON env.codigoseguimientompnorm = ultimo_estado.codigoseguimientompnorm
+        WHERE env.codigoseguimientompnorm <> ''
           AND (
             LOWER(COALESCE(ultimo_estado.notpolhistoricompestado, '')) = LOWER(%s)
             OR LOWER(COALESCE(env.laststagesian, '')) = LOWER(%s)
-            OR ultimo_estado.codigoseguimientomp IS NULL
+            OR ultimo_estado.codigoseguimientompnorm IS NULL
           )
     """
 
     params: List[object] = [estado_objetivo.strip(), estado_objetivo.strip()]
     if codigo_seguimiento:
-        consulta += "\n          AND TRIM(env.codigoseguimientomp) = %s"
+        consulta += "\n          AND env.codigoseguimientompnorm = %s"
         params.append(codigo_seguimiento.strip())
 
-    consulta += "\n        ORDER BY TRIM(env.codigoseguimientomp)"
+    consulta += "\n        ORDER BY env.codigoseguimientompnorm"
 
     with conn_pg.cursor(cursor_factory=extras.DictCursor) as cursor:
         cursor.execute(consulta, tuple(params))
@@ -109,7 +93,7 @@ def _obtener_notificaciones_por_estado(
                 pmovimientoid=int(fila["pmovimientoid"]),
                 pactuacionid=int(fila["pactuacionid"]),
                 pdomicilioelectronicopj=str(fila["pdomicilioelectronicopj"]),
-                fecha_ultimo_estado=fila["notpolhistoricompfecha"],
+                fecha_ultimo_estado=fila["notpolhistoricompfechats"],
                 estado_ultimo=estado_ultimo,
                 estado_envio=estado_envio,
                 tiene_archivo=archivo_id is not None and int(archivo_id) != 0,
@@ -126,24 +110,9 @@ def _contar_por_estado(
 
     consulta = """
         SELECT COUNT(*) AS total
-        FROM (
-            SELECT DISTINCT ON (TRIM(codigoseguimientomp))
-                TRIM(codigoseguimientomp) AS codigo_seguimiento,
-                COALESCE(notpolhistoricompestado, '') AS estado,
-                notpolhistoricompfecha,
-                notpolhistoricomparchivoid
-            FROM notpolhistoricomp
-            WHERE codigoseguimientomp IS NOT NULL
-              AND TRIM(codigoseguimientomp) <> ''
-            ORDER BY TRIM(codigoseguimientomp),
-                     to_timestamp(
-                         left(replace(notpolhistoricompfecha, 'T', ' '), 19),
-                         'YYYY-MM-DD HH24:MI:SS'
-                     ) DESC NULLS LAST,
-                     notpolhistoricompestadonid DESC NULLS LAST
-        ) AS ultimos
-        WHERE (%s IS NULL OR LOWER(estado) = LOWER(%s))
-          AND notpolhistoricompfecha::date < CURRENT_DATE
+        FROM notpol_ultimo_estado
+        WHERE (%s IS NULL OR LOWER(COALESCE(notpolhistoricompestado, '')) = LOWER(%s))
+          AND notpolhistoricompfechats < CURRENT_DATE
           AND notpolhistoricomparchivoid IS NOT NULL
           AND notpolhistoricomparchivoid <> 0;
     """
@@ -156,124 +125,71 @@ def _contar_por_estado(
     return int(resultado[0]) if resultado else 0
 
 
-def _obtener_ultimo_estado_desde_xml(xml_respuesta: str) -> Optional[str]:
-    """Extrae el último estado desde el XML del servicio SOAP."""
+def _respuesta_con_estados(
+    xml_respuesta: Union[str, respuesta_estado.RespuestaEstadoNotificacion, None],
+) -> Optional[respuesta_estado.RespuestaEstadoNotificacion]:
+    """Devuelve la respuesta parseada si contiene historial de estados."""
 
     if not xml_respuesta:
         return None
 
-    try:
-        root = ET.fromstring(xml_respuesta)
-    except ET.ParseError as exc:
+    respuesta = respuesta_estado.parsear_respuesta_estado(xml_respuesta)
+    if not respuesta.xml_valido:
         _log_step(
             "procesar_por_estado",
             "ADVERTENCIA",
-            f"No se pudo parsear el XML de respuesta: {exc}",
+            "No se pudo parsear el XML de respuesta: %s",
+            respuesta.errores[0],
         )
         return None
 
-    namespaces = {
-        "soap": "http://schemas.xmlsoap.org/soap/envelope/",
-        "temp": "http://tempuri.org/",
-    }
-    estados = root.findall(
-        ".//temp:HistorialEstados/temp:EstadoNotificacion", namespaces
-    )
-    if not estados:
-        return None
+    return respuesta if respuesta.estados else None
 
-    estados_normalizados = historialsian._normalizar_estados(estados, namespaces)
-    if not estados_normalizados:
-        return None
 
-    ultimo_estado = historialsian._obtener_estado_mas_reciente(estados_normalizados)
-    if ultimo_estado is None:
+def _obtener_ultimo_estado_desde_xml(
+    xml_respuesta: Union[str, respuesta_estado.RespuestaEstadoNotificacion, None],
+) -> Optional[str]:
+    """Extrae el último estado desde el XML del servicio SOAP."""
+
+    respuesta = _respuesta_con_estados(xml_respuesta)
+    if respuesta is None or respuesta.ultimo_estado is None:
         return None
 
-    return (ultimo_estado.get("estado") or "").strip()
+    return (respuesta.ultimo_estado.estado or "").strip()
 
 
 def _obtener_estado_nuevo_para_consola(
-    xml_respuesta: str,
+    xml_respuesta: Union[str, respuesta_estado.RespuestaEstadoNotificacion, None],
     fecha_ultimo_estado: Optional[object],
 ) -> Optional[str]:
     """Obtiene el estado más reciente que se registraría según el historial."""
 
-    if not xml_respuesta:
-        return None
-
-    try:
-        root = ET.fromstring(xml_respuesta)
-    except ET.ParseError as exc:
-        _log_step(
-            "procesar_por_estado",
-            "ADVERTENCIA",
-            f"No se pudo parsear el XML de respuesta: {exc}",
-        )
-        return None
-
-    namespaces = {
-        "soap": "http://schemas.xmlsoap.org/soap/envelope/",
-        "temp": "http://tempuri.org/",
-    }
-    estados = root.findall(
-        ".//temp:HistorialEstados/temp:EstadoNotificacion", namespaces
-    )
-    if not estados:
-        return None
-
-    estados_normalizados = historialsian._normalizar_estados(estados, namespaces)
-    if not estados_normalizados:
+    respuesta = _respuesta_con_estados(xml_respuesta)
+    if respuesta is None:
         return None
 
     estados_filtrados = historialsian._filtrar_estados_nuevos(
-        estados_normalizados, fecha_ultimo_estado
+        [estado.como_dict() for estado in respuesta.estados], fecha_ultimo_estado
     )
     if estados_filtrados:
         return (estados_filtrados[-1].get("estado") or "").strip()
 
-    ultimo_estado = historialsian._obtener_estado_mas_reciente(estados_normalizados)
-    if ultimo_estado is None:
+    if respuesta.ultimo_estado is None:
         return None
 
-    return (ultimo_estado.get("estado") or "").strip()
+    return (respuesta.ultimo_estado.estado or "").strip()
 
 
-def _obtener_archivo_id_ultimo_estado(xml_respuesta: str) -> Optional[str]:
+def _obtener_archivo_id_ultimo_estado(
+    xml_respuesta: Union[str, respuesta_estado.RespuestaEstadoNotificacion, None],
+) -> Optional[str]:
     """Extrae el archivo asociado al último estado desde el XML del servicio."""
 
-    if not xml_respuesta:
+    respuesta = _respuesta_con_estados(xml_respuesta)
+    if respuesta is None or respuesta.ultimo_estado is None:
         return None
 
-    try:
-        root = ET.fromstring(xml_respuesta)
-    except ET.ParseError as exc:
-        _log_step(
-            "procesar_por_estado",
-            "ADVERTENCIA",
-            f"No se pudo parsear el XML de respuesta: {exc}",
-        )
-        return None
-
-    namespaces = {
-        "soap": "http://schemas.xmlsoap.org/soap/envelope/",
-        "temp": "http://tempuri.org/",
-    }
-    estados = root.findall(
-        ".//temp:HistorialEstados/temp:EstadoNotificacion", namespaces
-    )
-    if not estados:
-        return None
-
-    estados_normalizados = historialsian._normalizar_estados(estados, namespaces)
-    if not estados_normalizados:
-        return None
-
-    ultimo_estado = historialsian._obtener_estado_mas_reciente(estados_normalizados)
-    if ultimo_estado is None:
-        return None
-
-    archivo_id = (ultimo_estado.get("archivo_id") or "").strip()
+    archivo_id = (respuesta.ultimo_estado.archivo_id or "").strip()
     if not archivo_id or archivo_id == "0":
         return None
     return archivo_id
@@ -282,24 +198,33 @@ def _obtener_archivo_id_ultimo_estado(xml_respuesta: str) -> Optional[str]:
 def _obtener_datos_archivo(
     conn_pg: psycopg2.extensions.connection, codigo_seguimiento: str
 ) -> Optional[str]:
-    """Obtiene los datos de archivo desde las tablas asociadas al código."""
+    """Obtiene los datos de archivo desde las tablas asociadas al código.
+
+    Se busca primero la referencia en ``archivomp`` y, para filas aún no
+    migradas, las columnas de contenido históricas.
+    """
+
+    referencia = almacen_archivos.obtener_referencia_por_codigo(
+        conn_pg, codigo_seguimiento
+    )
+    if referencia is not None:
+        contenido = referencia.leer(conn_pg)
+        if contenido:
+            return contenido
 
     consulta_envio = """
         SELECT ecedarchivoseguimientodatos
         FROM enviocedulanotificacionpolicia
-        WHERE TRIM(codigoseguimientomp) = TRIM(%s)
+        WHERE codigoseguimientompnorm = TRIM(%s)
         LIMIT 1
     """
     consulta_historial = """
         SELECT notpolhistoricomparchcont
         FROM notpolhistoricomp
-        WHERE TRIM(codigoseguimientomp) = TRIM(%s)
+        WHERE codigoseguimientompnorm = TRIM(%s)
           AND notpolhistoricomparchivoid IS NOT NULL
           AND notpolhistoricomparchivoid <> 0
-        ORDER BY to_timestamp(
-            left(replace(notpolhistoricompfecha, 'T', ' '), 19),
-            'YYYY-MM-DD HH24:MI:SS'
-        ) DESC NULLS LAST
+        ORDER BY notpolhistoricompfechats DESC NULLS LAST
         LIMIT 1
     """
 
@@ -317,6 +242,7 @@ def _obtener_datos_archivo(
     return None
 
 
+@SUMMARY.cronometrar()
 def _procesar_notificacion(
     conn_pg: psycopg2.extensions.connection,
     notificacion: NotificacionPendiente,
@@ -329,10 +255,9 @@ def _procesar_notificacion(
     _log_step(
         "procesar_por_estado",
         "INICIO",
-        (
-            f"Consultando {notificacion.codigo_seguimiento} "
-            f"(estado actual: {notificacion.fecha_ultimo_estado})"
-        ),
+        "Consultando %s (estado actual: %s)",
+        notificacion.codigo_seguimiento,
+        notificacion.fecha_ultimo_estado,
     )
 
     try:
@@ -367,16 +292,18 @@ def _procesar_notificacion(
         _log_step(
             "procesar_por_estado",
             "ADVERTENCIA",
-            f"Sin resultado para {notificacion.codigo_seguimiento}",
+            "Sin resultado para %s",
+            notificacion.codigo_seguimiento,
         )
         return None, False, None, None, None
 
-    ultimo_estado_xml = _obtener_ultimo_estado_desde_xml(resultado.xml_respuesta)
+    respuesta = respuesta_estado.parsear_respuesta_estado(resultado.xml_respuesta)
+    ultimo_estado_xml = _obtener_ultimo_estado_desde_xml(respuesta)
     estado_nuevo_consola = _obtener_estado_nuevo_para_consola(
-        resultado.xml_respuesta,
+        respuesta,
         notificacion.fecha_ultimo_estado,
     )
-    archivo_id_xml = _obtener_archivo_id_ultimo_estado(resultado.xml_respuesta)
+    archivo_id_xml = _obtener_archivo_id_ultimo_estado(respuesta)
     tiene_archivo_xml = archivo_id_xml is not None
 
     envio = retornoxmlmp.EnvioNotificacion(
@@ -393,14 +320,18 @@ def _procesar_notificacion(
     fecha_ultima = (
         fecha_historial if fecha_historial is not None else notificacion.fecha_ultimo_estado
     )
-    actualizo_historial = historialsian.llamar_his_mp(
-        notificacion.pmovimientoid,
-        notificacion.pactuacionid,
-        notificacion.pdomicilioelectronicopj,
-        notificacion.codigo_seguimiento,
-        fecha_ultima,
-        resultado.xml_respuesta,
-    )
+    # El historial se escribe en conn_pg y se confirma al terminar el código.
+    sesion = historialsian.SesionHistorial(conn_pg, lote=1)
+    with sesion.codigo():
+        actualizo_historial = historialsian.llamar_his_mp(
+            notificacion.pmovimientoid,
+            notificacion.pactuacionid,
+            notificacion.pdomicilioelectronicopj,
+            notificacion.codigo_seguimiento,
+            fecha_ultima,
+            respuesta,
+            sesion=sesion,
+        )
 
     archivo_datos: Optional[str] = None
     archivo_actualizado = False
@@ -409,7 +340,7 @@ def _procesar_notificacion(
             archivo_actualizado = retornoxmlmp._actualizar_datos_archivo(
                 conn_pg,
                 envio,
-                resultado.xml_respuesta,
+                respuesta,
                 usar_test,
             )
         except Exception as exc:  # pragma: no cover - dependiente de la base real
@@ -417,17 +348,17 @@ def _procesar_notificacion(
             _log_step(
                 "procesar_por_estado",
                 "ERROR",
-                (
-                    f"{notificacion.codigo_seguimiento}: "
-                    f"no se pudo actualizar archivo: {exc}"
-                ),
+                "%s: no se pudo actualizar archivo: %s",
+                notificacion.codigo_seguimiento,
+                exc,
             )
             return None, False, None, ultimo_estado_xml, estado_nuevo_consola
         archivo_datos = _obtener_datos_archivo(conn_pg, notificacion.codigo_seguimiento)
     _log_step(
         "procesar_por_estado",
         "OK",
-        f"Actualización completada para {notificacion.codigo_seguimiento}",
+        "Actualización completada para %s",
+        notificacion.codigo_seguimiento,
     )
 
     return (
@@ -446,21 +377,18 @@ def _imprimir_resultado_en_consola(
 ) -> None:
     """Muestra los datos clave solicitados en consola."""
 
-    archivo_texto = datos_archivo or ""
-    estado_nuevo = (estado_nuevo or "").strip()
-    print(
-        "codigoseguimientomp={codigo}, notpolhistoricompestado={estado}, "
-        "estado_anterior_laststage={laststage}, estado_nuevo={estado_nuevo}, "
-        "archivo={archivo}".format(
-            codigo=notificacion.codigo_seguimiento,
-            estado=notificacion.estado_ultimo,
-            laststage=notificacion.estado_envio,
-            estado_nuevo=estado_nuevo,
-            archivo=archivo_texto,
-        )
+    registro.obtener("procesar_por_estado").info(
+        "codigoseguimientomp=%s, notpolhistoricompestado=%s, "
+        "estado_anterior_laststage=%s, estado_nuevo=%s, archivo=%s",
+        notificacion.codigo_seguimiento,
+        notificacion.estado_ultimo,
+        notificacion.estado_envio,
+        (estado_nuevo or "").strip(),
+        registro.truncar(datos_archivo or ""),
     )
 
 
+@SUMMARY.cronometrar()
 def procesar_por_estado(
     estado_objetivo: str,
     usar_test: Optional[bool] = None,
@@ -473,7 +401,7 @@ def procesar_por_estado(
 
     bandera_test = default_test_flag if usar_test is None else usar_test
 
-    with psycopg2.connect(**pgsql_config) as conn_pg:
+    with historialsian.conectar(pgsql_config) as conn_pg:
         conn_pg.autocommit = False
 
         notificaciones = _obtener_notificaciones_por_estado(
@@ -486,10 +414,8 @@ def procesar_por_estado(
             _log_step(
                 "procesar_por_estado",
                 "OK",
-                (
-                    "No se encontraron notificaciones "
-                    f"con estado '{estado_normalizado}'"
-                ),
+                "No se encontraron notificaciones con estado '%s'",
+                estado_normalizado,
             )
             return
 
@@ -545,6 +471,11 @@ def _parse_args(argv: Optional[Iterable[str]] = None) -> argparse.Namespace:
         action="store_true",
         help="Usa el entorno de pruebas del servicio SOAP",
     )
+    parser.add_argument(
+        "--reporte-json",
+        dest="reporte_json",
+        help="Guarda el resumen (conteos, tiempos por paso e idas a la base) en este archivo JSON.",
+    )
     return parser.parse_args(argv)
 
 
@@ -555,6 +486,7 @@ def main(argv: Optional[Iterable[str]] = None) -> None:
         usar_test=args.test,
         codigoseguimientomp=args.codigoseguimientomp,
     )
+    SUMMARY.imprimir(args.reporte_json)
 
 
 if __name__ == "__main__":
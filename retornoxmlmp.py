@@ -4,20 +4,29 @@ Este módulo consulta los registros de ``enviocedulanotificacionpolicia`` que no
 están descartados, ejecuta la operación ``ObtenerEstadoNotificacion`` del
 servicio SOAP del Ministerio y almacena el XML completo obtenido en la tabla
 ``retornomp``. Si el registro ya existe, se actualiza únicamente cuando el
-contenido difiere del almacenado.
+digest del contenido difiere del almacenado.
 """
 
 from __future__ import annotations
 
 import argparse
+import base64
+import binascii
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import dataclass
 from datetime import datetime, timedelta, timezone
 from email.utils import parsedate_to_datetime
+import hashlib
+import os
 from pathlib import Path
-import subprocess
-import sys
+import queue
+import re
+import tempfile
+import threading
 import time
-from typing import Iterable, List, Optional, Tuple
+import uuid
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 import xml.etree.ElementTree as ET
 from xml.dom import minidom
 
@@ -28,13 +37,24 @@ from requests.adapters import HTTPAdapter
 import urllib3
 from urllib3.util.retry import Retry
 
+import almacen_archivos
+import historialsian
+import permanencia
+import registro
+import respuesta_estado
 from historialsian import (
+    SUMMARY,
     _log_step,
     panel_config,
     pgsql_config,
     test as default_test_flag,
 )
 
+# Tamaño de los fragmentos leídos del servicio de archivos y umbral a partir
+# del cual el contenido base64 acumulado pasa de memoria a un archivo temporal.
+TAMANO_FRAGMENTO_ARCHIVO = 64 * 1024
+MAX_CONTENIDO_EN_MEMORIA = 1024 * 1024
+
 # Evita advertencias cuando se deshabilita la verificación del certificado.
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
@@ -53,6 +73,12 @@ MAX_OBSERVACION_LEN = 400
 # la probabilidad de recibir respuestas ``HTTP 429`` cuando se ejecutan muchos
 # requerimientos de manera seguida.
 MIN_INTERVALO_SOAP_SEGUNDOS = 1.5
+
+# Claves de los advisory locks de sesión que coordinan las ejecuciones
+# completas y las particionadas (``--shard``) sobre la base del panel.
+CLAVE_BLOQUEO_RETORNOMP = 731001
+CLAVE_BLOQUEO_PARTICION = 731002
+LIMITADOR_SOAP_ID = 1
 XML_NAMESPACES = {
     "soap": SOAP_ENVELOPE,
     "temp": SOAP_NAMESPACE,
@@ -101,12 +127,70 @@ def _obtener_sesion_soap(max_reintentos: int) -> _SesionSOAP:
     return _SESION_SOAP
 
 
+class _LimitadorCompartido:
+    """Intervalo mínimo entre llamadas SOAP compartido por varios procesos.
+
+    Cada llamada reserva su turno adelantando ``proxima`` en la fila
+    ``limitesoapmp`` con un único ``UPDATE`` en autocommit, de modo que los
+    trabajadores particionados respetan juntos ``MIN_INTERVALO_SOAP_SEGUNDOS``.
+    """
+
+    _SENTENCIA_RESERVAR = """
+        UPDATE public.limitesoapmp
+        SET proxima = GREATEST(proxima, clock_timestamp()) + make_interval(secs => %s)
+        WHERE limitesoapmpid = %s
+        RETURNING EXTRACT(EPOCH FROM (proxima - clock_timestamp())) - %s
+    """
+
+    def __init__(
+        self,
+        conexion: psycopg2.extensions.connection,
+        intervalo: float = MIN_INTERVALO_SOAP_SEGUNDOS,
+    ) -> None:
+        conexion.autocommit = True
+        self._conexion = conexion
+        self._intervalo = intervalo
+        self._bloqueo = threading.Lock()
+
+    def reservar(self) -> float:
+        """Reserva el próximo turno y devuelve los segundos a esperar."""
+
+        with self._bloqueo, self._conexion.cursor() as cursor:
+            cursor.execute(
+                self._SENTENCIA_RESERVAR,
+                (self._intervalo, LIMITADOR_SOAP_ID, self._intervalo),
+            )
+            fila = cursor.fetchone()
+        return max(float(fila[0]), 0.0) if fila else 0.0
+
+    def cerrar(self) -> None:
+        self._conexion.close()
+
+
+_LIMITADOR_COMPARTIDO: Optional[_LimitadorCompartido] = None
+
+
 def _respetar_intervalo_solicitudes() -> None:
     """Garantiza un descanso mínimo entre llamadas al servicio SOAP."""
 
     if MIN_INTERVALO_SOAP_SEGUNDOS <= 0:
         return
 
+    if _LIMITADOR_COMPARTIDO is not None:
+        try:
+            espera = _LIMITADOR_COMPARTIDO.reservar()
+        except psycopg2.Error as exc:
+            _log_step(
+                "_respetar_intervalo_solicitudes",
+                "ADVERTENCIA",
+                "Limitador compartido no disponible, se usa el local: %s",
+                exc,
+            )
+        else:
+            if espera > 0:
+                time.sleep(espera)
+            return
+
     global _ULTIMA_INVOCACION_SOAP
     momento_actual = time.monotonic()
     restante = MIN_INTERVALO_SOAP_SEGUNDOS - (momento_actual - _ULTIMA_INVOCACION_SOAP)
@@ -135,6 +219,110 @@ class ResultadoSOAP:
     xml_respuesta: str
 
 
+class ContenidoArchivo:
+    """Texto base64 de ``ArchivoContenido`` acumulado por fragmentos.
+
+    El contenido se guarda en un ``SpooledTemporaryFile`` que pasa a disco al
+    superar ``MAX_CONTENIDO_EN_MEMORIA`` y se envía a ``archivomp`` con
+    :meth:`fragmentos`, sin materializarlo como ``str``. Al igual que el
+    ``.strip()`` previo, se descartan los espacios iniciales y finales, y el
+    base64 se valida a medida que llega para conocer el tamaño decodificado
+    sin decodificarlo completo. El SHA-256 del texto se calcula en el mismo
+    recorrido y es la clave en ``archivomp``.
+    """
+
+    def __init__(self, max_memoria: int = MAX_CONTENIDO_EN_MEMORIA) -> None:
+        self._archivo = tempfile.SpooledTemporaryFile(max_size=max_memoria)
+        self._espacios_pendientes = ""
+        self._resto_base64 = ""
+        self._sha256 = hashlib.sha256()
+        self.longitud = 0
+        self.tamano_decodificado = 0
+        self.base64_valido = True
+
+    @classmethod
+    def desde_texto(cls, texto: str) -> "ContenidoArchivo":
+        contenido = cls()
+        contenido.escribir(texto)
+        contenido.finalizar()
+        return contenido
+
+    def escribir(self, fragmento: str) -> None:
+        if not fragmento:
+            return
+        if self.longitud == 0:
+            fragmento = fragmento.lstrip()
+        sin_final = fragmento.rstrip()
+        if not sin_final:
+            if self.longitud:
+                self._espacios_pendientes += fragmento
+            return
+        texto = self._espacios_pendientes + sin_final
+        self._espacios_pendientes = fragmento[len(sin_final):]
+        codificado = texto.encode("utf-8")
+        self._archivo.write(codificado)
+        self._sha256.update(codificado)
+        self.longitud += len(texto)
+        self._validar_base64(texto)
+
+    def _validar_base64(self, texto: str) -> None:
+        if not self.base64_valido:
+            return
+        pendiente = self._resto_base64 + "".join(texto.split())
+        corte = len(pendiente) - len(pendiente) % 4
+        self._resto_base64 = pendiente[corte:]
+        try:
+            self.tamano_decodificado += len(base64.b64decode(pendiente[:corte], validate=True))
+        except (binascii.Error, ValueError):
+            self.base64_valido = False
+
+    def finalizar(self) -> None:
+        self._espacios_pendientes = ""
+        if self._resto_base64:
+            self.base64_valido = False
+            self._resto_base64 = ""
+
+    @property
+    def digest(self) -> str:
+        return self._sha256.hexdigest()
+
+    def texto(self) -> str:
+        self._archivo.seek(0)
+        return self._archivo.read().decode("utf-8")
+
+    def fragmentos(self, tamano: int = TAMANO_FRAGMENTO_ARCHIVO) -> Iterator[bytes]:
+        """Recorre el texto UTF-8 almacenado de a ``tamano`` bytes."""
+
+        self._archivo.seek(0)
+        while True:
+            fragmento = self._archivo.read(tamano)
+            if not fragmento:
+                return
+            yield fragmento
+
+    def cerrar(self) -> None:
+        self._archivo.close()
+
+    def __bool__(self) -> bool:
+        return self.longitud > 0
+
+    def __repr__(self) -> str:
+        return (
+            f"ContenidoArchivo(longitud={self.longitud}, "
+            f"tamano_decodificado={self.tamano_decodificado})"
+        )
+
+
+@dataclass(frozen=True)
+class DatosArchivo:
+    """Datos devueltos por ``ObtenerArchivoEstadoNotificacion`` para un envío."""
+
+    estado_id: int
+    archivo_id: Optional[int]
+    archivo_nombre: Optional[str]
+    archivo_contenido: Union[ContenidoArchivo, str, None]
+
+
 @dataclass(frozen=True)
 class IteracionConsulta:
     """Agrupa los parámetros para una iteración de consulta."""
@@ -145,6 +333,7 @@ class IteracionConsulta:
     max_dias: Optional[int] = None
     incluir_estados_vacios: bool = False
     omitir_filtro_estados: bool = False
+    solo_vencidos: bool = False
 
 
 def _asegurar_tablas_panel(conn_panel: psycopg2.extensions.connection) -> None:
@@ -177,12 +366,47 @@ def _asegurar_tablas_panel(conn_panel: psycopg2.extensions.connection) -> None:
             ON public.ejecproc USING btree (procesosatid)
     """
 
+    sentencia_crear_punto_control = """
+        CREATE TABLE IF NOT EXISTS public.puntocontrolretorno (
+            ejecucionid varchar(32) NOT NULL,
+            iteracion text NOT NULL,
+            inicio timestamp NOT NULL,
+            pmovimientoid int8 NULL,
+            pactuacionid int8 NULL,
+            pdomicilioelectronicopj varchar(200) NULL,
+            procesados int4 NOT NULL DEFAULT 0,
+            completada bool NOT NULL DEFAULT FALSE,
+            actualizado timestamp NOT NULL DEFAULT NOW(),
+            particion varchar(20) NOT NULL DEFAULT '',
+            CONSTRAINT puntocontrolretorno_pkey PRIMARY KEY (ejecucionid, iteracion)
+        )
+    """
+
+    sentencia_crear_limitador = """
+        CREATE TABLE IF NOT EXISTS public.limitesoapmp (
+            limitesoapmpid int4 NOT NULL,
+            proxima timestamptz NOT NULL DEFAULT clock_timestamp(),
+            CONSTRAINT limitesoapmp_pkey PRIMARY KEY (limitesoapmpid)
+        )
+    """
+
     with conn_panel.cursor() as cursor:
         cursor.execute("CREATE SEQUENCE IF NOT EXISTS procesosatid")
         cursor.execute("CREATE SEQUENCE IF NOT EXISTS ejecprocid")
         cursor.execute(sentencia_crear_procesos)
         cursor.execute(sentencia_crear_ejecproc)
         cursor.execute(sentencia_crear_indice)
+        cursor.execute(sentencia_crear_punto_control)
+        cursor.execute(
+            "ALTER TABLE public.puntocontrolretorno "
+            "ADD COLUMN IF NOT EXISTS particion varchar(20) NOT NULL DEFAULT ''"
+        )
+        cursor.execute(sentencia_crear_limitador)
+        cursor.execute(
+            "INSERT INTO public.limitesoapmp (limitesoapmpid) VALUES (%s) "
+            "ON CONFLICT DO NOTHING",
+            (LIMITADOR_SOAP_ID,),
+        )
     conn_panel.commit()
 
 
@@ -222,37 +446,214 @@ def _actualizar_inicio_proceso(
     conn_panel.commit()
 
 
-def _registrar_evento_ejecucion(
-    conn_panel: psycopg2.extensions.connection,
-    fecha: datetime,
-    resultado: int,
-    observaciones: str,
-) -> None:
-    """Inserta un registro en ``ejecproc`` con la información indicada."""
+_SENTENCIA_EJECPROC_LOTE = """
+    INSERT INTO public.ejecproc (
+        procesosatid,
+        ejecprocfecha,
+        ejecprocresultado,
+        ejecprocobservaciones
+    )
+    VALUES %s
+"""
 
-    sentencia = """
-        INSERT INTO public.ejecproc (
-            procesosatid,
-            ejecprocfecha,
-            ejecprocresultado,
-            ejecprocobservaciones
-        )
-        VALUES (%s, %s, %s, %s)
-    """
+_FIN_EVENTOS = object()
 
-    texto_observaciones = (observaciones or "")[:MAX_OBSERVACION_LEN]
 
-    with conn_panel.cursor() as cursor:
-        cursor.execute(
-            sentencia,
-            (
-                PROCESO_RETORNOMP_ID,
-                fecha,
-                resultado,
-                texto_observaciones,
-            ),
+def _firma_evento(observaciones: str) -> str:
+    """Clave de agrupación: el texto con los números reemplazados por ``#``."""
+
+    return re.sub(r"\d+", "#", observaciones)
+
+
+class _RegistroEventos:
+    """Registra eventos en ``ejecproc`` de forma asíncrona y por lotes.
+
+    Los eventos se encolan en memoria y un hilo dedicado, con su propia
+    conexión al panel, los escribe cada ``intervalo`` segundos con un
+    ``INSERT`` multi-fila. Los eventos con el mismo resultado y la misma clave
+    de agrupación dentro de un lote se escriben una sola vez con la cantidad
+    de repeticiones. Si la cola supera ``max_cola`` los eventos nuevos se
+    descartan y se deja constancia de cuántos se perdieron. Si una escritura
+    falla se cierra la conexión, el próximo vaciado vuelve a conectar y los
+    eventos se reintentan. ``cerrar`` vacía la cola antes de terminar.
+    """
+
+    def __init__(
+        self,
+        conectar: Callable[[], psycopg2.extensions.connection],
+        intervalo: float = 5.0,
+        max_cola: int = 5000,
+    ) -> None:
+        self._conectar = conectar
+        self._intervalo = intervalo
+        self._max_cola = max(1, max_cola)
+        self._cola: "queue.Queue[object]" = queue.Queue(maxsize=self._max_cola)
+        self._descartados = 0
+        self._bloqueo = threading.Lock()
+        self._hilo = threading.Thread(
+            target=self._ejecutar, name="registro-ejecproc", daemon=True
         )
-    conn_panel.commit()
+        self._hilo.start()
+
+    def __enter__(self) -> "_RegistroEventos":
+        return self
+
+    def __exit__(self, *_exc_info: object) -> None:
+        self.cerrar()
+
+    def registrar(
+        self,
+        fecha: datetime,
+        resultado: int,
+        observaciones: str,
+        clave: Optional[str] = None,
+    ) -> None:
+        """Encola un evento; ``clave`` permite agrupar mensajes equivalentes."""
+
+        texto = observaciones or ""
+        evento = (fecha, resultado, texto, clave or _firma_evento(texto))
+        try:
+            self._cola.put_nowait(evento)
+        except queue.Full:
+            with self._bloqueo:
+                self._descartados += 1
+
+    def cerrar(self) -> None:
+        """Escribe los eventos pendientes y detiene el hilo."""
+
+        if not self._hilo.is_alive():
+            return
+        self._cola.put(_FIN_EVENTOS)
+        self._hilo.join()
+
+    def _ejecutar(self) -> None:
+        conexion: Optional[psycopg2.extensions.connection] = None
+        pendientes: Dict[Tuple[int, str], List[object]] = {}
+        proximo_vaciado = time.monotonic() + self._intervalo
+        finalizar = False
+
+        try:
+            while not finalizar:
+                espera = max(0.0, proximo_vaciado - time.monotonic())
+                try:
+                    evento = self._cola.get(timeout=espera)
+                except queue.Empty:
+                    evento = None
+
+                while evento is not None:
+                    if evento is _FIN_EVENTOS:
+                        finalizar = True
+                    else:
+                        self._agrupar(pendientes, evento)
+                    try:
+                        evento = self._cola.get_nowait()
+                    except queue.Empty:
+                        evento = None
+
+                if finalizar or time.monotonic() >= proximo_vaciado:
+                    if pendientes or self._descartados:
+                        conexion = self._vaciar(conexion, pendientes)
+                    proximo_vaciado = time.monotonic() + self._intervalo
+        finally:
+            self._cerrar_conexion(conexion)
+            perdidos = sum(agrupado[3] for agrupado in pendientes.values())  # type: ignore[misc]
+            if perdidos or self._descartados:
+                _log_step(
+                    "_RegistroEventos",
+                    "ERROR",
+                    "Se perdieron %s eventos sin registrar en ejecproc (%s descartados)",
+                    perdidos,
+                    self._descartados,
+                )
+
+    def _vaciar(
+        self,
+        conexion: Optional[psycopg2.extensions.connection],
+        pendientes: Dict[Tuple[int, str], List[object]],
+    ) -> Optional[psycopg2.extensions.connection]:
+        """Escribe ``pendientes`` y devuelve la conexión para el próximo vaciado.
+
+        Ante cualquier error la conexión se cierra y se devuelve ``None`` para
+        reconectar; los eventos quedan en ``pendientes`` hasta ``max_cola``
+        grupos y el resto se suma a los descartados.
+        """
+
+        try:
+            if conexion is None:
+                conexion = self._conectar()
+            self._escribir(conexion, pendientes)
+            return conexion
+        except Exception as exc:
+            _log_step(
+                "_RegistroEventos",
+                "ERROR",
+                "No se pudieron registrar %s eventos en ejecproc: %s",
+                sum(agrupado[3] for agrupado in pendientes.values()),  # type: ignore[misc]
+                exc,
+            )
+            self._cerrar_conexion(conexion)
+            exceso = len(pendientes) - self._max_cola
+            if exceso > 0:
+                for clave in list(pendientes)[:exceso]:
+                    with self._bloqueo:
+                        self._descartados += pendientes.pop(clave)[3]  # type: ignore[operator]
+            return None
+
+    @staticmethod
+    def _cerrar_conexion(conexion: Optional[psycopg2.extensions.connection]) -> None:
+        if conexion is None:
+            return
+        try:
+            conexion.close()
+        except Exception:
+            pass
+
+    @staticmethod
+    def _agrupar(
+        pendientes: Dict[Tuple[int, str], List[object]], evento: object
+    ) -> None:
+        fecha, resultado, texto, clave = evento  # type: ignore[misc]
+        agrupado = pendientes.get((resultado, clave))
+        if agrupado is None:
+            pendientes[(resultado, clave)] = [fecha, resultado, texto, 1]
+        else:
+            agrupado[3] += 1  # type: ignore[operator]
+
+    def _escribir(
+        self,
+        conexion: psycopg2.extensions.connection,
+        pendientes: Dict[Tuple[int, str], List[object]],
+    ) -> None:
+        with self._bloqueo:
+            descartados, self._descartados = self._descartados, 0
+
+        filas = []
+        for fecha, resultado, texto, cantidad in pendientes.values():
+            sufijo = f" (x{cantidad})" if cantidad > 1 else ""  # type: ignore[operator]
+            observaciones = texto[: MAX_OBSERVACION_LEN - len(sufijo)] + sufijo  # type: ignore[index]
+            filas.append((PROCESO_RETORNOMP_ID, fecha, resultado, observaciones))
+        if descartados:
+            filas.append(
+                (
+                    PROCESO_RETORNOMP_ID,
+                    datetime.now(),
+                    0,
+                    f"[procesar_envios] Eventos descartados por cola llena: {descartados}",
+                )
+            )
+
+        try:
+            with conexion.cursor() as cursor:
+                extras.execute_values(
+                    cursor, _SENTENCIA_EJECPROC_LOTE, filas, page_size=len(filas)
+                )
+            conexion.commit()
+        except BaseException:
+            # La transacción se descarta al cerrar la conexión en _vaciar.
+            with self._bloqueo:
+                self._descartados += descartados
+            raise
+        pendientes.clear()
 
 
 ITERACIONES: Tuple[IteracionConsulta, ...] = (
@@ -347,58 +748,247 @@ ITERACIONES: Tuple[IteracionConsulta, ...] = (
     ),
 )
 
+# Con ``--segun-permanencia`` se reemplazan las ventanas fijas por una única
+# iteración sobre los envíos cuya ``proximaconsultasian`` (calculada por
+# ``permanencia.py``) ya pasó.
+ITERACION_PERMANENCIA = IteracionConsulta(
+    descripcion="Próxima consulta vencida según modelo de permanencia",
+    estados=(),
+    max_dias=45,
+    omitir_filtro_estados=True,
+    solo_vencidos=True,
+)
 
-def _ejecutar_historial_sian(
-    codigo_seguimiento: Optional[str] = None,
-) -> None:
-    """Ejecuta ``historialsian.py`` y espera a que finalice.
-
-    Parameters
-    ----------
-    codigo_seguimiento:
-        Código específico que se desea procesar. Cuando es ``None`` se
-        ejecuta el comportamiento tradicional que procesa todos los
-        retornos pendientes.
+
+class _EjecutorHistorial:
+    """Ejecuta :func:`historialsian.procesar_historial` dentro del proceso.
+
+    En modo normal usa las conexiones de ``procesar_envios`` y espera a que
+    termine. Con ``en_segundo_plano`` cada ejecución se encola en un único
+    hilo con conexiones propias, de modo que la conciliación se superpone con
+    la consulta del siguiente grupo de envíos; ``esperar`` bloquea hasta que
+    finalicen todas las ejecuciones encoladas.
     """
 
-    script_path = Path(__file__).resolve().parent / "historialsian.py"
-    if not script_path.exists():
-        _log_step(
-            "procesar_envios",
-            "ERROR",
-            f"No se encontró historialsian.py en {script_path}",
+    def __init__(
+        self,
+        conn_pg: psycopg2.extensions.connection,
+        conn_panel: psycopg2.extensions.connection,
+        en_segundo_plano: bool = False,
+    ) -> None:
+        self._conn_pg = conn_pg
+        self._conn_panel = conn_panel
+        self._ejecutor: Optional[ThreadPoolExecutor] = (
+            ThreadPoolExecutor(max_workers=1, thread_name_prefix="historial")
+            if en_segundo_plano
+            else None
+        )
+        self._pendientes: List[Future] = []
+
+    def ejecutar(
+        self,
+        retornos: Iterable[historialsian.RetornoPendiente],
+        codigo_seguimiento: Optional[str] = None,
+    ) -> None:
+        retornos = list(retornos)
+        if self._ejecutor is None:
+            self._procesar(self._conn_pg, self._conn_panel, retornos, codigo_seguimiento)
+            return
+        self._pendientes.append(
+            self._ejecutor.submit(
+                self._procesar_con_conexiones_propias, retornos, codigo_seguimiento
+            )
         )
-        return
 
-    _log_step(
-        "procesar_envios",
-        "INICIO",
-        f"Ejecutando {script_path.name}",
-    )
+    def esperar(self) -> None:
+        if self._ejecutor is None:
+            return
+        for futuro in self._pendientes:
+            futuro.result()
+        self._pendientes.clear()
+        self._ejecutor.shutdown(wait=True)
+
+    def _procesar_con_conexiones_propias(
+        self,
+        retornos: List[historialsian.RetornoPendiente],
+        codigo_seguimiento: Optional[str],
+    ) -> None:
+        try:
+            with historialsian.conectar(pgsql_config) as conn_pg, historialsian.conectar(
+                panel_config
+            ) as conn_panel:
+                self._procesar(conn_pg, conn_panel, retornos, codigo_seguimiento)
+        except psycopg2.Error as exc:
+            _log_step(
+                "procesar_envios",
+                "ERROR",
+                "historial en segundo plano sin conexión: %s",
+                exc,
+            )
 
-    try:
-        comando = [sys.executable, str(script_path)]
-        if codigo_seguimiento:
-            comando.extend(["--codigodeseguimientomp", codigo_seguimiento])
-        subprocess.run(comando, check=True)
-    except (subprocess.CalledProcessError, OSError) as exc:
-        print(
-            f"[retornoxmlmp] historialsian.py finalizó con error: {exc}",
-            flush=True,
-        )
+    @staticmethod
+    def _procesar(
+        conn_pg: psycopg2.extensions.connection,
+        conn_panel: psycopg2.extensions.connection,
+        retornos: List[historialsian.RetornoPendiente],
+        codigo_seguimiento: Optional[str],
+    ) -> None:
         _log_step(
             "procesar_envios",
-            "ERROR",
-            f"historialsian.py finalizó con error: {exc}",
+            "INICIO",
+            "Ejecutando historial para %s retornos modificados",
+            len(retornos),
         )
-    else:
-        mensaje = "historialsian.py finalizó correctamente"
-        if codigo_seguimiento:
-            mensaje = (
-                f"historialsian.py finalizó correctamente para "
-                f"{codigo_seguimiento}"
+        try:
+            historialsian.procesar_historial(
+                conn_pg,
+                conn_panel,
+                retornos,
+                codigodeseguimientomp=codigo_seguimiento,
+            )
+        except Exception as exc:
+            conn_pg.rollback()
+            conn_panel.rollback()
+            _log_step(
+                "procesar_envios",
+                "ERROR",
+                "historial finalizó con error: %s",
+                exc,
+            )
+        else:
+            mensaje = "historial finalizó correctamente"
+            if codigo_seguimiento:
+                mensaje = f"historial finalizó correctamente para {codigo_seguimiento}"
+            _log_step("procesar_envios", "OK", mensaje)
+
+
+@dataclass(frozen=True)
+class Particion:
+    """Parte ``indice`` de ``total`` (base 1) de los envíos candidatos.
+
+    Los envíos se reparten por un hash del código de seguimiento normalizado,
+    así cada código pertenece siempre a la misma partición.
+    """
+
+    indice: int
+    total: int
+
+    def __post_init__(self) -> None:
+        if self.total < 1 or not 1 <= self.indice <= self.total:
+            raise ValueError(
+                f"Partición inválida {self.indice}/{self.total}: se espera 1 <= i <= N"
             )
-        _log_step("procesar_envios", "OK", mensaje)
+
+    @classmethod
+    def desde_texto(cls, texto: str) -> "Particion":
+        try:
+            indice, total = (int(parte) for parte in texto.split("/"))
+        except ValueError:
+            raise ValueError(f"Partición inválida '{texto}': se espera el formato i/N")
+        return cls(indice, total)
+
+    def __str__(self) -> str:
+        return f"{self.indice}/{self.total}"
+
+
+class _BloqueoEjecucion:
+    """Advisory locks de sesión que evitan solapar ejecuciones.
+
+    Una ejecución completa toma ``CLAVE_BLOQUEO_RETORNOMP`` en modo exclusivo y
+    cada trabajador particionado lo toma compartido, más un bloqueo exclusivo
+    por número de partición. Como gestor de contexto devuelve si se obtuvieron
+    los bloqueos y los libera al salir.
+    """
+
+    def __init__(
+        self,
+        conn_panel: psycopg2.extensions.connection,
+        particion: Optional[Particion] = None,
+        activo: bool = True,
+    ) -> None:
+        self._conn_panel = conn_panel
+        self._particion = particion
+        self._activo = activo
+        self._adquirido = False
+
+    def __enter__(self) -> bool:
+        if not self._activo:
+            return True
+        self._adquirido = self.adquirir()
+        return self._adquirido
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if self._adquirido:
+            self.liberar()
+
+    def adquirir(self) -> bool:
+        with self._conn_panel.cursor() as cursor:
+            if self._particion is None:
+                cursor.execute(
+                    "SELECT pg_try_advisory_lock(%s)", (CLAVE_BLOQUEO_RETORNOMP,)
+                )
+                adquirido = cursor.fetchone()[0]
+            else:
+                cursor.execute(
+                    "SELECT pg_try_advisory_lock_shared(%s)",
+                    (CLAVE_BLOQUEO_RETORNOMP,),
+                )
+                adquirido = cursor.fetchone()[0]
+                if adquirido:
+                    cursor.execute(
+                        "SELECT pg_try_advisory_lock(%s, %s)",
+                        (CLAVE_BLOQUEO_PARTICION, self._particion.indice),
+                    )
+                    adquirido = cursor.fetchone()[0]
+                    if not adquirido:
+                        cursor.execute(
+                            "SELECT pg_advisory_unlock_shared(%s)",
+                            (CLAVE_BLOQUEO_RETORNOMP,),
+                        )
+        self._conn_panel.commit()
+        return adquirido
+
+    def liberar(self) -> None:
+        if self._conn_panel.closed:
+            return
+        self._conn_panel.rollback()
+        with self._conn_panel.cursor() as cursor:
+            if self._particion is None:
+                cursor.execute(
+                    "SELECT pg_advisory_unlock(%s)", (CLAVE_BLOQUEO_RETORNOMP,)
+                )
+            else:
+                cursor.execute(
+                    "SELECT pg_advisory_unlock(%s, %s)",
+                    (CLAVE_BLOQUEO_PARTICION, self._particion.indice),
+                )
+                cursor.execute(
+                    "SELECT pg_advisory_unlock_shared(%s)",
+                    (CLAVE_BLOQUEO_RETORNOMP,),
+                )
+        self._conn_panel.commit()
+        self._adquirido = False
+
+
+class _UsoLimitadorCompartido:
+    """Activa ``_LIMITADOR_COMPARTIDO`` mientras dura el bloque ``with``."""
+
+    def __init__(self, activo: bool) -> None:
+        self._activo = activo
+        self._limitador: Optional[_LimitadorCompartido] = None
+
+    def __enter__(self) -> Optional[_LimitadorCompartido]:
+        global _LIMITADOR_COMPARTIDO
+        if self._activo:
+            self._limitador = _LimitadorCompartido(historialsian.conectar(panel_config))
+            _LIMITADOR_COMPARTIDO = self._limitador
+        return self._limitador
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        global _LIMITADOR_COMPARTIDO
+        if self._limitador is not None:
+            _LIMITADOR_COMPARTIDO = None
+            self._limitador.cerrar()
 
 
 def _obtener_envios(
@@ -406,6 +996,7 @@ def _obtener_envios(
     iteracion: IteracionConsulta,
     momento_referencia: datetime,
     codigo_especifico: Optional[str] = None,
+    particion: Optional[Particion] = None,
 ) -> List[EnvioNotificacion]:
     """Obtiene los envíos a consultar en el servicio SOAP para una iteración."""
 
@@ -428,14 +1019,15 @@ def _obtener_envios(
           AND (
             COALESCE(laststagesian, '') <> 'Finalizada'
             OR (
-                COALESCE(ecedarchivoseguimientodatos, '') = ''
+                ecedarchivoseguimientodigest IS NULL
+                AND COALESCE(ecedarchivoseguimientodatos, '') = ''
                 AND EXISTS (
                     SELECT 1
                     FROM (
                         SELECT n.notpolhistoricomparchivoid
                         FROM notpolhistoricomp AS n
-                        WHERE TRIM(n.codigoseguimientomp) = TRIM(enviocedulanotificacionpolicia.codigoseguimientomp)
-                        ORDER BY n.notpolhistoricompfecha DESC NULLS LAST
+                        WHERE n.codigoseguimientompnorm = enviocedulanotificacionpolicia.codigoseguimientompnorm
+                        ORDER BY n.notpolhistoricompfechats DESC NULLS LAST
                         LIMIT 1
                     ) AS ultimo_archivo
                     WHERE ultimo_archivo.notpolhistoricomparchivoid IS NOT NULL
@@ -463,6 +1055,12 @@ def _obtener_envios(
     if codigo_especifico is None:
         consulta += "\n          AND fechalaststate IS NOT NULL"
 
+    if iteracion.solo_vencidos:
+        consulta += (
+            "\n          AND (proximaconsultasian IS NULL OR proximaconsultasian <= %s)"
+        )
+        params.append(momento_referencia)
+
     if iteracion.max_dias is not None:
         fecha_minima = momento_referencia - timedelta(days=iteracion.max_dias)
         consulta += "\n          AND fechalaststate >= %s"
@@ -474,9 +1072,15 @@ def _obtener_envios(
         params.append(fecha_maxima)
 
     if codigo_especifico is not None:
-        consulta += "\n          AND TRIM(codigoseguimientomp) = %s"
+        consulta += "\n          AND codigoseguimientompnorm = %s"
         params.append(codigo_especifico.strip())
 
+    if particion is not None:
+        consulta += (
+            "\n          AND mod(abs(hashtext(codigoseguimientompnorm)::bigint), %s) = %s"
+        )
+        params.extend((particion.total, particion.indice - 1))
+
     consulta += """
         ORDER BY penviocedulanotificacionfechahora,
                  pmovimientoid,
@@ -544,21 +1148,33 @@ def _construir_xml_peticion_archivo(estado_notificacion_id: str) -> str:
 
 
 def _host_soap(usar_test: bool) -> str:
-    """Devuelve la URL base del servicio SOAP según el entorno."""
+    """Devuelve la URL base del servicio SOAP según el entorno.
+
+    ``MP_SOAP_HOST`` reemplaza ambos entornos, por ejemplo para apuntar al
+    simulador local de ``mp_simulado.py``.
+    """
 
+    host_alternativo = os.environ.get("MP_SOAP_HOST", "").strip()
+    if host_alternativo:
+        return host_alternativo.rstrip("/")
     if usar_test:
         return "https://pruebasian.mpublico.gov.ar"
     return "https://sian.mpublico.gov.ar"
 
 
+@SUMMARY.cronometrar()
 def _invocar_servicio(
     codigo_seguimiento: str,
     usar_test: bool,
     timeout: int = 60,
     max_reintentos: int = 3,
-    mostrar_respuesta: bool = True,
+    mostrar_respuesta: Optional[bool] = None,
 ) -> Tuple[Optional[ResultadoSOAP], Optional[str]]:
-    """Invoca el servicio SOAP y retorna el XML completo de la respuesta."""
+    """Invoca el servicio SOAP y retorna el XML completo de la respuesta.
+
+    El XML solo se vuelca al log (categoría ``soap.xml``) con
+    ``mostrar_respuesta=True`` o, por defecto, con ``SIAN_LOG_XML``.
+    """
 
     url = f"{_host_soap(usar_test)}/services/wsNotificacion.asmx"
     payload = _construir_xml_peticion(codigo_seguimiento)
@@ -639,21 +1255,30 @@ def _invocar_servicio(
         )
         return None, mensaje_error
 
+    if mostrar_respuesta is None:
+        mostrar_respuesta = registro.depurar_xml()
     if mostrar_respuesta:
-        xml_legible = _formatear_xml_legible(xml_texto)
-        print(f"CODIGODESEGUIMIENTOMP: {codigo_seguimiento}")
-        print(f"XML amigable:\n{xml_legible}\n")
+        registro.obtener("soap.xml").info(
+            "CODIGODESEGUIMIENTOMP: %s\nXML amigable:\n%s\n",
+            codigo_seguimiento,
+            registro.diferido(_formatear_xml_legible, xml_texto),
+        )
 
     return ResultadoSOAP(codigo_seguimiento=codigo_seguimiento, xml_respuesta=xml_texto), None
 
 
+@SUMMARY.cronometrar()
 def _invocar_servicio_archivo(
     estado_notificacion_id: str,
     usar_test: bool,
     timeout: int = 60,
     max_reintentos: int = 3,
-) -> Tuple[Optional[str], Optional[str]]:
-    """Invoca el servicio SOAP para obtener el archivo asociado."""
+) -> Tuple[Optional[dict[str, object]], Optional[str]]:
+    """Invoca el servicio SOAP para obtener el archivo asociado.
+
+    La respuesta se lee en fragmentos y se parsea a medida que llega, sin
+    retener el documento completo.
+    """
 
     url = f"{_host_soap(usar_test)}/services/wsNotificacion.asmx"
     payload = _construir_xml_peticion_archivo(estado_notificacion_id)
@@ -671,6 +1296,7 @@ def _invocar_servicio_archivo(
             data=payload,
             headers=headers,
             timeout=timeout,
+            stream=True,
         )
     except requests.RequestException as exc:
         mensaje_error = f"{estado_notificacion_id}: error de red {exc}"
@@ -711,6 +1337,7 @@ def _invocar_servicio_archivo(
             "ADVERTENCIA",
             mensaje_error,
         )
+        respuesta.close()
         if segundos_espera:
             time.sleep(segundos_espera)
         return None, mensaje_error
@@ -719,6 +1346,7 @@ def _invocar_servicio_archivo(
         mensaje_error = (
             f"{estado_notificacion_id}: HTTP {respuesta.status_code} {respuesta.text}"
         )
+        respuesta.close()
         _log_step(
             "_invocar_servicio_archivo",
             "ERROR",
@@ -726,8 +1354,30 @@ def _invocar_servicio_archivo(
         )
         return None, mensaje_error
 
-    xml_texto = respuesta.text.strip()
-    if not xml_texto:
+    con_contenido = False
+
+    def _fragmentos() -> Iterable[bytes]:
+        # Todos los fragmentos van al parser: uno formado solo por espacios
+        # puede ser parte de un texto y ``_ReceptorArchivo`` decide qué recortar.
+        nonlocal con_contenido
+        for fragmento in respuesta.iter_content(chunk_size=TAMANO_FRAGMENTO_ARCHIVO):
+            con_contenido = con_contenido or bool(fragmento.strip())
+            yield fragmento
+
+    try:
+        datos_archivo = _extraer_datos_archivo(_fragmentos())
+    except requests.RequestException as exc:
+        mensaje_error = f"{estado_notificacion_id}: error de red {exc}"
+        _log_step(
+            "_invocar_servicio_archivo",
+            "ERROR",
+            mensaje_error,
+        )
+        return None, mensaje_error
+    finally:
+        respuesta.close()
+
+    if not con_contenido:
         mensaje_error = f"{estado_notificacion_id}: respuesta vacía del servicio de archivo"
         _log_step(
             "_invocar_servicio_archivo",
@@ -736,7 +1386,7 @@ def _invocar_servicio_archivo(
         )
         return None, mensaje_error
 
-    return xml_texto, None
+    return datos_archivo, None
 
 
 def _formatear_xml_legible(xml_texto: str) -> str:
@@ -751,126 +1401,121 @@ def _formatear_xml_legible(xml_texto: str) -> str:
         return xml_texto
 
 
-def _obtener_texto_xml(
-    nodo: ET.Element, tag: str, namespaces: dict[str, str]
+def _extraer_estado_notificacion_id(
+    xml_respuesta: Union[str, respuesta_estado.RespuestaEstadoNotificacion, None],
 ) -> Optional[str]:
-    elemento = nodo.find(f"temp:{tag}", namespaces)
-    if elemento is None or elemento.text is None:
-        return None
-    texto = elemento.text.strip()
-    return texto if texto else None
-
-
-def _parsear_fecha_xml(fecha_texto: Optional[str]) -> Optional[datetime]:
-    if not fecha_texto:
-        return None
-
-    valor = fecha_texto.strip()
-    if not valor:
-        return None
-
-    try:
-        fecha = datetime.fromisoformat(valor.replace("Z", "+00:00"))
-    except ValueError:
-        return None
+    """Extrae el identificador de estado desde el XML del servicio SOAP.
 
-    if fecha.tzinfo is not None:
-        return fecha.replace(tzinfo=None)
-    return fecha
-
-
-def _extraer_estado_notificacion_id(xml_respuesta: str) -> Optional[str]:
-    """Extrae el identificador de estado desde el XML del servicio SOAP."""
+    Prioriza el estado más reciente con archivo adjunto; si no hay, el estado
+    más reciente del historial y, en último caso, el ``EstadoNotificacionId``
+    que aparezca fuera del historial.
+    """
 
     if not xml_respuesta:
         return None
 
-    try:
-        root = ET.fromstring(xml_respuesta)
-    except ET.ParseError as exc:
+    respuesta = respuesta_estado.parsear_respuesta_estado(xml_respuesta)
+    if not respuesta.xml_valido:
         _log_step(
             "_extraer_estado_notificacion_id",
             "ADVERTENCIA",
-            f"No se pudo parsear XML de estado: {exc}",
+            "No se pudo parsear XML de estado: %s",
+            respuesta.errores[0],
         )
         return None
 
-    estados = root.findall(
-        ".//temp:HistorialEstados/temp:EstadoNotificacion",
-        XML_NAMESPACES,
-    )
-    if estados:
-        candidatos: list[tuple[Optional[datetime], int, str]] = []
-        candidatos_archivo: list[tuple[Optional[datetime], int, str]] = []
-        for indice, estado_node in enumerate(estados):
-            estado_id = _obtener_texto_xml(
-                estado_node, "EstadoNotificacionId", XML_NAMESPACES
-            )
-            if not estado_id:
-                continue
-            fecha_texto = _obtener_texto_xml(estado_node, "Fecha", XML_NAMESPACES)
-            fecha_estado = _parsear_fecha_xml(fecha_texto)
-            candidatos.append((fecha_estado, indice, estado_id))
-
-            archivo_id = _obtener_texto_xml(estado_node, "ArchivoId", XML_NAMESPACES)
-            if archivo_id and archivo_id != "0":
-                candidatos_archivo.append((fecha_estado, indice, estado_id))
-
-        if candidatos_archivo:
-            _, _, estado_id = max(
-                candidatos_archivo,
-                key=lambda item: (item[0] is not None, item[0] or datetime.min, item[1]),
-            )
-            return estado_id
+    return respuesta.estado_id_archivo
 
-        if candidatos:
-            _, _, estado_id = max(
-                candidatos,
-                key=lambda item: (item[0] is not None, item[0] or datetime.min, item[1]),
-            )
-            return estado_id
 
-    nodo_estado = root.find(".//temp:EstadoNotificacionId", XML_NAMESPACES)
-    if nodo_estado is None or nodo_estado.text is None:
-        return None
+class _ReceptorArchivo:
+    """Destino de ``XMLParser`` que captura los campos del archivo."""
 
-    estado_id = nodo_estado.text.strip()
-    return estado_id if estado_id else None
+    _CAMPOS = {
+        f"{{{SOAP_NAMESPACE}}}ArchivoId": "archivo_id",
+        f"{{{SOAP_NAMESPACE}}}ArchivoNombre": "archivo_nombre",
+        f"{{{SOAP_NAMESPACE}}}ArchivoContenido": "archivo_contenido",
+    }
+
+    def __init__(self) -> None:
+        self.valores: dict[str, Optional[str]] = {}
+        self.contenido: Optional[ContenidoArchivo] = None
+        self._campo: Optional[str] = None
+        self._texto: list[str] = []
+
+    def start(self, tag: str, attrib: dict[str, str]) -> None:
+        campo = self._CAMPOS.get(tag)
+        if campo is None or campo in self.valores:
+            return
+        if campo == "archivo_contenido" and self.contenido is not None:
+            return
+        self._campo = campo
+        self._texto = []
+        if campo == "archivo_contenido":
+            self.contenido = ContenidoArchivo()
+
+    def end(self, tag: str) -> None:
+        if self._campo is None or self._CAMPOS.get(tag) != self._campo:
+            return
+        if self._campo == "archivo_contenido":
+            self.contenido.finalizar()
+        else:
+            self.valores[self._campo] = "".join(self._texto).strip() or None
+        self._campo = None
+
+    def data(self, texto: str) -> None:
+        if self._campo == "archivo_contenido":
+            self.contenido.escribir(texto)
+        elif self._campo is not None:
+            self._texto.append(texto)
+
+    def close(self) -> "_ReceptorArchivo":
+        return self
+
+
+def _describir_contenido(contenido: Union[ContenidoArchivo, str]) -> str:
+    if not isinstance(contenido, ContenidoArchivo):
+        return contenido
+    return (
+        f"{contenido.longitud} caracteres base64, "
+        f"{contenido.tamano_decodificado} bytes"
+        + ("" if contenido.base64_valido else " (base64 inválido)")
+    )
 
 
 def _extraer_datos_archivo(
-    xml_respuesta: str,
-) -> Optional[dict[str, Optional[str]]]:
-    """Extrae datos de archivo desde la respuesta SOAP."""
+    xml_respuesta: Union[str, bytes, Iterable[bytes], None],
+) -> Optional[dict[str, object]]:
+    """Extrae datos de archivo desde la respuesta SOAP.
+
+    Acepta el XML completo o un iterable de fragmentos; en ambos casos se
+    parsea de forma incremental y ``archivo_contenido`` se devuelve como
+    :class:`ContenidoArchivo`.
+    """
 
     if not xml_respuesta:
         return None
 
+    fragmentos = (
+        (xml_respuesta,) if isinstance(xml_respuesta, (str, bytes)) else xml_respuesta
+    )
+    receptor = _ReceptorArchivo()
+    parser = ET.XMLParser(target=receptor)
     try:
-        root = ET.fromstring(xml_respuesta)
+        for fragmento in fragmentos:
+            parser.feed(fragmento)
+        parser.close()
     except ET.ParseError as exc:
         _log_step(
             "_extraer_datos_archivo",
             "ADVERTENCIA",
-            f"No se pudo parsear XML de archivo: {exc}",
+            "No se pudo parsear XML de archivo: %s",
+            exc,
         )
         return None
 
-    archivo_id = None
-    archivo_nombre = None
-    archivo_contenido = None
-
-    nodo_archivo_id = root.find(".//temp:ArchivoId", XML_NAMESPACES)
-    if nodo_archivo_id is not None and nodo_archivo_id.text is not None:
-        archivo_id = nodo_archivo_id.text.strip() or None
-
-    nodo_archivo_nombre = root.find(".//temp:ArchivoNombre", XML_NAMESPACES)
-    if nodo_archivo_nombre is not None and nodo_archivo_nombre.text is not None:
-        archivo_nombre = nodo_archivo_nombre.text.strip() or None
-
-    nodo_archivo_contenido = root.find(".//temp:ArchivoContenido", XML_NAMESPACES)
-    if nodo_archivo_contenido is not None and nodo_archivo_contenido.text is not None:
-        archivo_contenido = nodo_archivo_contenido.text.strip() or None
+    archivo_id = receptor.valores.get("archivo_id")
+    archivo_nombre = receptor.valores.get("archivo_nombre")
+    archivo_contenido: Union[ContenidoArchivo, str, None] = receptor.contenido or None
 
     if archivo_id is None and archivo_nombre is None and archivo_contenido is None:
         return None
@@ -880,13 +1525,11 @@ def _extraer_datos_archivo(
 
     _log_step(
         "_extraer_datos_archivo",
-        "INFO",
-        (
-            "Datos de archivo obtenidos: "
-            f"archivo_id={archivo_id}, "
-            f"archivo_nombre={archivo_nombre}, "
-            f"archivo_contenido={archivo_contenido}"
-        ),
+        "OK",
+        "Datos de archivo obtenidos: archivo_id=%s, archivo_nombre=%s, archivo_contenido=%s",
+        archivo_id,
+        archivo_nombre,
+        registro.diferido(_describir_contenido, archivo_contenido),
     )
 
     return {
@@ -896,18 +1539,105 @@ def _extraer_datos_archivo(
     }
 
 
-def _actualizar_datos_archivo(
-    conn_pg: psycopg2.extensions.connection,
+_SENTENCIA_ARCHIVOS_DESCARGADOS = """
+    SELECT codigoseguimientompnorm, ecedarchivosegnotid, ecedarchivoseguimientoid
+    FROM enviocedulanotificacionpolicia
+    WHERE codigoseguimientompnorm = ANY(%s)
+      AND ecedarchivosegnotid IS NOT NULL
+      AND (
+        ecedarchivoseguimientodigest IS NOT NULL
+        OR COALESCE(ecedarchivoseguimientodatos, '') <> ''
+      )
+"""
+
+
+class _IndiceArchivosDescargados:
+    """Estados cuyo archivo ya fue descargado, para no pedirlo de nuevo.
+
+    Se carga en bloque con los envíos de cada iteración y se mantiene en
+    memoria durante la ejecución. Un archivo se vuelve a descargar solo si
+    cambió el ``EstadoNotificacionId`` elegido o el ``ArchivoId`` informado en
+    el XML de estado.
+    """
+
+    def __init__(self) -> None:
+        self._descargados: Dict[str, Tuple[int, Optional[int]]] = {}
+        self._codigos_cargados: set[str] = set()
+        self.llamadas_evitadas = 0
+
+    def cargar(
+        self,
+        conn_pg: psycopg2.extensions.connection,
+        envios: Iterable[EnvioNotificacion],
+    ) -> None:
+        codigos = {
+            envio.codigoseguimientomp.strip() for envio in envios
+        } - self._codigos_cargados
+        if not codigos:
+            return
+        with conn_pg.cursor() as cursor:
+            cursor.execute(_SENTENCIA_ARCHIVOS_DESCARGADOS, (sorted(codigos),))
+            for codigo, estado_id, archivo_id in cursor.fetchall():
+                self._descargados[codigo] = (
+                    int(estado_id),
+                    int(archivo_id) if archivo_id is not None else None,
+                )
+        self._codigos_cargados.update(codigos)
+
+    def ya_descargado(
+        self, codigo: str, estado_id: int, archivo_id: Optional[int]
+    ) -> bool:
+        descargado = self._descargados.get(codigo.strip())
+        if descargado is None or descargado[0] != estado_id:
+            return False
+        if archivo_id is not None and descargado[1] != archivo_id:
+            return False
+        self.llamadas_evitadas += 1
+        return True
+
+    def registrar(self, codigo: str, datos: DatosArchivo) -> None:
+        self._descargados[codigo.strip()] = (datos.estado_id, datos.archivo_id)
+
+
+def _archivo_id_seleccionado(
+    xml_respuesta: Union[str, respuesta_estado.RespuestaEstadoNotificacion],
+    estado_id: str,
+) -> Optional[int]:
+    """``ArchivoId`` que informa el XML de estado para ``estado_id``."""
+
+    respuesta = respuesta_estado.parsear_respuesta_estado(xml_respuesta)
+    estado = respuesta.ultimo_estado_con_archivo
+    if estado is None or str(estado.estado_id) != estado_id:
+        return None
+    try:
+        return int(estado.archivo_id)
+    except (TypeError, ValueError):
+        return None
+
+
+def _obtener_datos_archivo_envio(
     envio: EnvioNotificacion,
-    xml_respuesta: str,
+    xml_respuesta: Union[str, respuesta_estado.RespuestaEstadoNotificacion],
     usar_test: bool,
     mostrar_llamado_archivo: bool = False,
-) -> bool:
-    """Actualiza los datos de archivo en enviocedulanotificacionpolicia."""
+    indice: Optional[_IndiceArchivosDescargados] = None,
+) -> Optional[DatosArchivo]:
+    """Consulta ``ObtenerArchivoEstadoNotificacion`` para el estado del envío.
+
+    Con ``indice`` se omite la consulta cuando el archivo de ese estado ya fue
+    descargado.
+    """
 
     estado_id = _extraer_estado_notificacion_id(xml_respuesta)
     if not estado_id:
-        return False
+        return None
+
+    if indice is not None and estado_id.isdigit() and indice.ya_descargado(
+        envio.codigoseguimientomp,
+        int(estado_id),
+        _archivo_id_seleccionado(xml_respuesta, estado_id),
+    ):
+        return None
 
     if mostrar_llamado_archivo:
         url = f"{_host_soap(usar_test)}/services/wsNotificacion.asmx"
@@ -916,12 +1646,14 @@ def _actualizar_datos_archivo(
             "Content-Type": "text/xml; charset=UTF-8",
             "SOAPAction": SOAP_ACTION_ARCHIVO,
         }
-        print("Llamado a ObtenerArchivoEstadoNotificacion:")
-        print(f"URL: {url}")
-        print(f"Headers: {headers}")
-        print(f"Payload:\n{payload}\n")
+        registro.obtener("soap.xml").info(
+            "Llamado a ObtenerArchivoEstadoNotificacion:\nURL: %s\nHeaders: %s\nPayload:\n%s\n",
+            url,
+            headers,
+            payload,
+        )
 
-    xml_archivo, error_archivo = _invocar_servicio_archivo(
+    datos_archivo, error_archivo = _invocar_servicio_archivo(
         estado_id,
         usar_test,
     )
@@ -929,62 +1661,123 @@ def _actualizar_datos_archivo(
         _log_step(
             "_actualizar_datos_archivo",
             "ADVERTENCIA",
-            f"{envio.codigoseguimientomp}: {error_archivo}",
+            "%s: %s",
+            envio.codigoseguimientomp,
+            error_archivo,
         )
-        return False
-
-    if not xml_archivo:
-        return False
+        return None
 
-    datos_archivo = _extraer_datos_archivo(xml_archivo)
     if not datos_archivo:
-        return False
+        return None
 
-    sentencia_envio = """
-        UPDATE enviocedulanotificacionpolicia
-        SET ecedarchivosegnotid = %s,
-            ecedarchivoseguimientoid = %s,
-            ecedarchivoseguimientonombre = %s,
-            ecedarchivoseguimientodatos = %s
-        WHERE TRIM(codigoseguimientomp) = TRIM(%s)
-    """
+    datos = DatosArchivo(
+        estado_id=int(estado_id),
+        archivo_id=(
+            int(datos_archivo["archivo_id"])
+            if datos_archivo.get("archivo_id")
+            else None
+        ),
+        archivo_nombre=datos_archivo.get("archivo_nombre"),
+        archivo_contenido=datos_archivo.get("archivo_contenido"),
+    )
+    if indice is not None:
+        indice.registrar(envio.codigoseguimientomp, datos)
+    return datos
+
+
+_SENTENCIA_ARCHIVO_ENVIO = """
+    UPDATE enviocedulanotificacionpolicia
+    SET ecedarchivosegnotid = %s,
+        ecedarchivoseguimientoid = %s,
+        ecedarchivoseguimientonombre = %s,
+        ecedarchivoseguimientodigest = %s,
+        ecedarchivoseguimientotamano = %s,
+        ecedarchivoseguimientodatos = NULL
+    WHERE codigoseguimientompnorm = TRIM(%s)
+"""
 
-    sentencia_historial = """
-        UPDATE notpolhistoricomp
-        SET notpolhistoricomparchcont = %s
-        WHERE TRIM(codigoseguimientomp) = TRIM(%s)
-          AND notpolhistoricomparchivoid IS NOT NULL
-          AND notpolhistoricomparchivoid <> 0
-          AND notpolhistoricompfecha = (
-            SELECT MAX(n2.notpolhistoricompfecha)
-            FROM notpolhistoricomp AS n2
-            WHERE TRIM(n2.codigoseguimientomp) = TRIM(%s)
-              AND n2.notpolhistoricomparchivoid IS NOT NULL
-              AND n2.notpolhistoricomparchivoid <> 0
-          )
+_SENTENCIA_ARCHIVO_HISTORIAL = """
+    UPDATE notpolhistoricomp AS n
+    SET notpolhistoricomparchdigest = env.ecedarchivoseguimientodigest,
+        notpolhistoricomparchtamano = env.ecedarchivoseguimientotamano,
+        notpolhistoricomparchcont = NULL
+    FROM enviocedulanotificacionpolicia AS env
+    WHERE env.codigoseguimientompnorm = TRIM(%s)
+      AND n.codigoseguimientompnorm = env.codigoseguimientompnorm
+      AND n.notpolhistoricomparchivoid IS NOT NULL
+      AND n.notpolhistoricomparchivoid <> 0
+      AND n.notpolhistoricompfechats = (
+        SELECT MAX(n2.notpolhistoricompfechats)
+        FROM notpolhistoricomp AS n2
+        WHERE n2.codigoseguimientompnorm = env.codigoseguimientompnorm
+          AND n2.notpolhistoricomparchivoid IS NOT NULL
+          AND n2.notpolhistoricomparchivoid <> 0
+      )
+"""
+
+
+def _referencia_contenido(
+    contenido: Union[ContenidoArchivo, str, None],
+) -> Tuple[Optional[str], Optional[int]]:
+    """Digest y tamaño con que el contenido se identifica en ``archivomp``."""
+
+    if isinstance(contenido, ContenidoArchivo):
+        return contenido.digest, contenido.longitud
+    if not contenido:
+        return None, None
+    return almacen_archivos.calcular_digest_contenido(contenido), len(contenido)
+
+
+def _aplicar_datos_archivo(
+    cursor: psycopg2.extensions.cursor,
+    codigo_seguimiento: str,
+    datos: DatosArchivo,
+) -> None:
+    """Escribe los datos de archivo de un código sin confirmar la transacción.
+
+    El contenido se guarda en ``archivomp`` (solo si el digest es nuevo) y las
+    tablas de notificaciones reciben el digest y el tamaño.
     """
 
-    with conn_pg.cursor() as cursor:
-        cursor.execute(
-            sentencia_envio,
-            (
-                int(estado_id),
-                int(datos_archivo["archivo_id"])
-                if datos_archivo.get("archivo_id")
-                else None,
-                datos_archivo.get("archivo_nombre"),
-                datos_archivo.get("archivo_contenido"),
-                envio.codigoseguimientomp,
-            ),
-        )
-        cursor.execute(
-            sentencia_historial,
-            (
-                datos_archivo.get("archivo_contenido"),
-                envio.codigoseguimientomp,
-                envio.codigoseguimientomp,
-            ),
+    digest, tamano = _referencia_contenido(datos.archivo_contenido)
+    if digest is not None:
+        almacen_archivos.guardar_contenidos(
+            cursor, [(digest, tamano, datos.archivo_contenido)]
         )
+    cursor.execute(
+        _SENTENCIA_ARCHIVO_ENVIO,
+        (
+            datos.estado_id,
+            datos.archivo_id,
+            datos.archivo_nombre,
+            digest,
+            tamano,
+            codigo_seguimiento,
+        ),
+    )
+    cursor.execute(_SENTENCIA_ARCHIVO_HISTORIAL, (codigo_seguimiento,))
+
+
+def _actualizar_datos_archivo(
+    conn_pg: psycopg2.extensions.connection,
+    envio: EnvioNotificacion,
+    xml_respuesta: Union[str, respuesta_estado.RespuestaEstadoNotificacion],
+    usar_test: bool,
+    mostrar_llamado_archivo: bool = False,
+) -> bool:
+    """Actualiza los datos de archivo en enviocedulanotificacionpolicia."""
+
+    datos = _obtener_datos_archivo_envio(
+        envio,
+        xml_respuesta,
+        usar_test,
+        mostrar_llamado_archivo=mostrar_llamado_archivo,
+    )
+    if datos is None:
+        return False
+
+    with conn_pg.cursor() as cursor:
+        _aplicar_datos_archivo(cursor, envio.codigoseguimientomp, datos)
     conn_pg.commit()
     return True
 
@@ -1048,111 +1841,673 @@ def _segundos_retry_after(
     return int(diferencia)
 
 
-def _obtener_xml_actual(
+def _calcular_digest_xml(xml_texto: str) -> str:
+    """Devuelve el SHA-256 hexadecimal del XML tal como se almacena."""
+
+    return hashlib.sha256(xml_texto.encode("utf-8")).hexdigest()
+
+
+def _almacenar_xml(
     conn_panel: psycopg2.extensions.connection,
     envio: EnvioNotificacion,
-) -> Optional[str]:
-    """Recupera el XML almacenado en ``retornomp``."""
-
-    consulta = """
-        SELECT contenido_xml
-        FROM retornomp
-        WHERE pmovimientoid = %s
-          AND pactuacionid = %s
-          AND pdomicilioelectronicopj = %s
+    xml_respuesta: str,
+) -> str:
+    """Inserta o actualiza el XML en ``retornomp`` según corresponda.
+
+    La comparación con el contenido almacenado se resuelve en la base mediante
+    ``contenido_digest``: la fila solo se reescribe cuando el digest cambia, y
+    ``RETURNING`` informa el resultado sin volver a leer el XML anterior.
     """
 
+    xml_nuevo = xml_respuesta.strip()
+
+    sentencia = """
+        INSERT INTO retornomp (
+            pmovimientoid,
+            pactuacionid,
+            pdomicilioelectronicopj,
+            contenido_xml,
+            contenido_digest,
+            procesado,
+            fechaproceso,
+            ultactualizacion
+        )
+        VALUES (%s, %s, %s, %s, %s, FALSE, NULL, NOW())
+        ON CONFLICT (pmovimientoid, pactuacionid, pdomicilioelectronicopj) DO UPDATE
+        SET contenido_xml = EXCLUDED.contenido_xml,
+            contenido_digest = EXCLUDED.contenido_digest,
+            ultactualizacion = NOW(),
+            procesado = FALSE,
+            fechaproceso = NULL
+        WHERE retornomp.contenido_digest IS DISTINCT FROM EXCLUDED.contenido_digest
+        RETURNING (xmax = 0) AS insertado
+    """
     with conn_panel.cursor() as cursor:
         cursor.execute(
-            consulta,
+            sentencia,
             (
                 envio.pmovimientoid,
                 envio.pactuacionid,
                 envio.pdomicilioelectronicopj,
+                xml_nuevo,
+                _calcular_digest_xml(xml_nuevo),
             ),
         )
         fila = cursor.fetchone()
+    conn_panel.commit()
 
-    if not fila:
-        return None
+    if fila is None:
+        return "sin_cambios"
+    return "insert" if fila[0] else "update"
+
+
+_SENTENCIA_RETORNOMP_UPSERT = """
+    INSERT INTO retornomp (
+        pmovimientoid,
+        pactuacionid,
+        pdomicilioelectronicopj,
+        contenido_xml,
+        contenido_digest,
+        procesado,
+        fechaproceso,
+        ultactualizacion
+    )
+    VALUES %s
+    ON CONFLICT (pmovimientoid, pactuacionid, pdomicilioelectronicopj) DO UPDATE
+    SET contenido_xml = EXCLUDED.contenido_xml,
+        contenido_digest = EXCLUDED.contenido_digest,
+        ultactualizacion = NOW(),
+        procesado = FALSE,
+        fechaproceso = NULL
+    WHERE retornomp.contenido_digest IS DISTINCT FROM EXCLUDED.contenido_digest
+    RETURNING pmovimientoid, pactuacionid, pdomicilioelectronicopj, (xmax = 0) AS insertado
+"""
 
-    contenido = fila[0]
-    if contenido is None:
-        return None
-    return str(contenido).strip()
+_SENTENCIA_ARCHIVO_ENVIO_LOTE = """
+    UPDATE enviocedulanotificacionpolicia AS env
+    SET ecedarchivosegnotid = datos.estado_id,
+        ecedarchivoseguimientoid = datos.archivo_id,
+        ecedarchivoseguimientonombre = datos.archivo_nombre,
+        ecedarchivoseguimientodigest = datos.digest,
+        ecedarchivoseguimientotamano = datos.tamano,
+        ecedarchivoseguimientodatos = NULL
+    FROM (VALUES %s) AS datos (codigo, estado_id, archivo_id, archivo_nombre, digest, tamano)
+    WHERE env.codigoseguimientompnorm = datos.codigo
+"""
 
+_SENTENCIA_ARCHIVO_HISTORIAL_LOTE = """
+    UPDATE notpolhistoricomp AS n
+    SET notpolhistoricomparchdigest = env.ecedarchivoseguimientodigest,
+        notpolhistoricomparchtamano = env.ecedarchivoseguimientotamano,
+        notpolhistoricomparchcont = NULL
+    FROM (VALUES %s) AS datos (codigo)
+    JOIN enviocedulanotificacionpolicia AS env
+      ON env.codigoseguimientompnorm = datos.codigo
+    WHERE n.codigoseguimientompnorm = datos.codigo
+      AND n.notpolhistoricomparchivoid IS NOT NULL
+      AND n.notpolhistoricomparchivoid <> 0
+      AND n.notpolhistoricompfechats = (
+        SELECT MAX(n2.notpolhistoricompfechats)
+        FROM notpolhistoricomp AS n2
+        WHERE n2.codigoseguimientompnorm = datos.codigo
+          AND n2.notpolhistoricomparchivoid IS NOT NULL
+          AND n2.notpolhistoricomparchivoid <> 0
+      )
+"""
 
-def _almacenar_xml(
-    conn_panel: psycopg2.extensions.connection,
-    envio: EnvioNotificacion,
-    xml_respuesta: str,
-) -> str:
-    """Inserta o actualiza el XML en ``retornomp`` según corresponda."""
 
-    xml_actual = _obtener_xml_actual(conn_panel, envio)
-    xml_nuevo = xml_respuesta.strip()
+def _clave_retorno(
+    pmovimientoid: object, pactuacionid: object, pdomicilioelectronicopj: object
+) -> Tuple[object, object, str]:
+    """Clave de ``retornomp`` comparable entre valores de Python y de la base."""
+
+    return pmovimientoid, pactuacionid, str(pdomicilioelectronicopj).strip()
+
+
+_SENTENCIA_ULTIMA_EJECUCION_INCOMPLETA = """
+    SELECT ejecucionid, MIN(inicio)
+    FROM public.puntocontrolretorno
+    WHERE particion = %s
+    GROUP BY ejecucionid
+    HAVING NOT bool_and(completada)
+    ORDER BY MAX(actualizado) DESC
+    LIMIT 1
+"""
+
+_SENTENCIA_PUNTO_CONTROL = """
+    INSERT INTO public.puntocontrolretorno (
+        ejecucionid,
+        iteracion,
+        inicio,
+        pmovimientoid,
+        pactuacionid,
+        pdomicilioelectronicopj,
+        procesados,
+        completada,
+        actualizado,
+        particion
+    )
+    VALUES %s
+    ON CONFLICT (ejecucionid, iteracion) DO UPDATE
+    SET pmovimientoid = EXCLUDED.pmovimientoid,
+        pactuacionid = EXCLUDED.pactuacionid,
+        pdomicilioelectronicopj = EXCLUDED.pdomicilioelectronicopj,
+        procesados = EXCLUDED.procesados,
+        completada = EXCLUDED.completada,
+        actualizado = EXCLUDED.actualizado
+"""
+
+
+@dataclass
+class _AvanceIteracion:
+    ultima_clave: Optional[Tuple[object, object, str]] = None
+    procesados: int = 0
+    completada: bool = False
 
-    if xml_actual is None:
-        sentencia = """
-            INSERT INTO retornomp (
-                pmovimientoid,
-                pactuacionid,
-                pdomicilioelectronicopj,
-                contenido_xml,
-                procesado,
-                fechaproceso,
-                ultactualizacion
+
+class _PuntoControl:
+    """Avance de una ejecución de ``procesar_envios`` en ``puntocontrolretorno``.
+
+    Se registra una fila por iteración con la última clave procesada. El
+    avance se guarda cada vez que :class:`_EscrituraDiferida` confirma un
+    lote, de modo que nunca apunta a envíos cuyos datos no se escribieron.
+    Al reanudar se omiten las iteraciones completadas, los envíos anteriores a
+    la última clave y los que ya tienen ``retornomp.ultactualizacion``
+    posterior al inicio de la ejecución interrumpida.
+    """
+
+    def __init__(
+        self,
+        conn_panel: psycopg2.extensions.connection,
+        ejecucion_id: str,
+        inicio: datetime,
+        avances: Dict[str, _AvanceIteracion],
+        consultados: Optional[set] = None,
+        particion: str = "",
+    ) -> None:
+        self._conn_panel = conn_panel
+        self.particion = particion
+        self.ejecucion_id = ejecucion_id
+        self.inicio = inicio
+        self._avances = avances
+        self._consultados = consultados or set()
+        self._modificadas: set[str] = set(avances)
+        self.reanudada = consultados is not None
+        self.envios_omitidos = 0
+
+    @classmethod
+    def iniciar(
+        cls,
+        conn_panel: psycopg2.extensions.connection,
+        iteraciones: Iterable[IteracionConsulta],
+        inicio: datetime,
+        reanudar: bool = False,
+        particion: str = "",
+    ) -> "_PuntoControl":
+        descripciones = [iteracion.descripcion for iteracion in iteraciones]
+        if reanudar:
+            with conn_panel.cursor() as cursor:
+                cursor.execute(_SENTENCIA_ULTIMA_EJECUCION_INCOMPLETA, (particion,))
+                fila = cursor.fetchone()
+                if fila is not None:
+                    ejecucion_id, inicio_anterior = fila
+                    cursor.execute(
+                        """
+                        SELECT iteracion, pmovimientoid, pactuacionid,
+                               pdomicilioelectronicopj, procesados, completada
+                        FROM public.puntocontrolretorno
+                        WHERE ejecucionid = %s
+                        """,
+                        (ejecucion_id,),
+                    )
+                    avances = {
+                        iteracion: _AvanceIteracion(
+                            ultima_clave=(
+                                _clave_retorno(pmov, pact, pdom)
+                                if pmov is not None
+                                else None
+                            ),
+                            procesados=procesados,
+                            completada=completada,
+                        )
+                        for iteracion, pmov, pact, pdom, procesados, completada in cursor.fetchall()
+                    }
+                    cursor.execute(
+                        """
+                        SELECT pmovimientoid, pactuacionid, pdomicilioelectronicopj
+                        FROM retornomp
+                        WHERE ultactualizacion >= %s
+                        """,
+                        (inicio_anterior,),
+                    )
+                    consultados = {_clave_retorno(*clave) for clave in cursor.fetchall()}
+                conn_panel.commit()
+            if fila is not None:
+                punto = cls(
+                    conn_panel,
+                    ejecucion_id,
+                    inicio_anterior,
+                    avances,
+                    consultados,
+                    particion=particion,
+                )
+                for descripcion in descripciones:
+                    if descripcion not in punto._avances:
+                        punto._avances[descripcion] = _AvanceIteracion()
+                        punto._modificadas.add(descripcion)
+                punto.guardar()
+                return punto
+
+        punto = cls(
+            conn_panel,
+            uuid.uuid4().hex,
+            inicio,
+            {descripcion: _AvanceIteracion() for descripcion in descripciones},
+            particion=particion,
+        )
+        punto.guardar()
+        return punto
+
+    def completada(self, iteracion: str) -> bool:
+        avance = self._avances.get(iteracion)
+        return avance is not None and avance.completada
+
+    def filtrar_pendientes(
+        self, iteracion: str, envios: List[EnvioNotificacion]
+    ) -> List[EnvioNotificacion]:
+        """Quita los envíos que la ejecución interrumpida ya había consultado."""
+
+        if not self.reanudada:
+            return envios
+
+        pendientes = envios
+        avance = self._avances.get(iteracion)
+        if avance is not None and avance.ultima_clave is not None:
+            claves = [
+                _clave_retorno(
+                    envio.pmovimientoid, envio.pactuacionid, envio.pdomicilioelectronicopj
+                )
+                for envio in envios
+            ]
+            if avance.ultima_clave in claves:
+                pendientes = envios[claves.index(avance.ultima_clave) + 1:]
+
+        pendientes = [
+            envio
+            for envio in pendientes
+            if _clave_retorno(
+                envio.pmovimientoid, envio.pactuacionid, envio.pdomicilioelectronicopj
             )
-            VALUES (%s, %s, %s, %s, FALSE, NULL, NOW())
-        """
-        with conn_panel.cursor() as cursor:
-            cursor.execute(
-                sentencia,
+            not in self._consultados
+        ]
+        self.envios_omitidos += len(envios) - len(pendientes)
+        return pendientes
+
+    def marcar(self, iteracion: str, envio: EnvioNotificacion) -> None:
+        avance = self._avances.setdefault(iteracion, _AvanceIteracion())
+        avance.ultima_clave = _clave_retorno(
+            envio.pmovimientoid, envio.pactuacionid, envio.pdomicilioelectronicopj
+        )
+        avance.procesados += 1
+        self._modificadas.add(iteracion)
+
+    def completar(self, iteracion: str) -> None:
+        self._avances.setdefault(iteracion, _AvanceIteracion()).completada = True
+        self._modificadas.add(iteracion)
+
+    def guardar(self) -> None:
+        if not self._modificadas:
+            return
+        ahora = datetime.now()
+        filas = []
+        for iteracion in sorted(self._modificadas):
+            avance = self._avances[iteracion]
+            pmov, pact, pdom = avance.ultima_clave or (None, None, None)
+            filas.append(
                 (
-                    envio.pmovimientoid,
-                    envio.pactuacionid,
-                    envio.pdomicilioelectronicopj,
-                    xml_nuevo,
-                ),
+                    self.ejecucion_id,
+                    iteracion,
+                    self.inicio,
+                    pmov,
+                    pact,
+                    pdom,
+                    avance.procesados,
+                    avance.completada,
+                    ahora,
+                    self.particion,
+                )
             )
-        conn_panel.commit()
-        return "insert"
+        try:
+            with self._conn_panel.cursor() as cursor:
+                extras.execute_values(
+                    cursor, _SENTENCIA_PUNTO_CONTROL, filas, page_size=len(filas)
+                )
+            self._conn_panel.commit()
+        except psycopg2.Error as exc:
+            self._conn_panel.rollback()
+            _log_step(
+                "_PuntoControl",
+                "ERROR",
+                "No se pudo guardar el punto de control: %s",
+                exc,
+            )
+            return
+        self._modificadas.clear()
 
-    if xml_actual == xml_nuevo:
-        return "sin_cambios"
+    def finalizar(self) -> None:
+        """Guarda el avance; solo las iteraciones exitosas quedan completadas.
 
-    sentencia = """
-        UPDATE retornomp
-        SET contenido_xml = %s,
-            ultactualizacion = NOW(),
-            procesado = FALSE,
-            fechaproceso = NULL
-        WHERE pmovimientoid = %s
-          AND pactuacionid = %s
-          AND pdomicilioelectronicopj = %s
+        Una iteración que falló sigue incompleta y la ejecución puede
+        retomarse con ``--reanudar``.
+        """
+
+        self.guardar()
+
+
+def _longitud_contenido(datos: DatosArchivo) -> int:
+    contenido = datos.archivo_contenido
+    if isinstance(contenido, ContenidoArchivo):
+        return contenido.longitud
+    return len(contenido or "")
+
+
+def _cerrar_contenido(datos: DatosArchivo) -> None:
+    if isinstance(datos.archivo_contenido, ContenidoArchivo):
+        datos.archivo_contenido.cerrar()
+
+
+class _EscrituraDiferida:
+    """Agrupa las escrituras de ``procesar_envios`` y las confirma por lotes.
+
+    Los XML para ``retornomp`` y los datos de archivo se acumulan en memoria y
+    se escriben con sentencias multi-fila cada ``max_envios`` envíos o cada
+    ``max_segundos`` segundos, con un único ``commit`` por base. Si el lote
+    falla se reintenta fila por fila, cada una dentro de su propio
+    ``SAVEPOINT``, para aislar los registros problemáticos. Los contenidos de
+    archivo pendientes también se vacían al superar ``max_bytes_archivos``
+    caracteres, para acotar el volumen de cada carga a ``archivomp``.
     """
-    with conn_panel.cursor() as cursor:
-        cursor.execute(
-            sentencia,
+
+    def __init__(
+        self,
+        conn_panel: psycopg2.extensions.connection,
+        conn_pg: psycopg2.extensions.connection,
+        max_envios: int = 50,
+        max_segundos: float = 30.0,
+        al_fallar: Optional[Callable[[str, EnvioNotificacion, str], None]] = None,
+        max_bytes_archivos: int = 16 * 1024 * 1024,
+        al_vaciar: Optional[Callable[[], None]] = None,
+    ) -> None:
+        self._conn_panel = conn_panel
+        self._conn_pg = conn_pg
+        self._max_envios = max(1, max_envios)
+        self._max_segundos = max_segundos
+        self._max_bytes_archivos = max_bytes_archivos
+        self._bytes_archivos_pendientes = 0
+        self._al_fallar = al_fallar
+        self._al_vaciar = al_vaciar
+        self._xml_pendientes: Dict[Tuple[int, int, str], Tuple[str, EnvioNotificacion, str]] = {}
+        self._archivos_pendientes: Dict[str, Tuple[str, EnvioNotificacion, DatosArchivo]] = {}
+        self._envios_en_lote = 0
+        self._inicio_lote = time.monotonic()
+        self._retornos_modificados: Dict[
+            Tuple[object, object, str], historialsian.RetornoPendiente
+        ] = {}
+        self.resultados_xml: Counter[str] = Counter()
+        self.codigos_archivo_actualizados: set[str] = set()
+
+    def agregar_xml(
+        self, contexto: str, envio: EnvioNotificacion, xml_respuesta: str
+    ) -> None:
+        clave = (envio.pmovimientoid, envio.pactuacionid, envio.pdomicilioelectronicopj)
+        self._xml_pendientes[clave] = (contexto, envio, xml_respuesta.strip())
+
+    def agregar_archivo(
+        self, contexto: str, envio: EnvioNotificacion, datos: DatosArchivo
+    ) -> None:
+        anterior = self._archivos_pendientes.get(envio.codigoseguimientomp)
+        if anterior is not None:
+            self._bytes_archivos_pendientes -= _longitud_contenido(anterior[2])
+            _cerrar_contenido(anterior[2])
+        self._archivos_pendientes[envio.codigoseguimientomp] = (contexto, envio, datos)
+        self._bytes_archivos_pendientes += _longitud_contenido(datos)
+        if self._bytes_archivos_pendientes >= self._max_bytes_archivos:
+            self.vaciar()
+
+    def tomar_retornos_modificados(self) -> List[historialsian.RetornoPendiente]:
+        """Devuelve y olvida los XML insertados o modificados hasta el momento."""
+
+        self.vaciar()
+        retornos = list(self._retornos_modificados.values())
+        self._retornos_modificados.clear()
+        return retornos
+
+    def envio_completado(self) -> None:
+        """Cuenta un envío procesado y vacía el lote si alcanzó el límite."""
+
+        self._envios_en_lote += 1
+        if (
+            self._envios_en_lote >= self._max_envios
+            or time.monotonic() - self._inicio_lote >= self._max_segundos
+        ):
+            self.vaciar()
+
+    def vaciar(self) -> None:
+        """Escribe y confirma todo lo pendiente."""
+
+        xml_pendientes = list(self._xml_pendientes.values())
+        archivos_pendientes = list(self._archivos_pendientes.values())
+        self._xml_pendientes.clear()
+        self._archivos_pendientes.clear()
+        self._bytes_archivos_pendientes = 0
+        self._envios_en_lote = 0
+        self._inicio_lote = time.monotonic()
+
+        fallos: List[Tuple[str, EnvioNotificacion, str]] = []
+        if xml_pendientes:
+            fallos.extend(self._vaciar_xml(xml_pendientes))
+        if archivos_pendientes:
+            try:
+                fallos.extend(self._vaciar_archivos(archivos_pendientes))
+            finally:
+                for _, _, datos in archivos_pendientes:
+                    _cerrar_contenido(datos)
+
+        if self._al_fallar is not None:
+            for contexto, envio, mensaje in fallos:
+                self._al_fallar(contexto, envio, mensaje)
+        if self._al_vaciar is not None:
+            self._al_vaciar()
+
+    def _vaciar_xml(
+        self, pendientes: List[Tuple[str, EnvioNotificacion, str]]
+    ) -> List[Tuple[str, EnvioNotificacion, str]]:
+        filas = [
             (
-                xml_nuevo,
                 envio.pmovimientoid,
                 envio.pactuacionid,
                 envio.pdomicilioelectronicopj,
-            ),
-        )
-    conn_panel.commit()
-    return "update"
+                xml_nuevo,
+                _calcular_digest_xml(xml_nuevo),
+            )
+            for _, envio, xml_nuevo in pendientes
+        ]
+        plantilla = "(%s, %s, %s, %s, %s, FALSE, NULL, NOW())"
+
+        try:
+            with self._conn_panel.cursor() as cursor:
+                resultado = extras.execute_values(
+                    cursor,
+                    _SENTENCIA_RETORNOMP_UPSERT,
+                    filas,
+                    template=plantilla,
+                    page_size=len(filas),
+                    fetch=True,
+                )
+            self._conn_panel.commit()
+        except psycopg2.Error:
+            self._conn_panel.rollback()
+        else:
+            self._registrar_resultados_xml(resultado, pendientes)
+            return []
+
+        fallos: List[Tuple[str, EnvioNotificacion, str]] = []
+        with self._conn_panel.cursor() as cursor:
+            for (contexto, envio, _), fila in zip(pendientes, filas):
+                cursor.execute("SAVEPOINT retornomp_fila")
+                try:
+                    resultado = extras.execute_values(
+                        cursor,
+                        _SENTENCIA_RETORNOMP_UPSERT,
+                        [fila],
+                        template=plantilla,
+                        fetch=True,
+                    )
+                except psycopg2.Error as exc:
+                    cursor.execute("ROLLBACK TO SAVEPOINT retornomp_fila")
+                    fallos.append((contexto, envio, f"error al almacenar XML: {exc}"))
+                else:
+                    cursor.execute("RELEASE SAVEPOINT retornomp_fila")
+                    self._registrar_resultados_xml(resultado, [(contexto, envio, fila[3])])
+        self._conn_panel.commit()
+        return fallos
+
+    def _registrar_resultados_xml(
+        self,
+        resultado: List[Tuple[int, int, str, bool]],
+        pendientes: List[Tuple[str, EnvioNotificacion, str]],
+    ) -> None:
+        por_clave = {
+            _clave_retorno(
+                envio.pmovimientoid, envio.pactuacionid, envio.pdomicilioelectronicopj
+            ): (envio, xml_nuevo)
+            for _, envio, xml_nuevo in pendientes
+        }
+        insertados = 0
+        for pmovimientoid, pactuacionid, pdomicilioelectronicopj, insertado in resultado:
+            clave = _clave_retorno(pmovimientoid, pactuacionid, pdomicilioelectronicopj)
+            if insertado:
+                insertados += 1
+            if clave not in por_clave:
+                continue
+            envio, xml_nuevo = por_clave[clave]
+            self._retornos_modificados[clave] = historialsian.RetornoPendiente(
+                pmovimientoid=envio.pmovimientoid,
+                pactuacionid=envio.pactuacionid,
+                pdomicilioelectronicopj=envio.pdomicilioelectronicopj,
+                codigo_seguimiento=envio.codigoseguimientomp,
+                xml_contenido=xml_nuevo,
+                contenido_digest=_calcular_digest_xml(xml_nuevo),
+            )
+        self.resultados_xml["insert"] += insertados
+        self.resultados_xml["update"] += len(resultado) - insertados
+        self.resultados_xml["sin_cambios"] += len(pendientes) - len(resultado)
+
+    def _vaciar_archivos(
+        self, pendientes: List[Tuple[str, EnvioNotificacion, DatosArchivo]]
+    ) -> List[Tuple[str, EnvioNotificacion, str]]:
+        referencias = [
+            _referencia_contenido(datos.archivo_contenido) for _, _, datos in pendientes
+        ]
+        try:
+            with self._conn_pg.cursor() as cursor:
+                almacen_archivos.guardar_contenidos(
+                    cursor,
+                    [
+                        (digest, tamano, datos.archivo_contenido)
+                        for (digest, tamano), (_, _, datos) in zip(referencias, pendientes)
+                        if digest is not None
+                    ],
+                )
+                extras.execute_values(
+                    cursor,
+                    _SENTENCIA_ARCHIVO_ENVIO_LOTE,
+                    [
+                        (
+                            envio.codigoseguimientomp,
+                            datos.estado_id,
+                            datos.archivo_id,
+                            datos.archivo_nombre,
+                            digest,
+                            tamano,
+                        )
+                        for (digest, tamano), (_, envio, datos) in zip(
+                            referencias, pendientes
+                        )
+                    ],
+                    template="(%s, %s::bigint, %s::bigint, %s::text, %s::text, %s::integer)",
+                    page_size=len(pendientes),
+                )
+                extras.execute_values(
+                    cursor,
+                    _SENTENCIA_ARCHIVO_HISTORIAL_LOTE,
+                    [(envio.codigoseguimientomp,) for _, envio, _ in pendientes],
+                    template="(%s)",
+                    page_size=len(pendientes),
+                )
+            self._conn_pg.commit()
+        except psycopg2.Error:
+            self._conn_pg.rollback()
+        else:
+            self.codigos_archivo_actualizados.update(
+                envio.codigoseguimientomp for _, envio, _ in pendientes
+            )
+            return []
+
+        fallos: List[Tuple[str, EnvioNotificacion, str]] = []
+        with self._conn_pg.cursor() as cursor:
+            for contexto, envio, datos in pendientes:
+                cursor.execute("SAVEPOINT archivo_fila")
+                try:
+                    _aplicar_datos_archivo(cursor, envio.codigoseguimientomp, datos)
+                except psycopg2.Error as exc:
+                    cursor.execute("ROLLBACK TO SAVEPOINT archivo_fila")
+                    fallos.append(
+                        (contexto, envio, f"error al actualizar archivo: {exc}")
+                    )
+                else:
+                    cursor.execute("RELEASE SAVEPOINT archivo_fila")
+                    self.codigos_archivo_actualizados.add(envio.codigoseguimientomp)
+        self._conn_pg.commit()
+        return fallos
 
 
+@SUMMARY.cronometrar()
 def procesar_envios(
     usar_test: Optional[bool] = None,
     dias: Optional[int] = None,
     codigodeseguimientomp: Optional[str] = None,
+    lote_escritura: int = 50,
+    intervalo_escritura: float = 30.0,
+    historial_en_segundo_plano: bool = False,
+    segun_permanencia: bool = False,
+    reanudar: bool = False,
+    particion: Optional[Particion] = None,
 ) -> None:
-    """Ejecuta el flujo completo para las iteraciones configuradas."""
+    """Ejecuta el flujo completo para las iteraciones configuradas.
+
+    Las escrituras en ``retornomp`` y los datos de archivo se confirman por
+    lotes de ``lote_escritura`` envíos o cada ``intervalo_escritura`` segundos.
+    El historial se concilia en el mismo proceso solo para los XML que
+    cambiaron; con ``historial_en_segundo_plano`` se ejecuta en un hilo que se
+    superpone con la consulta del siguiente grupo. Con ``segun_permanencia``
+    solo se consultan los envíos cuya próxima consulta venció y, al terminar,
+    se actualiza el modelo de permanencia de forma incremental.
+
+    El avance de cada iteración se registra en ``puntocontrolretorno`` junto
+    con cada lote confirmado. Con ``reanudar`` se continúa la última ejecución
+    interrumpida: se omiten las iteraciones terminadas y los envíos ya
+    consultados. No se usan puntos de control al filtrar por código.
+
+    Con ``particion`` solo se consultan los envíos de esa partición y el
+    intervalo mínimo entre llamadas SOAP se coordina con los demás
+    trabajadores mediante ``limitesoapmp``. Un advisory lock impide que una
+    ejecución completa se superponga con otra o con trabajadores
+    particionados.
+    """
 
     bandera_test = default_test_flag if usar_test is None else usar_test
+    log = registro.obtener("procesar_envios")
 
     inicio_proceso = datetime.now()
     momento_referencia = inicio_proceso
@@ -1162,10 +2517,27 @@ def procesar_envios(
 
     codigo_filtrado = (codigodeseguimientomp or "").strip() or None
 
-    with psycopg2.connect(**pgsql_config) as conn_pg, psycopg2.connect(**panel_config) as conn_panel:
+    with historialsian.conectar(pgsql_config) as conn_pg, historialsian.conectar(
+        panel_config
+    ) as conn_panel, _RegistroEventos(
+        lambda: historialsian.conectar(panel_config)
+    ) as eventos, _BloqueoEjecucion(
+        conn_panel, particion, activo=codigo_filtrado is None
+    ) as bloqueo_adquirido, _UsoLimitadorCompartido(
+        bloqueo_adquirido and particion is not None and codigo_filtrado is None
+    ):
         conn_pg.autocommit = False
         conn_panel.autocommit = False
 
+        if not bloqueo_adquirido:
+            mensaje = (
+                "[procesar_envios] Hay otra ejecución en curso que se superpone "
+                + (f"con la partición {particion}" if particion else "con una ejecución completa")
+            )
+            log.warning(mensaje)
+            eventos.registrar(inicio_proceso, 0, mensaje)
+            return
+
         _asegurar_tablas_panel(conn_panel)
         _actualizar_inicio_proceso(conn_panel, inicio_proceso)
 
@@ -1192,6 +2564,8 @@ def procesar_envios(
                     omitir_filtro_estados=True,
                 ),
             )
+        elif segun_permanencia:
+            iteraciones = (ITERACION_PERMANENCIA,)
         else:
             iteraciones = ITERACIONES
 
@@ -1200,36 +2574,86 @@ def procesar_envios(
             Tuple[IteracionConsulta, datetime, List[EnvioNotificacion], str, bool, bool]
         ] = []
         total_envios = 0
-        codigos_actualizados_archivo: set[str] = set()
         envios_procesados = 0
 
-        def _formatear_con_pendientes(mensaje: str) -> str:
-            pendientes = max(total_envios - envios_procesados, 0)
-            return f"{mensaje} | Faltan por procesar: {pendientes}"
+        def _faltan_por_procesar() -> int:
+            return max(total_envios - envios_procesados, 0)
+
+        def _registrar_fallo_escritura(
+            contexto: str, envio: EnvioNotificacion, mensaje: str
+        ) -> None:
+            eventos.registrar(
+                datetime.now(),
+                0,
+                f"{contexto} | {envio.codigoseguimientomp}: {mensaje}",
+            )
+
+        punto_control: Optional[_PuntoControl] = None
+        if codigo_filtrado is None:
+            punto_control = _PuntoControl.iniciar(
+                conn_panel,
+                iteraciones,
+                inicio_proceso,
+                reanudar=reanudar,
+                particion=str(particion) if particion is not None else "",
+            )
+            if punto_control.reanudada:
+                log.info(
+                    "[procesar_envios] Reanudando la ejecución %s iniciada el %s",
+                    punto_control.ejecucion_id,
+                    registro.diferido(punto_control.inicio.strftime, "%Y-%m-%d %H:%M:%S"),
+                )
+
+        escritura = _EscrituraDiferida(
+            conn_panel,
+            conn_pg,
+            max_envios=lote_escritura,
+            max_segundos=intervalo_escritura,
+            al_fallar=_registrar_fallo_escritura,
+            al_vaciar=punto_control.guardar if punto_control is not None else None,
+        )
+        historial = _EjecutorHistorial(
+            conn_pg, conn_panel, en_segundo_plano=historial_en_segundo_plano
+        )
+        indice_archivos = _IndiceArchivosDescargados()
 
         for iteracion in iteraciones:
             inicio_iteracion = datetime.now()
 
+            if punto_control is not None and punto_control.completada(
+                iteracion.descripcion
+            ):
+                log.info(
+                    "[procesar_envios] Iteración: %s | "
+                    "Completada en la ejecución interrumpida, se omite",
+                    iteracion.descripcion,
+                )
+                continue
+
             try:
                 envios = _obtener_envios(
                     conn_pg,
                     iteracion,
                     momento_referencia,
                     codigo_especifico=codigo_filtrado,
+                    particion=particion,
                 )
             except Exception as exc:
                 mensaje_error = (
                     f"[procesar_envios] Iteración: {iteracion.descripcion} | "
                     f"Error al obtener envíos: {exc}"
                 )
-                print(_formatear_con_pendientes(mensaje_error))
+                log.error(
+                    "%s | Faltan por procesar: %s", mensaje_error, _faltan_por_procesar()
+                )
                 conn_pg.rollback()
                 conn_panel.rollback()
-                _registrar_evento_ejecucion(
-                    conn_panel, inicio_iteracion, 0, mensaje_error
-                )
+                eventos.registrar(inicio_iteracion, 0, mensaje_error)
                 continue
 
+            if punto_control is not None:
+                envios = punto_control.filtrar_pendientes(iteracion.descripcion, envios)
+
             cantidad_envios = len(envios)
             total_envios += cantidad_envios
             mensaje_iteracion = (
@@ -1268,7 +2692,10 @@ def procesar_envios(
             )
 
         if not iteraciones_preparadas:
-            print(_formatear_con_pendientes("Total de registros a procesar: 0"))
+            log.info(
+                "Total de registros a procesar: 0 | Faltan por procesar: %s",
+                _faltan_por_procesar(),
+            )
 
         total_impreso = False
 
@@ -1281,10 +2708,10 @@ def procesar_envios(
             es_iteracion_notificaciones_25_45,
         ) in iteraciones_preparadas:
             if not total_impreso:
-                print(
-                    _formatear_con_pendientes(
-                        f"Total de registros a procesar: {total_envios}"
-                    )
+                log.info(
+                    "Total de registros a procesar: %s | Faltan por procesar: %s",
+                    total_envios,
+                    _faltan_por_procesar(),
                 )
                 total_impreso = True
 
@@ -1298,109 +2725,144 @@ def procesar_envios(
             try:
                 if not envios:
                     if ejecutar_historial_general:
-                        _ejecutar_historial_sian()
+                        historial.ejecutar(escritura.tomar_retornos_modificados())
                 else:
                     if codigo_filtrado is not None:
                         se_procesaron_envios_codigo = True
+                    contexto_iteracion = (
+                        f"[procesar_envios] Iteración: {iteracion.descripcion}"
+                    )
+                    indice_archivos.cargar(conn_pg, envios)
                     for envio in envios:
                         resultado, mensaje_error = _invocar_servicio(
                             envio.codigoseguimientomp, bandera_test
                         )
                         if mensaje_error:
                             observacion_error = (
-                                f"[procesar_envios] Iteración: {iteracion.descripcion} | "
-                                f"{mensaje_error}"
+                                f"{contexto_iteracion} | {mensaje_error}"
                             )
-                            _registrar_evento_ejecucion(
-                                conn_panel,
+                            eventos.registrar(
                                 datetime.now(),
                                 0,
                                 observacion_error,
+                                clave=_firma_evento(
+                                    observacion_error.replace(
+                                        envio.codigoseguimientomp, ""
+                                    )
+                                ),
                             )
                         if resultado is None:
                             envios_procesados += 1
+                            if punto_control is not None:
+                                punto_control.marcar(iteracion.descripcion, envio)
+                            escritura.envio_completado()
                             continue
 
+                        escritura.agregar_xml(
+                            contexto_iteracion, envio, resultado.xml_respuesta
+                        )
+                        respuesta = respuesta_estado.parsear_respuesta_estado(
+                            resultado.xml_respuesta
+                        )
                         try:
-                            _almacenar_xml(
-                                conn_panel,
-                                envio,
-                                resultado.xml_respuesta,
-                            )
-                        except Exception as exc:
-                            conn_panel.rollback()
-                            observacion_error = (
-                                f"[procesar_envios] Iteración: {iteracion.descripcion} | "
-                                f"{envio.codigoseguimientomp}: error al almacenar XML: {exc}"
-                            )
-                            _registrar_evento_ejecucion(
-                                conn_panel,
-                                datetime.now(),
-                                0,
-                                observacion_error,
-                            )
-                        try:
-                            actualizado_archivo = _actualizar_datos_archivo(
-                                conn_pg,
+                            datos_archivo = _obtener_datos_archivo_envio(
                                 envio,
-                                resultado.xml_respuesta,
+                                respuesta,
                                 bandera_test,
+                                indice=indice_archivos,
                             )
-                            if actualizado_archivo:
-                                codigos_actualizados_archivo.add(
-                                    envio.codigoseguimientomp
-                                )
                         except Exception as exc:
-                            conn_pg.rollback()
                             observacion_error = (
-                                f"[procesar_envios] Iteración: {iteracion.descripcion} | "
+                                f"{contexto_iteracion} | "
                                 f"{envio.codigoseguimientomp}: error al actualizar archivo: {exc}"
                             )
-                            _registrar_evento_ejecucion(
-                                conn_panel,
+                            eventos.registrar(
                                 datetime.now(),
                                 0,
                                 observacion_error,
                             )
+                        else:
+                            if datos_archivo is not None:
+                                escritura.agregar_archivo(
+                                    contexto_iteracion, envio, datos_archivo
+                                )
 
                         envios_procesados += 1
+                        if punto_control is not None:
+                            punto_control.marcar(iteracion.descripcion, envio)
+                        escritura.envio_completado()
 
                     if ejecutar_historial_general:
-                        _ejecutar_historial_sian()
+                        historial.ejecutar(escritura.tomar_retornos_modificados())
             except Exception as exc:
                 ejecucion_exitosa = False
                 conn_pg.rollback()
                 conn_panel.rollback()
                 observacion_error = f"{mensaje_iteracion} | Error inesperado: {exc}"
-                print(_formatear_con_pendientes(observacion_error))
-                _registrar_evento_ejecucion(
-                    conn_panel,
+                log.error(
+                    "%s | Faltan por procesar: %s",
+                    observacion_error,
+                    _faltan_por_procesar(),
+                )
+                eventos.registrar(
                     inicio_iteracion,
                     0,
                     observacion_error,
                 )
 
             if ejecucion_exitosa:
-                _registrar_evento_ejecucion(
-                    conn_panel,
+                if punto_control is not None:
+                    punto_control.completar(iteracion.descripcion)
+                eventos.registrar(
                     inicio_iteracion,
                     1,
                     mensaje_iteracion,
                 )
 
-        if dias is not None and codigo_filtrado is None:
-            _ejecutar_historial_sian()
+        retornos_pendientes = escritura.tomar_retornos_modificados()
+        if codigo_filtrado is None:
+            if dias is not None or retornos_pendientes:
+                historial.ejecutar(retornos_pendientes)
+        elif se_procesaron_envios_codigo:
+            historial.ejecutar(retornos_pendientes, codigo_filtrado)
+        historial.esperar()
+
+        if punto_control is not None:
+            punto_control.finalizar()
+            if punto_control.envios_omitidos:
+                log.info(
+                    "[procesar_envios] Envíos omitidos por estar consultados en la "
+                    "ejecución interrumpida: %s",
+                    punto_control.envios_omitidos,
+                )
 
-        if codigo_filtrado is not None and se_procesaron_envios_codigo:
-            _ejecutar_historial_sian(codigo_filtrado)
+        if segun_permanencia and codigo_filtrado is None and dias is None:
+            try:
+                permanencia.refrescar(conn_pg)
+            except psycopg2.Error as exc:
+                conn_pg.rollback()
+                eventos.registrar(
+                    datetime.now(),
+                    0,
+                    f"[procesar_envios] No se pudo actualizar el modelo de permanencia: {exc}",
+                )
 
-        ruta_txt = _guardar_codigos_actualizados(codigos_actualizados_archivo)
+        log.info(
+            "[procesar_envios] Llamadas a ObtenerArchivoEstadoNotificacion "
+            "evitadas: %s | Faltan por procesar: %s",
+            indice_archivos.llamadas_evitadas,
+            _faltan_por_procesar(),
+        )
+
+        ruta_txt = _guardar_codigos_actualizados(
+            escritura.codigos_archivo_actualizados
+        )
         if ruta_txt:
-            print(
-                _formatear_con_pendientes(
-                    "[procesar_envios] Archivo de códigos actualizados generado en "
-                    f"{ruta_txt}"
-                )
+            log.info(
+                "[procesar_envios] Archivo de códigos actualizados generado en "
+                "%s | Faltan por procesar: %s",
+                ruta_txt,
+                _faltan_por_procesar(),
             )
 
 
@@ -1437,6 +2899,58 @@ def _parse_args(argv: Optional[Iterable[str]] = None) -> argparse.Namespace:
             "actual menos la cantidad de días indicada"
         ),
     )
+    parser.add_argument(
+        "--lote-escritura",
+        type=int,
+        default=50,
+        help=(
+            "Cantidad de envíos que se acumulan antes de confirmar las "
+            "escrituras en la base de datos"
+        ),
+    )
+    parser.add_argument(
+        "--intervalo-escritura",
+        type=float,
+        default=30.0,
+        help="Segundos máximos entre confirmaciones de escrituras acumuladas",
+    )
+    parser.add_argument(
+        "--historial-en-segundo-plano",
+        action="store_true",
+        help=(
+            "Concilia el historial en un hilo aparte mientras se consulta el "
+            "siguiente grupo de envíos"
+        ),
+    )
+    parser.add_argument(
+        "--segun-permanencia",
+        action="store_true",
+        help=(
+            "Consulta solo los envíos cuya próxima consulta (modelo de "
+            "permanencia por estado) ya venció, en lugar de las ventanas fijas"
+        ),
+    )
+    parser.add_argument(
+        "--shard",
+        "--particion",
+        dest="particion",
+        type=Particion.desde_texto,
+        help=(
+            "Procesa solo la partición i de N (por ejemplo 2/4) según un hash "
+            "del código de seguimiento; los trabajadores comparten el límite "
+            "de llamadas al servicio SOAP"
+        ),
+    )
+    parser.add_argument(
+        "--resume",
+        "--reanudar",
+        dest="reanudar",
+        action="store_true",
+        help=(
+            "Continúa la última ejecución interrumpida, omitiendo las "
+            "iteraciones terminadas y los envíos ya consultados"
+        ),
+    )
     parser.add_argument(
         "--codigodeseguimientomp",
         "--codigoseguimientomp",
@@ -1447,6 +2961,23 @@ def _parse_args(argv: Optional[Iterable[str]] = None) -> argparse.Namespace:
             "Solo se consulta ese registro y se sincroniza su historial."
         ),
     )
+    parser.add_argument(
+        "--depurar-xml",
+        dest="depurar_xml",
+        action="store_true",
+        help="Vuelca al log el XML de cada respuesta SOAP (equivale a SIAN_LOG_XML=1)",
+    )
+    parser.add_argument(
+        "--log-formato",
+        dest="log_formato",
+        choices=("texto", "json"),
+        help="Formato del log (por defecto SIAN_LOG_FORMATO o texto)",
+    )
+    parser.add_argument(
+        "--reporte-json",
+        dest="reporte_json",
+        help="Guarda el resumen (conteos, tiempos por paso e idas a la base) en este archivo JSON.",
+    )
     return parser.parse_args(argv)
 
 
@@ -1454,11 +2985,21 @@ def main(argv: Optional[Iterable[str]] = None) -> None:
     """Punto de entrada para ejecución por consola."""
 
     args = _parse_args(argv)
+    registro.configurar(
+        formato=args.log_formato, xml=True if args.depurar_xml else None
+    )
     procesar_envios(
         usar_test=args.test,
         dias=args.dias,
         codigodeseguimientomp=args.codigodeseguimientomp,
+        lote_escritura=args.lote_escritura,
+        intervalo_escritura=args.intervalo_escritura,
+        historial_en_segundo_plano=args.historial_en_segundo_plano,
+        segun_permanencia=args.segun_permanencia,
+        reanudar=args.reanudar,
+        particion=args.particion,
     )
+    SUMMARY.imprimir(args.reporte_json)
 
 
 if __name__ == "__main__":
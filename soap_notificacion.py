@@ -3,12 +3,16 @@
 Uso:
     python soap_notificacion.py --entorno DESA --data '{"UsuarioClave":"...","UsuarioNombre":"...","codigoSeguimiento":"..."}'
     python soap_notificacion.py --entorno PROD --data-file payload.json
+
+Con ``MP_SOAP_HOST`` (por ejemplo ``http://127.0.0.1:8089``) la solicitud se
+envía a esa URL base en lugar del entorno indicado.
 """
 
 from __future__ import annotations
 
 import argparse
 import json
+import os
 import sys
 from typing import Any, Dict
 
@@ -77,8 +81,11 @@ def consultar_estado_notificacion(
     timeout: float = 30.0,
 ) -> requests.Response:
     xml_body = _construir_xml(payload)
-    host = _normalizar_entorno(entorno)
-    url = f"https://{host}{BASE_PATH}"
+    host_alternativo = os.environ.get("MP_SOAP_HOST", "").strip().rstrip("/")
+    if host_alternativo:
+        url = f"{host_alternativo}{BASE_PATH}"
+    else:
+        url = f"https://{_normalizar_entorno(entorno)}{BASE_PATH}"
 
     headers = {
         "Content-Type": "text/xml;charset=UTF-8",
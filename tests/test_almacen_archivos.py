@@ -0,0 +1,52 @@
+import unittest
+from unittest import mock
+
+import almacen_archivos
+
+
+class AlmacenArchivosTests(unittest.TestCase):
+    def test_guardar_contenidos_omite_digests_existentes(self):
+        cursor = mock.MagicMock()
+        cursor.fetchall.return_value = [("a" * 64,)]
+
+        with mock.patch.object(almacen_archivos.extras, "execute_values") as execute_values:
+            insertados = almacen_archivos.guardar_contenidos(
+                cursor,
+                [
+                    ("a" * 64, 4, "QUJD"),
+                    ("b" * 64, 4, "REVG"),
+                    ("b" * 64, 4, "REVG"),
+                ],
+            )
+
+        self.assertEqual(insertados, 1)
+        self.assertEqual(cursor.execute.call_args.args[1], (["a" * 64, "b" * 64],))
+        self.assertEqual(execute_values.call_args.args[2], [("b" * 64, 4, "REVG")])
+
+    def test_guardar_contenidos_por_fragmentos_usa_copy_escapado(self):
+        cursor = mock.MagicMock()
+        cursor.fetchall.return_value = []
+        contenido = mock.Mock()
+        contenido.fragmentos.return_value = iter([b"QUJD\r\n", b"RE\\VG"])
+        copiado = []
+        cursor.copy_expert.side_effect = lambda sentencia, archivo, size: copiado.append(
+            b"".join(iter(lambda: archivo.read(3), b""))
+        )
+
+        with mock.patch.object(almacen_archivos.extras, "execute_values") as execute_values:
+            insertados = almacen_archivos.guardar_contenidos(
+                cursor, [("c" * 64, 12, contenido), ("d" * 64, 4, "REVG")]
+            )
+
+        self.assertEqual(insertados, 2)
+        self.assertEqual(
+            copiado, [b"c" * 64 + b"\t12\tQUJD\\r\\nRE\\\\VG\n"]
+        )
+        sentencias = [llamada.args[0] for llamada in cursor.execute.call_args_list]
+        self.assertIn("CREATE TEMP TABLE IF NOT EXISTS archivomp_carga", sentencias[1])
+        self.assertIn("ON CONFLICT (digest) DO NOTHING", sentencias[2])
+        self.assertEqual(execute_values.call_args.args[2], [("d" * 64, 4, "REVG")])
+
+
+if __name__ == "__main__":
+    unittest.main()
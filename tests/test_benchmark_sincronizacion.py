@@ -0,0 +1,42 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+import benchmark_sincronizacion as benchmark
+
+
+class BenchmarkSincronizacionTests(unittest.TestCase):
+    def test_resume_etapa_y_compara_con_la_corrida_anterior(self):
+        medicion = benchmark.MedicionEtapa(
+            "procesar_envios",
+            latencias=[0.01 * numero for numero in range(1, 101)],
+            idas_bd=250,
+            segundos=2.0,
+        )
+        resumen = benchmark.resumir_etapa(medicion)
+        self.assertEqual(resumen["codigos"], 100)
+        self.assertEqual(resumen["codigos_por_segundo"], 50.0)
+        self.assertEqual(resumen["latencia_p50_ms"], 505.0)
+        self.assertEqual(resumen["latencia_p95_ms"], 950.5)
+        self.assertEqual(resumen["idas_bd_por_codigo"], 2.5)
+
+        with tempfile.TemporaryDirectory() as directorio:
+            ruta = Path(directorio) / "historial.jsonl"
+            parametros = {"envios": 100}
+            self.assertIsNone(
+                benchmark.registrar_corrida(ruta, parametros, {"procesar_envios": resumen})
+            )
+            benchmark.registrar_corrida(ruta, {"envios": 5}, {})
+            mas_lento = dict(resumen, codigos_por_segundo=40.0)
+            anterior = benchmark.registrar_corrida(
+                ruta, parametros, {"procesar_envios": mas_lento}
+            )
+
+        lineas = benchmark.comparar_corridas(
+            {"procesar_envios": mas_lento}, anterior["etapas"]
+        )
+        self.assertIn("procesar_envios.codigos_por_segundo: 50.0 -> 40.0 (-20.0%)", lineas)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+import unittest
+from datetime import datetime
+
+import conciliacion_historial as conciliacion
+import historialsian
+
+
+def _estado(estado_id, fecha, texto):
+    return (estado_id, fecha, fecha.isoformat(), texto, None, None, None, None, None, None)
+
+
+class ConciliacionHistorialTests(unittest.TestCase):
+    def test_planifica_inserciones_estados_y_marcas_del_lote(self):
+        retornos = [
+            conciliacion.RetornoLeido(1, 2, "dom", "<xml/>", "d1"),
+            conciliacion.RetornoLeido(3, 4, "dom", "<roto", "d2"),
+            conciliacion.RetornoLeido(5, 6, "dom", "<xml/>", "d3"),
+        ]
+        codigos = {
+            (1, 2, "dom"): ((1, 2, "dom"), "COD1"),
+            (3, 4, "dom"): ((3, 4, "dom"), "COD2"),
+        }
+        ingresada = _estado(1, datetime(2024, 1, 1, 10), "Ingresada")
+        entregada = _estado(3, datetime(2024, 1, 3, 10), "Entregada")
+        parseados = [
+            conciliacion.EstadosParseados(
+                True,
+                (_estado(0, datetime(2023, 12, 1), "Anterior"), ingresada, entregada, entregada),
+                entregada,
+            ),
+            conciliacion.EstadosParseados(False, (), None),
+            conciliacion.EstadosParseados(True, (ingresada,), ingresada),
+        ]
+        existentes = {
+            (1, 2, "dom", "COD1"): {
+                historialsian._construir_clave_estado(
+                    1, "2024-01-01 10:00:00", "INGRESADA"
+                )
+            }
+        }
+
+        plan = conciliacion._planificar_lote(retornos, codigos, parseados, existentes)
+
+        self.assertEqual([fila[2] for fila in plan.filas_notpol], [3])
+        self.assertEqual(plan.filas_notpol[0][13], "COD1")
+        self.assertEqual(plan.filas_notpol[0][14], datetime(2024, 1, 3, 10))
+        self.assertEqual(
+            plan.estados_xml,
+            [
+                ("COD1", "Entregada", datetime(2024, 1, 3, 10), True),
+                ("COD2", "Sin info", None, False),
+            ],
+        )
+        self.assertEqual(
+            plan.claves_historial, [(1, 2, "dom", "COD1"), (3, 4, "dom", "COD2")]
+        )
+        self.assertEqual(plan.procesados, [(1, 2, "dom", "d1"), (3, 4, "dom", "d2")])
+        self.assertEqual(plan.sin_envio, 1)
+
+    def test_extraer_estados_de_xml_invalido(self):
+        parseado = conciliacion._extraer_estados("<sin cerrar")
+        self.assertFalse(parseado.xml_valido)
+        self.assertIsNone(parseado.ultimo)
+
+    def test_pool_parsea_por_adelantado_y_conserva_el_orden(self):
+        xml = (
+            '<soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/"'
+            ' xmlns:tem="http://tempuri.org/"><soapenv:Body>'
+            "<tem:ObtenerEstadoNotificacionResponse><tem:ObtenerEstadoNotificacionResult>"
+            "<tem:HistorialEstados><tem:EstadoNotificacion>"
+            "<tem:EstadoNotificacionId>{id}</tem:EstadoNotificacionId>"
+            "<tem:Fecha>2024-01-0{id}T10:00:00</tem:Fecha><tem:Estado>E{id}</tem:Estado>"
+            "</tem:EstadoNotificacion></tem:HistorialEstados>"
+            "</tem:ObtenerEstadoNotificacionResult></tem:ObtenerEstadoNotificacionResponse>"
+            "</soapenv:Body></soapenv:Envelope>"
+        )
+        lotes = [
+            [conciliacion.RetornoLeido(n, n, "dom", xml.format(id=n), None) for n in ids]
+            for ids in ((1, 2, 3), (4, 5))
+        ]
+        leidos = []
+
+        def leer():
+            for lote in lotes:
+                leidos.append(lote)
+                yield lote
+
+        with conciliacion.ProcessPoolExecutor(max_workers=2) as pool:
+            adelantados = conciliacion._parsear_por_adelantado(pool, leer())
+            primero, parseados = next(adelantados)
+            # El segundo lote ya se leyó y se encargó antes de entregar el primero.
+            self.assertEqual(len(leidos), 2)
+            self.assertIs(primero, lotes[0])
+            self.assertEqual(
+                [p.ultimo[3] for p in parseados], ["E1", "E2", "E3"]
+            )
+            segundo, parseados = next(adelantados)
+            self.assertEqual([p.estados[0][0] for p in parseados], [4, 5])
+            self.assertEqual(list(adelantados), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
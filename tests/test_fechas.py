@@ -0,0 +1,38 @@
+import unittest
+from datetime import date, datetime, timedelta, timezone
+
+import fechas
+
+
+class FechasTests(unittest.TestCase):
+    def test_parsea_iso_y_alternativos_sin_zona(self):
+        casos = {
+            "2024-01-31T10:15:00": datetime(2024, 1, 31, 10, 15),
+            " 2024-01-31 10:15:00 ": datetime(2024, 1, 31, 10, 15),
+            "2024-01-31T10:15:00.5": datetime(2024, 1, 31, 10, 15, 0, 500000),
+            "2024-01-31T10:15:00-03:00": datetime(2024, 1, 31, 10, 15),
+            "2024-01-31T10:15:00Z": datetime(2024, 1, 31, 10, 15),
+            "2024-01-31": datetime(2024, 1, 31),
+        }
+        for texto, esperado in casos.items():
+            with self.subTest(texto=texto):
+                resultado = fechas.parsear(texto)
+                self.assertEqual(resultado, esperado)
+                self.assertIsNone(resultado.tzinfo)
+
+        self.assertIsNone(fechas.parsear("31/01/2024"))
+        self.assertIsNone(fechas.parsear("2024-02-30T10:00:00"))
+        self.assertIsNone(fechas.parsear("  "))
+
+    def test_normaliza_y_formatea(self):
+        con_zona = datetime(2024, 1, 31, 10, 15, tzinfo=timezone(timedelta(hours=-3)))
+        self.assertEqual(fechas.normalizar(con_zona), datetime(2024, 1, 31, 10, 15))
+        self.assertEqual(fechas.normalizar(date(2024, 1, 31)), datetime(2024, 1, 31))
+        self.assertEqual(fechas.formatear("2024-01-31T10:15:00"), "31/01/2024 10:15:00")
+        self.assertEqual(fechas.formatear("31/01/2024"), "31/01/2024 00:00:00")
+        self.assertEqual(fechas.formatear("pendiente"), "pendiente")
+        self.assertEqual(fechas.formatear(None), "Sin fecha")
+
+
+if __name__ == "__main__":
+    unittest.main()
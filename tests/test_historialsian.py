@@ -0,0 +1,288 @@
+import unittest
+from datetime import datetime
+from unittest import mock
+
+import historialsian
+
+
+class HistorialSianTests(unittest.TestCase):
+    def test_procesar_historial_concilia_solo_retornos_indicados(self):
+        conexion_pg = mock.MagicMock()
+        conexion_panel = mock.MagicMock()
+        retornos = [
+            historialsian.RetornoPendiente(1, 2, "dom", "COD1", "<xml/>", "d1"),
+            historialsian.RetornoPendiente(3, 4, "dom", "COD2", "<xml/>", "d2"),
+        ]
+
+        with mock.patch.object(historialsian, "pre_historial") as pre_historial, \
+            mock.patch.object(historialsian, "_obtener_fecha_historial", return_value=None), \
+            mock.patch.object(
+                historialsian, "llamar_his_mp", side_effect=[True, False]
+            ) as llamar_his_mp, \
+            mock.patch.object(historialsian, "_marcar_retornomp_procesados") as marcar:
+            conciliados = historialsian.procesar_historial(
+                conexion_pg, conexion_panel, retornos
+            )
+
+        self.assertEqual(conciliados, 1)
+        pre_historial.assert_called_once_with(None, conexion_pg=conexion_pg)
+        self.assertEqual(llamar_his_mp.call_count, 2)
+        marcar.assert_called_once_with(conexion_panel, [(1, 2, "dom", "d1")])
+
+    def test_marca_retornos_procesados_por_lote_con_digest(self):
+        conexion_panel = mock.MagicMock()
+        cursor = conexion_panel.cursor.return_value.__enter__.return_value
+        cursor.rowcount = 2
+        procesados = [(1, 2, "dom", "d1"), (3, 4, "dom", "d2")]
+
+        with mock.patch.object(historialsian.extras, "execute_values") as execute_values:
+            historialsian._marcar_retornomp_procesados(conexion_panel, procesados)
+            historialsian._marcar_retornomp_procesados(conexion_panel, [])
+
+        execute_values.assert_called_once()
+        sentencia, filas = execute_values.call_args.args[1:3]
+        self.assertIn("contenido_digest IS NOT DISTINCT FROM d.digest", sentencia)
+        self.assertEqual(filas, procesados)
+        conexion_panel.commit.assert_called_once()
+
+    def test_guardar_historial_inserta_estados_nuevos_en_una_sentencia(self):
+        conexion = mock.MagicMock()
+        cursor = conexion.cursor.return_value.__enter__.return_value
+        cursor.fetchall.return_value = [(1, "2024-01-01 10:00:00", "Ingresada")]
+        estados = [
+            {"estado_id": 1, "fecha": "2024-01-01T10:00:00", "estado": "Ingresada"},
+            {"estado_id": 2, "fecha": "2024-01-02T10:00:00", "estado": "Enviada"},
+            {"estado_id": 2, "fecha": "2024-01-02T10:00:00", "estado": "ENVIADA"},
+            {"estado_id": 3, "fecha": "2024-01-03T10:00:00", "estado": "Entregada"},
+        ]
+
+        with mock.patch.object(
+            historialsian.extras, "execute_values", return_value=[(1,), (1,)]
+        ) as execute_values, mock.patch.object(
+            historialsian.psycopg2, "connect"
+        ) as connect:
+            insertados = historialsian._guardar_historial_notpol(
+                estados,
+                1,
+                2,
+                "dom",
+                "COD1",
+                sesion=historialsian.SesionHistorial(conexion),
+            )
+
+        self.assertEqual(insertados, 2)
+        connect.assert_not_called()
+        conexion.commit.assert_not_called()
+        execute_values.assert_called_once()
+        filas = execute_values.call_args.args[2]
+        self.assertEqual([fila[2] for fila in filas], [2, 3])
+        self.assertEqual(cursor.execute.call_count, 2)
+        consulta, parametros = cursor.execute.call_args.args
+        self.assertIn("INSERT INTO notpol_ultimo_estado", consulta)
+        self.assertEqual(parametros, (["COD1"],))
+
+    def test_sesion_confirma_por_lote_y_revierte_solo_el_codigo_fallido(self):
+        conexion = mock.MagicMock()
+        cursor = conexion.cursor.return_value.__enter__.return_value
+        confirmaciones = []
+
+        with mock.patch.object(historialsian.psycopg2, "connect") as connect:
+            with historialsian.SesionHistorial(
+                conexion, lote=2, al_confirmar=lambda: confirmaciones.append(1)
+            ) as sesion:
+                with sesion.codigo():
+                    pass
+                self.assertEqual(conexion.commit.call_count, 0)
+                with sesion.codigo():
+                    sesion.revertir_codigo()
+                self.assertEqual(conexion.commit.call_count, 1)
+                with sesion.codigo():
+                    pass
+
+        connect.assert_not_called()
+        conexion.rollback.assert_not_called()
+        conexion.close.assert_not_called()
+        self.assertEqual(conexion.commit.call_count, 2)
+        self.assertEqual(len(confirmaciones), 2)
+        self.assertEqual(
+            [llamada.args[0] for llamada in cursor.execute.call_args_list],
+            [
+                "SAVEPOINT historial_codigo",
+                "RELEASE SAVEPOINT historial_codigo",
+                "SAVEPOINT historial_codigo",
+                "ROLLBACK TO SAVEPOINT historial_codigo",
+                "RELEASE SAVEPOINT historial_codigo",
+                "SAVEPOINT historial_codigo",
+                "RELEASE SAVEPOINT historial_codigo",
+            ],
+        )
+
+    def test_sesion_libera_savepoint_al_fallar_el_codigo(self):
+        conexion = mock.MagicMock()
+        cursor = conexion.cursor.return_value.__enter__.return_value
+        sesion = historialsian.SesionHistorial(conexion, lote=2)
+
+        with self.assertRaises(ValueError):
+            with sesion.codigo():
+                raise ValueError("xml")
+
+        self.assertEqual(
+            [llamada.args[0] for llamada in cursor.execute.call_args_list],
+            [
+                "SAVEPOINT historial_codigo",
+                "ROLLBACK TO SAVEPOINT historial_codigo",
+                "RELEASE SAVEPOINT historial_codigo",
+            ],
+        )
+        conexion.commit.assert_not_called()
+
+    def test_precarga_claves_del_lote_en_una_consulta(self):
+        conexion = mock.MagicMock()
+        cursor = conexion.cursor.return_value.__enter__.return_value
+        cursor.fetchall.return_value = [
+            (1, 2, "dom", "COD1", 1, "2024-01-01T10:00:00", "Ingresada"),
+            (9, 9, "otro", "COD1", 1, "2024-01-01T10:00:00", "Ingresada"),
+        ]
+        sesion = historialsian.SesionHistorial(conexion)
+
+        sesion.precargar_claves([(1, 2, "dom", " COD1 "), (3, 4, "dom", "COD2")])
+
+        self.assertEqual(cursor.execute.call_count, 1)
+        self.assertEqual(cursor.execute.call_args.args[1], (["COD1", "COD2"],))
+        self.assertEqual(
+            sesion.claves_precargadas(1, 2, "dom", "COD1"),
+            {(1, datetime(2024, 1, 1, 10), "INGRESADA")},
+        )
+        self.assertEqual(sesion.claves_precargadas(3, 4, "dom", "COD2"), set())
+        self.assertIsNone(sesion.claves_precargadas(9, 9, "otro", "COD1"))
+
+        estados = [
+            {"estado_id": 1, "fecha": "2024-01-01T10:00:00", "estado": "Ingresada"},
+            {"estado_id": 2, "fecha": "2024-01-02T10:00:00", "estado": "Enviada"},
+        ]
+        with mock.patch.object(
+            historialsian.extras, "execute_values", return_value=[(1,)]
+        ) as execute_values:
+            insertados = historialsian._guardar_historial_notpol(
+                estados, 1, 2, "dom", "COD1", sesion=sesion
+            )
+
+        self.assertEqual(insertados, 1)
+        # Solo se agrega la actualización de notpol_ultimo_estado.
+        self.assertEqual(cursor.execute.call_count, 2)
+        self.assertEqual([fila[2] for fila in execute_values.call_args.args[2]], [2])
+
+        sesion.revertir_codigo()
+        self.assertIsNone(sesion.claves_precargadas(1, 2, "dom", "COD1"))
+
+        # Tras revertir, la consulta por código también usa el código normalizado.
+        cursor.fetchall.return_value = []
+        with mock.patch.object(historialsian.extras, "execute_values", return_value=[]):
+            historialsian._guardar_historial_notpol(
+                estados, 1, 2, "dom", " COD1 ", sesion=sesion
+            )
+        consulta, parametros = cursor.execute.call_args_list[2].args
+        self.assertIn("codigoseguimientompnorm = TRIM(%s)", consulta)
+        self.assertEqual(parametros, (1, 2, "dom", " COD1 "))
+
+    def test_resumen_mide_tiempos_e_idas_por_paso(self):
+        resumen = historialsian.SummaryCollector()
+        with mock.patch.object(
+            historialsian.time, "perf_counter", side_effect=[0.0, 1.0, 1.5, 2.0, 4.0, 5.0]
+        ):
+            with resumen.medir("lasstage"):
+                resumen.add_ida()
+                with resumen.medir("grabar_historico", items=4):
+                    resumen.add_ida(2)
+            with resumen.medir("lasstage"):
+                pass
+        resumen._inicio = 0.0
+
+        with mock.patch.object(historialsian.time, "perf_counter", return_value=10.0):
+            reporte = resumen.reporte()
+
+        self.assertEqual(reporte["idas_bd"], 3)
+        self.assertEqual(list(reporte["pasos"]), ["lasstage", "grabar_historico"])
+        self.assertEqual(
+            reporte["pasos"]["lasstage"],
+            {
+                "llamadas": 2,
+                "total_s": 3.0,
+                "max_ms": 2000.0,
+                "p95_ms": 1950.0,
+                "items": 2,
+                "items_por_s": 0.7,
+                "idas_bd": 1,
+            },
+        )
+        self.assertEqual(reporte["pasos"]["grabar_historico"]["items_por_s"], 8.0)
+        self.assertEqual(reporte["pasos"]["grabar_historico"]["idas_bd"], 2)
+
+    def test_grabar_historico_diferido_actualiza_envios_al_confirmar(self):
+        conexion = mock.MagicMock()
+        cursor = conexion.cursor.return_value.__enter__.return_value
+        cursor.rowcount = 1
+        sesion = historialsian.SesionHistorial(conexion, lote=3, diferir_ultimo_estado=True)
+
+        with mock.patch.object(historialsian.extras, "execute_values") as execute_values:
+            with sesion.codigo():
+                historialsian.grabar_historico(
+                    "Ingresada", "2024-01-01T10:00:00", 1, 2, "dom", " COD1 ", sesion=sesion
+                )
+            with sesion.codigo():
+                historialsian.grabar_historico(
+                    "Pendiente", None, 3, 4, "dom", "COD2", sesion=sesion
+                )
+                sesion.revertir_codigo()
+            execute_values.assert_not_called()
+            with sesion.codigo():
+                historialsian.grabar_historico(
+                    "Entregada", "2024-01-02T10:00:00", 1, 2, "dom", "COD1", sesion=sesion
+                )
+            self.assertEqual(conexion.commit.call_count, 1)
+
+        self.assertEqual(execute_values.call_count, 2)
+        por_codigo, ultimo_estado = execute_values.call_args_list
+        self.assertEqual(
+            por_codigo.args[2], [("COD1", "Entregada", datetime(2024, 1, 2, 10), True)]
+        )
+        self.assertIn("DISTINCT ON", ultimo_estado.args[1])
+        self.assertEqual(ultimo_estado.args[2], [(1, 2, "dom", "COD1")])
+        self.assertNotIn(
+            "UPDATE enviocedulanotificacionpolicia",
+            " ".join(str(llamada) for llamada in cursor.execute.call_args_list),
+        )
+
+    def test_error_al_guardar_historial_deja_el_retorno_pendiente(self):
+        conexion = mock.MagicMock()
+        cursor = conexion.cursor.return_value.__enter__.return_value
+        sesion = historialsian.SesionHistorial(conexion, lote=2, diferir_ultimo_estado=True)
+        estado = {"estado_id": 1, "fecha": "2024-01-01T10:00:00", "estado": "Ingresada"}
+
+        def lasstage(*args, sesion):
+            insertados = historialsian._guardar_historial_notpol(
+                [estado], *args[:4], sesion=sesion
+            )
+            return {"estado": "Ingresada", "fecha_raw": estado["fecha"]}, 1, insertados
+
+        with mock.patch.object(historialsian, "lasstage", side_effect=lasstage), \
+            mock.patch.object(
+                historialsian,
+                "_insertar_estados_notpol",
+                side_effect=historialsian.psycopg2.Error("duplicada"),
+            ):
+            with sesion.codigo():
+                conciliado = historialsian.llamar_his_mp(
+                    1, 2, "dom", "COD1", None, "<xml/>", sesion=sesion
+                )
+
+        self.assertFalse(conciliado)
+        self.assertEqual(sesion._envios_codigo + sesion._envios_lote, [])
+        self.assertIn(
+            mock.call("ROLLBACK TO SAVEPOINT historial_codigo"),
+            cursor.execute.call_args_list,
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+import unittest
+from unittest import mock
+
+import migraciones
+
+
+class MigracionesTests(unittest.TestCase):
+    def test_aplicar_migracion_formatea_esquema_y_confirma(self):
+        conexion = mock.MagicMock()
+        cursor = conexion.cursor.return_value.__enter__.return_value
+        migracion = migraciones.MIGRACIONES[0]
+
+        migraciones.aplicar_migracion(conexion, migracion, esquema="pg_temp")
+
+        self.assertEqual(cursor.execute.call_count, len(migracion.sentencias))
+        for llamada in cursor.execute.call_args_list:
+            self.assertIn("pg_temp.", llamada.args[0])
+            self.assertNotIn("{esquema}", llamada.args[0])
+        conexion.commit.assert_called_once()
+
+    def test_fecha_historial_tipada_completa_por_lotes(self):
+        conexion = mock.MagicMock()
+        cursor = conexion.cursor.return_value.__enter__.return_value
+        filas_por_lote = iter([3, 3, 1])
+        cursor.execute.side_effect = lambda *_: setattr(
+            cursor, "rowcount", next(filas_por_lote)
+        )
+
+        total = migraciones.completar_fecha_historial(conexion, lote=3)
+
+        self.assertEqual(total, 7)
+        self.assertEqual(cursor.execute.call_count, 3)
+        self.assertEqual(conexion.commit.call_count, 3)
+        sentencia, parametros = cursor.execute.call_args.args
+        self.assertIn("public.notpolhistoricomp", sentencia)
+        self.assertIn("notpolhistoricompfechats IS NULL", sentencia)
+        self.assertEqual(parametros, (3,))
+        migracion = next(
+            m for m in migraciones.MIGRACIONES if m.nombre == "fecha_historial_tipada"
+        )
+        self.assertIs(migracion.completar, migraciones.completar_fecha_historial)
+
+    def test_ultimo_estado_por_codigo_se_reconstruye_al_aplicar(self):
+        conexion = mock.MagicMock()
+        cursor = conexion.cursor.return_value.__enter__.return_value
+        cursor.rowcount = 5
+        migracion = next(
+            m for m in migraciones.MIGRACIONES if m.nombre == "ultimo_estado_por_codigo"
+        )
+
+        migraciones.aplicar_migracion(conexion, migracion, esquema="pg_temp")
+
+        sentencias = [llamada.args[0] for llamada in cursor.execute.call_args_list]
+        self.assertEqual(len(sentencias), len(migracion.sentencias) + 2)
+        self.assertIn("DELETE FROM pg_temp.notpol_ultimo_estado", sentencias[-2])
+        self.assertIn("DISTINCT ON (codigoseguimientompnorm)", sentencias[-1])
+        self.assertIn("FROM pg_temp.notpolhistoricomp", sentencias[-1])
+        self.assertEqual(conexion.commit.call_count, 2)
+
+    def test_retornomp_digest_depura_duplicados_antes_del_indice_unico(self):
+        conexion = mock.MagicMock()
+        cursor = conexion.cursor.return_value.__enter__.return_value
+        migracion = next(
+            m for m in migraciones.MIGRACIONES if m.nombre == "retornomp_digest"
+        )
+
+        migraciones.aplicar_migracion(conexion, migracion, esquema="pg_temp")
+
+        sentencias = [llamada.args[0] for llamada in cursor.execute.call_args_list]
+        depuracion = next(
+            i for i, s in enumerate(sentencias) if "DELETE FROM pg_temp.retornomp" in s
+        )
+        indice = next(
+            i for i, s in enumerate(sentencias) if "CREATE UNIQUE INDEX" in s
+        )
+        self.assertLess(depuracion, indice)
+        self.assertIn(
+            "ORDER BY ultactualizacion DESC NULLS LAST, ctid DESC", sentencias[depuracion]
+        )
+        self.assertIn("orden > 1", sentencias[depuracion])
+        conexion.commit.assert_called_once()
+
+    def test_aplicar_migraciones_rechaza_nombres_desconocidos(self):
+        with self.assertRaises(ValueError):
+            migraciones.aplicar_migraciones(["inexistente"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+import os
+import unittest
+from unittest import mock
+
+import mp_simulado
+import respuesta_estado
+import retornoxmlmp
+
+
+class MpSimuladoTests(unittest.TestCase):
+    def _iniciar(self, **parametros):
+        servidor, servicio, url = mp_simulado.iniciar_en_segundo_plano(
+            mp_simulado.ConfiguracionSimulador(**parametros)
+        )
+        self.addCleanup(servidor.server_close)
+        self.addCleanup(servidor.shutdown)
+        entorno = mock.patch.dict(os.environ, {"MP_SOAP_HOST": url})
+        entorno.start()
+        self.addCleanup(entorno.stop)
+        intervalo = mock.patch.object(retornoxmlmp, "MIN_INTERVALO_SOAP_SEGUNDOS", 0)
+        intervalo.start()
+        self.addCleanup(intervalo.stop)
+        return servicio
+
+    def test_sirve_estado_y_archivo_por_http(self):
+        servicio = self._iniciar(tamano_archivo=100_000)
+        codigo = next(
+            f"SIM{numero}"
+            for numero in range(100)
+            if any(
+                registro.archivo_id
+                for registro in mp_simulado.generar_historial(f"SIM{numero}")
+            )
+        )
+
+        resultado, error = retornoxmlmp._invocar_servicio(
+            codigo, usar_test=True, max_reintentos=1, mostrar_respuesta=False
+        )
+        self.assertIsNone(error)
+        respuesta = respuesta_estado.parsear_respuesta_estado(resultado.xml_respuesta)
+        esperado = mp_simulado.generar_historial(codigo)
+        self.assertEqual(
+            [registro.estado_id for registro in respuesta.estados],
+            [registro.estado_id for registro in esperado],
+        )
+
+        datos, error = retornoxmlmp._invocar_servicio_archivo(
+            respuesta.estado_id_archivo, usar_test=True, max_reintentos=1
+        )
+        self.assertIsNone(error)
+        contenido = datos["archivo_contenido"]
+        self.assertTrue(contenido.base64_valido)
+        self.assertEqual(contenido.tamano_decodificado, 100_000)
+        self.assertEqual(servicio.contadores, {"estado": 1, "archivo": 1})
+
+    def test_rafaga_429_informa_retry_after(self):
+        servicio = self._iniciar(probabilidad_rafaga_429=1.0, duracion_rafaga_429=0.5)
+
+        resultado, error = retornoxmlmp._invocar_servicio(
+            "SIM1", usar_test=True, max_reintentos=1, mostrar_respuesta=False
+        )
+
+        self.assertIsNone(resultado)
+        self.assertIn("HTTP 429", error)
+        self.assertIn("Retry-After: 1", error)
+        self.assertEqual(servicio.contadores, {"429": 1})
+
+
+if __name__ == "__main__":
+    unittest.main()
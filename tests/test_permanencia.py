@@ -0,0 +1,83 @@
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+
+import permanencia
+
+
+class PermanenciaTests(unittest.TestCase):
+    def _modelo(self):
+        modelo = permanencia.ModeloPermanencia()
+        modelo.sumar("Enviada", 5, 10)
+        modelo.sumar("Enviada", 7, 10)
+        modelo.sumar("Ingresada", 3, 2)
+        return modelo
+
+    def test_espera_se_condiciona_al_tiempo_transcurrido(self):
+        modelo = self._modelo()
+
+        self.assertEqual(modelo.espera("Enviada", timedelta(0)), timedelta(hours=32))
+        self.assertEqual(
+            modelo.espera("Enviada", timedelta(hours=40)), timedelta(hours=88)
+        )
+        self.assertIsNone(modelo.espera("Enviada", timedelta(hours=200)))
+        self.assertIsNone(modelo.espera("Ingresada", timedelta(0)))
+
+    def test_proxima_consulta_respeta_limites(self):
+        modelo = self._modelo()
+        ahora = datetime(2025, 1, 10, 12, 0)
+
+        self.assertEqual(
+            modelo.proxima_consulta("Enviada", ahora - timedelta(hours=30), ahora),
+            ahora + permanencia.ESPERA_MINIMA,
+        )
+        self.assertEqual(
+            modelo.proxima_consulta("Ingresada", ahora, ahora),
+            ahora + permanencia.ESPERA_SIN_MODELO,
+        )
+        self.assertEqual(
+            modelo.proxima_consulta("Enviada", None, ahora),
+            ahora + permanencia.ESPERA_SIN_MODELO,
+        )
+
+    def test_actualizar_modelo_recalcula_codigos_por_alta_con_solapamiento(self):
+        conexion = mock.MagicMock()
+        cursor = conexion.cursor.return_value.__enter__.return_value
+        marca = datetime(2025, 1, 10, 12, 0)
+        hasta = datetime(2025, 1, 11, 12, 0)
+        cursor.fetchone.side_effect = [(marca,), (3, 7)]
+
+        transiciones = permanencia.actualizar_modelo(conexion, hasta=hasta)
+
+        self.assertEqual(transiciones, 7)
+        sentencias = [llamada.args[0] for llamada in cursor.execute.call_args_list]
+        self.assertEqual(
+            sentencias[2:7],
+            [
+                permanencia._SENTENCIA_CODIGOS_AFECTADOS,
+                permanencia._SENTENCIA_RESTAR_APORTES,
+                permanencia._SENTENCIA_BORRAR_APORTES,
+                permanencia._SENTENCIA_TRANSICIONES,
+                permanencia._SENTENCIA_SUMAR_APORTES,
+            ],
+        )
+        self.assertIn("notpolhistoricompalta > %(desde)s", sentencias[2])
+        self.assertEqual(
+            cursor.execute.call_args_list[2].args[1],
+            {"desde": marca - permanencia.SOLAPAMIENTO_MARCA, "hasta": hasta},
+        )
+        self.assertEqual(cursor.execute.call_args.args[1], (hasta,))
+        conexion.commit.assert_called_once()
+
+    def test_sentencias_no_dejan_llaves_sin_interpolar(self):
+        for nombre in dir(permanencia):
+            if nombre.startswith("_SENTENCIA_"):
+                with self.subTest(sentencia=nombre):
+                    self.assertNotIn("{", getattr(permanencia, nombre))
+        self.assertIn(
+            str(permanencia.CANTIDAD_CUBETAS - 1), permanencia._SENTENCIA_TRANSICIONES
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
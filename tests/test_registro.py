@@ -0,0 +1,72 @@
+import io
+import json
+import unittest
+
+import registro
+
+
+class RegistroTests(unittest.TestCase):
+    def setUp(self):
+        self.salida = io.StringIO()
+        self.addCleanup(registro.configurar, destino=io.StringIO())
+
+    def _eventos(self):
+        return [json.loads(linea) for linea in self.salida.getvalue().splitlines()]
+
+    def test_json_con_categoria_y_truncado(self):
+        registro.configurar(
+            nivel="INFO", formato="json", max_payload=10, destino=self.salida
+        )
+        registro.obtener("retornoxmlmp").info("archivo=%s", registro.truncar("A" * 30))
+        registro.paso("_invocar_servicio", "ADVERTENCIA", "respuesta al 100%")
+
+        eventos = self._eventos()
+        self.assertEqual(eventos[0]["categoria"], "retornoxmlmp")
+        self.assertEqual(
+            eventos[0]["mensaje"], "archivo=AAAAAAAAAA... [20 caracteres omitidos]"
+        )
+        self.assertEqual(eventos[1]["nivel"], "WARNING")
+        self.assertEqual(eventos[1]["categoria"], "invocar_servicio")
+        self.assertEqual(eventos[1]["mensaje"], "[ADVERTENCIA] respuesta al 100%")
+
+    def test_niveles_deshabilitados_no_formatean(self):
+        registro.configurar(nivel="WARNING", destino=self.salida)
+        llamadas = []
+
+        def costoso():
+            llamadas.append(1)
+            return "xml"
+
+        registro.paso("procesar_envios", "OK", "XML: %s", registro.diferido(costoso))
+        registro.obtener("soap.xml").info("%s", registro.diferido(costoso))
+
+        self.assertEqual(llamadas, [])
+        self.assertEqual(self.salida.getvalue(), "")
+        self.assertFalse(registro.depurar_xml())
+
+        registro.configurar(nivel="WARNING", xml=True, destino=self.salida)
+        registro.obtener("soap.xml").info("%s", registro.diferido(costoso))
+        self.assertEqual(llamadas, [1])
+        self.assertTrue(registro.depurar_xml())
+
+    def test_muestreo_descarta_informativos_pero_no_errores(self):
+        registro.configurar(
+            nivel="INFO",
+            formato="json",
+            muestreo={"procesar_envios": 0.0},
+            destino=self.salida,
+        )
+        log = registro.obtener("procesar_envios")
+        for numero in range(20):
+            log.info("codigo %s", numero)
+        log.error("fallo")
+        registro.obtener("app").info("sin muestreo")
+
+        self.assertEqual(
+            [evento["mensaje"] for evento in self._eventos()],
+            ["fallo", "sin muestreo"],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+import pickle
+import unittest
+
+import respuesta_estado
+
+
+XML_HISTORIAL_ARCHIVO = """<?xml version="1.0"?>
+<soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/" xmlns:tem="http://tempuri.org/">
+  <soapenv:Body>
+    <tem:ObtenerEstadoNotificacionResponse>
+      <tem:ObtenerEstadoNotificacionResult>
+        <tem:HistorialEstados>
+          <tem:EstadoNotificacion>
+            <tem:EstadoNotificacionId>111</tem:EstadoNotificacionId>
+            <tem:Fecha>2025-10-21T16:45:38</tem:Fecha>
+            <tem:ArchivoId>0</tem:ArchivoId>
+          </tem:EstadoNotificacion>
+          <tem:EstadoNotificacion>
+            <tem:EstadoNotificacionId>333</tem:EstadoNotificacionId>
+            <tem:Fecha>2025-10-27T11:00:00</tem:Fecha>
+            <tem:ArchivoId>999</tem:ArchivoId>
+          </tem:EstadoNotificacion>
+          <tem:EstadoNotificacion>
+            <tem:EstadoNotificacionId>222</tem:EstadoNotificacionId>
+            <tem:Fecha>2025-10-28T21:04:49</tem:Fecha>
+            <tem:ArchivoId>0</tem:ArchivoId>
+          </tem:EstadoNotificacion>
+        </tem:HistorialEstados>
+      </tem:ObtenerEstadoNotificacionResult>
+    </tem:ObtenerEstadoNotificacionResponse>
+  </soapenv:Body>
+</soapenv:Envelope>
+"""
+
+
+class RespuestaEstadoTests(unittest.TestCase):
+    def setUp(self):
+        respuesta_estado.limpiar_memo()
+
+    def test_parsea_una_vez_y_expone_ultimos_estados(self):
+        respuesta = respuesta_estado.parsear_respuesta_estado(XML_HISTORIAL_ARCHIVO)
+
+        self.assertTrue(respuesta.xml_valido)
+        self.assertEqual([estado.estado_id for estado in respuesta.estados], [111, 333, 222])
+        self.assertEqual(respuesta.ultimo_estado.estado_id, 222)
+        self.assertEqual(respuesta.ultimo_estado_con_archivo.estado_id, 333)
+        self.assertEqual(respuesta.estado_id_archivo, "333")
+        self.assertIs(
+            respuesta_estado.parsear_respuesta_estado(XML_HISTORIAL_ARCHIVO), respuesta
+        )
+        with self.assertRaises(AttributeError):
+            respuesta.ultimo_estado = None
+        self.assertEqual(pickle.loads(pickle.dumps(respuesta)), respuesta)
+
+    def test_xml_invalido_se_informa_como_error(self):
+        respuesta = respuesta_estado.parsear_respuesta_estado("<no cerrado>")
+
+        self.assertFalse(respuesta.xml_valido)
+        self.assertEqual(respuesta.estados, ())
+        self.assertIsNone(respuesta.estado_id_archivo)
+        self.assertTrue(respuesta.errores[0].startswith("XML inválido"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,6 +1,8 @@
 import unittest
 from unittest import mock
 
+import psycopg2
+
 import retornoxmlmp
 
 
@@ -121,14 +123,42 @@ class RetornoXmlMpTests(unittest.TestCase):
         self.assertEqual(estado_id, "222")
 
         datos_archivo = retornoxmlmp._extraer_datos_archivo(XML_ARCHIVO)
-        self.assertEqual(
-            datos_archivo,
-            {
-                "archivo_id": "456",
-                "archivo_nombre": "archivo.pdf",
-                "archivo_contenido": "ABCDEF",
-            },
+        self.assertEqual(datos_archivo["archivo_id"], "456")
+        self.assertEqual(datos_archivo["archivo_nombre"], "archivo.pdf")
+        self.assertEqual(datos_archivo["archivo_contenido"].texto(), "ABCDEF")
+
+    def test_extraer_datos_archivo_por_fragmentos(self):
+        xml = XML_ARCHIVO.replace("ABCDEF", "\n   QUJD\nREVG  \n").encode("utf-8")
+        fragmentos = [xml[inicio:inicio + 7] for inicio in range(0, len(xml), 7)]
+
+        datos_archivo = retornoxmlmp._extraer_datos_archivo(iter(fragmentos))
+
+        contenido = datos_archivo["archivo_contenido"]
+        self.assertEqual(contenido.texto(), "QUJD\nREVG")
+        self.assertEqual(contenido.tamano_decodificado, 6)
+        self.assertTrue(contenido.base64_valido)
+        self.assertEqual(list(contenido.fragmentos(4)), [b"QUJD", b"\nREV", b"G"])
+
+    def test_invocar_servicio_archivo_conserva_fragmentos_de_espacios(self):
+        xml = XML_ARCHIVO.replace("archivo.pdf", "mi archivo.pdf").encode("utf-8")
+        corte = xml.index(b" archivo.pdf")
+        respuesta = mock.MagicMock(status_code=200)
+        respuesta.iter_content.return_value = iter(
+            [xml[:corte], b" ", xml[corte + 1:]]
         )
+        sesion = mock.MagicMock()
+        sesion.post.return_value = respuesta
+
+        with mock.patch.object(
+            retornoxmlmp, "_obtener_sesion_soap", return_value=sesion
+        ), mock.patch.object(retornoxmlmp, "_respetar_intervalo_solicitudes"):
+            datos, error = retornoxmlmp._invocar_servicio_archivo(
+                "456", usar_test=True, max_reintentos=1
+            )
+
+        self.assertIsNone(error)
+        self.assertEqual(datos["archivo_nombre"], "mi archivo.pdf")
+        self.assertEqual(datos["archivo_contenido"].texto(), "ABCDEF")
 
     def test_extraer_estado_prioriza_historial_con_archivo(self):
         estado_id = retornoxmlmp._extraer_estado_notificacion_id(XML_HISTORIAL_ARCHIVO)
@@ -144,11 +174,13 @@ class RetornoXmlMpTests(unittest.TestCase):
         )
         conn_pg = mock.MagicMock()
         cursor = conn_pg.cursor.return_value.__enter__.return_value
+        cursor.fetchall.return_value = []
+        digest = retornoxmlmp.almacen_archivos.calcular_digest_contenido("ABCDEF")
 
         with mock.patch.object(
             retornoxmlmp,
             "_invocar_servicio_archivo",
-            return_value=(XML_ARCHIVO, None),
+            return_value=(retornoxmlmp._extraer_datos_archivo(XML_ARCHIVO), None),
         ):
             actualizado = retornoxmlmp._actualizar_datos_archivo(
                 conn_pg,
@@ -158,21 +190,290 @@ class RetornoXmlMpTests(unittest.TestCase):
             )
 
         self.assertTrue(actualizado)
-        self.assertEqual(cursor.execute.call_count, 2)
-        params = cursor.execute.call_args_list[0].args[1]
+        self.assertEqual(cursor.execute.call_args_list[0].args[1], ([digest],))
+        cursor.copy_expert.assert_called_once()
+        # El contenido se envía por COPY, que se lee al llamar a copy_expert.
+        self.assertEqual(cursor.execute.call_count, 5)
+        params = cursor.execute.call_args_list[3].args[1]
+        self.assertEqual(params, (123, 456, "archivo.pdf", digest, 6, "ABC123"))
+        historial_params = cursor.execute.call_args_list[4].args[1]
+        self.assertEqual(historial_params, ("ABC123",))
+        conn_pg.commit.assert_called_once()
+
+    def test_indice_archivos_evita_descargas_repetidas(self):
+        envio = retornoxmlmp.EnvioNotificacion(
+            id_envio=1,
+            pmovimientoid=10,
+            pactuacionid=20,
+            pdomicilioelectronicopj="correo@test.com",
+            codigoseguimientomp="ABC123 ",
+        )
+        conn_pg = mock.MagicMock()
+        cursor = conn_pg.cursor.return_value.__enter__.return_value
+        cursor.fetchall.return_value = [("ABC123", 123, 456)]
+        indice = retornoxmlmp._IndiceArchivosDescargados()
+        indice.cargar(conn_pg, [envio])
+        indice.cargar(conn_pg, [envio])
+
+        with mock.patch.object(
+            retornoxmlmp,
+            "_invocar_servicio_archivo",
+            return_value=(retornoxmlmp._extraer_datos_archivo(XML_ARCHIVO), None),
+        ) as invocar:
+            omitido = retornoxmlmp._obtener_datos_archivo_envio(
+                envio, XML_CON_ESTADO, True, indice=indice
+            )
+            descargado = retornoxmlmp._obtener_datos_archivo_envio(
+                envio, XML_HISTORIAL, True, indice=indice
+            )
+
+        cursor.execute.assert_called_once()
+        self.assertIsNone(omitido)
+        self.assertEqual(descargado.estado_id, 222)
+        invocar.assert_called_once()
+        self.assertEqual(invocar.call_args.args[0], "222")
+        self.assertEqual(indice.llamadas_evitadas, 1)
+
+    def test_punto_control_reanuda_despues_de_la_ultima_clave(self):
+        envios = [
+            retornoxmlmp.EnvioNotificacion(
+                id_envio=numero,
+                pmovimientoid=numero,
+                pactuacionid=20,
+                pdomicilioelectronicopj="correo@test.com",
+                codigoseguimientomp=f"COD{numero}",
+            )
+            for numero in range(1, 6)
+        ]
+        iteraciones = retornoxmlmp.ITERACIONES[:2]
+        inicio = retornoxmlmp.datetime(2025, 10, 1, 8, 0)
+        conn_panel = mock.MagicMock()
+        cursor = conn_panel.cursor.return_value.__enter__.return_value
+        cursor.fetchone.return_value = ("abc", inicio)
+        cursor.fetchall.side_effect = [
+            [
+                (iteraciones[0].descripcion, None, None, None, 5, True),
+                (iteraciones[1].descripcion, 2, 20, "correo@test.com ", 2, False),
+            ],
+            [(4, 20, "correo@test.com")],
+        ]
+
+        with mock.patch.object(retornoxmlmp.extras, "execute_values") as guardar:
+            punto = retornoxmlmp._PuntoControl.iniciar(
+                conn_panel, iteraciones, retornoxmlmp.datetime.now(), reanudar=True
+            )
+            pendientes = punto.filtrar_pendientes(iteraciones[1].descripcion, envios)
+            punto.marcar(iteraciones[1].descripcion, pendientes[-1])
+            punto.guardar()
+
+        self.assertEqual(punto.ejecucion_id, "abc")
+        self.assertEqual(punto.inicio, inicio)
+        self.assertTrue(punto.completada(iteraciones[0].descripcion))
+        self.assertFalse(punto.completada(iteraciones[1].descripcion))
+        self.assertEqual([envio.id_envio for envio in pendientes], [3, 5])
+        self.assertEqual(punto.envios_omitidos, 3)
+        filas = {fila[1]: fila for fila in guardar.call_args.args[2]}
         self.assertEqual(
-            params,
-            (
-                123,
-                456,
-                "archivo.pdf",
-                "ABCDEF",
-                "ABC123",
-            ),
+            filas[iteraciones[1].descripcion][:8],
+            ("abc", iteraciones[1].descripcion, inicio, 5, 20, "correo@test.com", 3, False),
         )
-        historial_params = cursor.execute.call_args_list[1].args[1]
-        self.assertEqual(historial_params, ("ABCDEF", "ABC123", "ABC123"))
-        conn_pg.commit.assert_called_once()
+
+    def test_punto_control_finalizar_no_completa_iteraciones_fallidas(self):
+        iteraciones = retornoxmlmp.ITERACIONES[:2]
+        conn_panel = mock.MagicMock()
+
+        with mock.patch.object(retornoxmlmp.extras, "execute_values") as guardar:
+            punto = retornoxmlmp._PuntoControl.iniciar(
+                conn_panel, iteraciones, retornoxmlmp.datetime.now()
+            )
+            punto.completar(iteraciones[0].descripcion)
+            punto.finalizar()
+
+        self.assertTrue(punto.completada(iteraciones[0].descripcion))
+        self.assertFalse(punto.completada(iteraciones[1].descripcion))
+        # Cada guardado escribe solo las iteraciones modificadas desde el anterior.
+        filas = {
+            fila[1]: fila for llamada in guardar.call_args_list for fila in llamada.args[2]
+        }
+        self.assertTrue(filas[iteraciones[0].descripcion][7])
+        self.assertFalse(filas[iteraciones[1].descripcion][7])
+
+    def test_particion_filtra_envios_y_toma_bloqueos_compartidos(self):
+        particion = retornoxmlmp.Particion.desde_texto("2/4")
+        with self.assertRaises(ValueError):
+            retornoxmlmp.Particion.desde_texto("5/4")
+
+        conn_pg = mock.MagicMock()
+        cursor = conn_pg.cursor.return_value.__enter__.return_value
+        cursor.fetchall.return_value = []
+        retornoxmlmp._obtener_envios(
+            conn_pg,
+            retornoxmlmp.ITERACIONES[0],
+            retornoxmlmp.datetime.now(),
+            particion=particion,
+        )
+        consulta, params = cursor.execute.call_args.args
+        self.assertIn("hashtext(codigoseguimientompnorm)", consulta)
+        self.assertEqual(params[-2:], (4, 1))
+
+        conn_panel = mock.MagicMock(closed=False)
+        cursor = conn_panel.cursor.return_value.__enter__.return_value
+        cursor.fetchone.side_effect = [(True,), (False,)]
+        with retornoxmlmp._BloqueoEjecucion(conn_panel, particion) as adquirido:
+            self.assertFalse(adquirido)
+        sentencias = [llamada.args[0] for llamada in cursor.execute.call_args_list]
+        self.assertEqual(
+            sentencias,
+            [
+                "SELECT pg_try_advisory_lock_shared(%s)",
+                "SELECT pg_try_advisory_lock(%s, %s)",
+                "SELECT pg_advisory_unlock_shared(%s)",
+            ],
+        )
+
+    def test_almacenar_xml_resuelve_upsert_en_una_sentencia(self):
+        envio = retornoxmlmp.EnvioNotificacion(
+            id_envio=1,
+            pmovimientoid=10,
+            pactuacionid=20,
+            pdomicilioelectronicopj="correo@test.com",
+            codigoseguimientomp="ABC123",
+        )
+        conn_panel = mock.MagicMock()
+        cursor = conn_panel.cursor.return_value.__enter__.return_value
+
+        for fila, esperado in (((True,), "insert"), ((False,), "update"), (None, "sin_cambios")):
+            cursor.reset_mock()
+            cursor.fetchone.return_value = fila
+            resultado = retornoxmlmp._almacenar_xml(conn_panel, envio, XML_CON_ESTADO)
+            self.assertEqual(resultado, esperado)
+            cursor.execute.assert_called_once()
+
+        sentencia, params = cursor.execute.call_args.args
+        self.assertIn("ON CONFLICT", sentencia)
+        self.assertIn("IS DISTINCT FROM EXCLUDED.contenido_digest", sentencia)
+        self.assertEqual(
+            params[4],
+            retornoxmlmp._calcular_digest_xml(XML_CON_ESTADO.strip()),
+        )
+
+    def _envios_de_prueba(self, cantidad):
+        return [
+            retornoxmlmp.EnvioNotificacion(
+                id_envio=indice,
+                pmovimientoid=indice,
+                pactuacionid=indice,
+                pdomicilioelectronicopj="correo@test.com",
+                codigoseguimientomp=f"COD{indice}",
+            )
+            for indice in range(1, cantidad + 1)
+        ]
+
+    def test_escritura_diferida_confirma_por_lote(self):
+        conn_panel = mock.MagicMock()
+        conn_pg = mock.MagicMock()
+        escritura = retornoxmlmp._EscrituraDiferida(conn_panel, conn_pg, max_envios=2)
+
+        with mock.patch.object(
+            retornoxmlmp.extras,
+            "execute_values",
+            return_value=[(1, 1, "correo@test.com", True)],
+        ) as execute_values:
+            for envio in self._envios_de_prueba(2):
+                escritura.agregar_xml("ctx", envio, XML_CON_ESTADO)
+                self.assertEqual(execute_values.call_count, 0)
+                escritura.envio_completado()
+
+        execute_values.assert_called_once()
+        self.assertEqual(len(execute_values.call_args.args[2]), 2)
+        conn_panel.commit.assert_called_once()
+        self.assertEqual(escritura.resultados_xml["insert"], 1)
+        self.assertEqual(escritura.resultados_xml["sin_cambios"], 1)
+        retornos = escritura.tomar_retornos_modificados()
+        self.assertEqual([retorno.codigo_seguimiento for retorno in retornos], ["COD1"])
+        self.assertEqual(escritura.tomar_retornos_modificados(), [])
+
+    def test_escritura_diferida_aisla_filas_con_error(self):
+        conn_panel = mock.MagicMock()
+        cursor = conn_panel.cursor.return_value.__enter__.return_value
+        al_fallar = mock.Mock()
+        escritura = retornoxmlmp._EscrituraDiferida(
+            conn_panel, mock.MagicMock(), al_fallar=al_fallar
+        )
+        envio_ok, envio_error = self._envios_de_prueba(2)
+        escritura.agregar_xml("ctx", envio_ok, XML_CON_ESTADO)
+        escritura.agregar_xml("ctx", envio_error, XML_CON_ESTADO)
+
+        with mock.patch.object(
+            retornoxmlmp.extras,
+            "execute_values",
+            side_effect=[
+                psycopg2.Error("lote"),
+                [(1, 1, "correo@test.com", False)],
+                psycopg2.Error("fila"),
+            ],
+        ):
+            escritura.vaciar()
+
+        conn_panel.rollback.assert_called_once()
+        sentencias = [llamada.args[0] for llamada in cursor.execute.call_args_list]
+        self.assertIn("ROLLBACK TO SAVEPOINT retornomp_fila", sentencias)
+        self.assertIn("RELEASE SAVEPOINT retornomp_fila", sentencias)
+        al_fallar.assert_called_once()
+        self.assertIs(al_fallar.call_args.args[1], envio_error)
+        self.assertEqual(escritura.resultados_xml["update"], 1)
+
+    def test_registro_eventos_agrupa_repetidos_y_vacia_al_cerrar(self):
+        conexion = mock.MagicMock()
+        fecha = retornoxmlmp.datetime(2025, 1, 1)
+
+        with mock.patch.object(retornoxmlmp.extras, "execute_values") as execute_values:
+            with retornoxmlmp._RegistroEventos(lambda: conexion, intervalo=60) as eventos:
+                for codigo in ("A1", "B2", "C3"):
+                    eventos.registrar(
+                        fecha, 0, f"{codigo}: HTTP 429", clave="HTTP 429"
+                    )
+                eventos.registrar(fecha, 1, "Iteración completa")
+
+        execute_values.assert_called_once()
+        filas = execute_values.call_args.args[2]
+        self.assertEqual(
+            [fila[3] for fila in filas],
+            ["A1: HTTP 429 (x3)", "Iteración completa"],
+        )
+        conexion.commit.assert_called_once()
+        conexion.close.assert_called_once()
+
+    def test_registro_eventos_reconecta_y_conserva_eventos_si_falla_la_escritura(self):
+        caida = mock.MagicMock()
+        caida.commit.side_effect = psycopg2.InterfaceError("connection already closed")
+        caida.rollback.side_effect = psycopg2.InterfaceError("connection already closed")
+        nueva = mock.MagicMock()
+        conectar = mock.Mock(side_effect=[caida, nueva])
+        fecha = retornoxmlmp.datetime(2025, 1, 1)
+        eventos = retornoxmlmp._RegistroEventos(conectar, intervalo=60, max_cola=1)
+        eventos.cerrar()
+        pendientes = {}
+        for texto in ("A1: HTTP 429", "B2: HTTP 429", "Timeout"):
+            eventos._agrupar(pendientes, (fecha, 0, texto, texto[4:] or texto))
+        eventos._descartados = 2
+
+        with mock.patch.object(retornoxmlmp.extras, "execute_values") as execute_values:
+            self.assertIsNone(eventos._vaciar(None, pendientes))
+            caida.close.assert_called_once()
+            # Se conserva un grupo (max_cola) y el resto se cuenta como descartado.
+            self.assertEqual(len(pendientes), 1)
+            self.assertEqual(eventos._descartados, 4)
+
+            self.assertIs(eventos._vaciar(None, pendientes), nueva)
+
+        self.assertEqual(conectar.call_count, 2)
+        filas = execute_values.call_args.args[2]
+        self.assertEqual(filas[0][3], "Timeout")
+        self.assertIn("descartados por cola llena: 4", filas[1][3])
+        nueva.commit.assert_called_once()
+        self.assertEqual(pendientes, {})
+        self.assertEqual(eventos._descartados, 0)
 
 
 if __name__ == "__main__":
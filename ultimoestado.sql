@@ -1,7 +1,8 @@
 -- Crea un índice que optimiza la búsqueda del último estado por movimiento,
 -- actuación y domicilio electrónico.
-CREATE INDEX IF NOT EXISTS idx_notpolhistoricomp_mov_act_dom_fecha
-    ON public.notpolhistoricomp (pmovimientoid, pactuacionid, pdomicilioelectronicopj, notpolhistoricompfecha DESC);
+-- Usa la columna tipada notpolhistoricompfechats (migración fecha_historial_tipada).
+CREATE INDEX IF NOT EXISTS idx_notpolhistoricomp_claves_fechats
+    ON public.notpolhistoricomp (pmovimientoid, pactuacionid, pdomicilioelectronicopj, notpolhistoricompfechats DESC NULLS LAST);
 
 -- Función que devuelve la fecha y el estado más reciente para los parámetros indicados.
 CREATE OR REPLACE FUNCTION public.obtener_ultimo_estado(
@@ -24,10 +25,7 @@ BEGIN
     WHERE n.pmovimientoid = p_pmovimientoid
       AND n.pactuacionid = p_pactuacionid
       AND n.pdomicilioelectronicopj = p_pdomicilioelectronicopj
-    ORDER BY to_timestamp(
-        left(replace(n.notpolhistoricompfecha, 'T', ' '), 19),
-        'YYYY-MM-DD HH24:MI:SS'
-    ) DESC NULLS LAST,
+    ORDER BY n.notpolhistoricompfechats DESC NULLS LAST,
     n.notpolhistoricompestadonid DESC NULLS LAST
     LIMIT 1;
 END;